@@ -0,0 +1,87 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from helper import get_commons_wikitexts
+from rate_limits import total_concurrency
+
+WINDOW_SIZE = 500
+WIKITEXT_BATCH_SIZE = 50
+
+# Concurrent engine for generate_metadata.
+#
+# Files are processed in windows of WINDOW_SIZE. Within a window, wikitext
+# batches and per-file record fetches (BHL page/item/title, Flickr tags) run
+# concurrently, while rate_limits.py keeps each host within its own
+# concurrency and rate limits. Records are returned in the order of the input
+# files, so the rows produced from them match the serial path.
+#
+# With a `prefetch` function, all wikitexts of a window are fetched first and
+# passed to it, so that it can warm the caches (e.g. one BHL request per item)
+# before the per-file fetches start. With a `parse` function, each wikitext is
+# parsed once as it arrives, and both stages get the parsed form instead.
+
+
+async def _harvest_window(files, fetch_record, max_in_flight, prefetch=None, parse=None):
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=max_in_flight)
+    )
+    in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def fetch_one(file, wikitext):
+        async with in_flight:
+            return await asyncio.to_thread(fetch_record, file, wikitext)
+
+    async def fetch_wikitexts(batch):
+        async with in_flight:
+            return await asyncio.to_thread(
+                lambda: [
+                    (file, parse(wikitext) if parse else wikitext)
+                    for file, wikitext in get_commons_wikitexts(batch)
+                ]
+            )
+
+    async def fetch_batch(batch):
+        wikitexts = await fetch_wikitexts(batch)
+        return await asyncio.gather(
+            *(fetch_one(file, wikitext) for file, wikitext in wikitexts)
+        )
+
+    batches = [
+        files[start : start + WIKITEXT_BATCH_SIZE]
+        for start in range(0, len(files), WIKITEXT_BATCH_SIZE)
+    ]
+    if prefetch is None:
+        results = await asyncio.gather(*(fetch_batch(batch) for batch in batches))
+        return [record for batch_records in results for record in batch_records]
+
+    batch_wikitexts = await asyncio.gather(*(fetch_wikitexts(batch) for batch in batches))
+    wikitexts = [pair for pairs in batch_wikitexts for pair in pairs]
+    await asyncio.to_thread(prefetch, wikitexts)
+    return await asyncio.gather(
+        *(fetch_one(file, wikitext) for file, wikitext in wikitexts)
+    )
+
+
+def harvest_records(
+    files,
+    fetch_record,
+    window_size=WINDOW_SIZE,
+    max_in_flight=None,
+    prefetch=None,
+    parse=None,
+):
+    """
+    Yields fetch_record(file, wikitext) for each file, in the order of `files`.
+
+    `fetch_record` must be thread-safe; it is run in a thread pool so that the
+    blocking `requests` calls of many files overlap. `prefetch`, if given, is
+    called with the window's (file, wikitext) pairs before any fetch_record.
+    `parse`, if given, turns each wikitext into what both of them receive.
+    """
+    files = list(files)
+    max_in_flight = max_in_flight or max(total_concurrency(), 1)
+    for start in range(0, len(files), window_size):
+        window = files[start : start + window_size]
+        yield from asyncio.run(
+            _harvest_window(window, fetch_record, max_in_flight, prefetch, parse)
+        )
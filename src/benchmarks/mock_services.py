@@ -0,0 +1,584 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+
+# Local stand-in for the services the pipeline talks to.
+#
+# One HTTP server answers for Commons (MediaWiki API, wbgetentities,
+# wbeditentity, OAuth2 token), BHL api3, Flickr, GBIF and the Wikidata SPARQL
+# endpoint. Requests are addressed as http://127.0.0.1:<port>/<host>/<path>;
+# route_to_mock() rewrites the real URLs to that form for everything that goes
+# through `requests` (including WikibaseIntegrator) and SPARQLWrapper.
+#
+# Responses come from a recorded fixtures file when it has an entry for the
+# request, and otherwise from a synthetic category of `n_files` files:
+#
+#   file i    "Benchmark plate {i} BHL{page}.jpg", in "Benchmark category"
+#   page      1000000 + i, on item 5000 + i // pages_per_item
+#   item      on title 900 + item // items_per_title
+#   Flickr    photo 7000000 + i, one binomial tag per page
+#
+# Every request can be delayed (`latency`, plus random `jitter`) and failed
+# with HTTP 503 at `error_rate`.
+
+SYNTHETIC_CATEGORY = "Benchmark category"
+MOCKED_HOSTS = (
+    "commons.wikimedia.org",
+    "www.biodiversitylibrary.org",
+    "biodiversitylibrary.org",
+    "api.flickr.com",
+    "api.gbif.org",
+    "query.wikidata.org",
+    "www.wikidata.org",
+    "meta.wikimedia.org",
+)
+# Query parameters that don't identify a request (see fixture_key).
+VOLATILE_PARAMS = {"apikey", "api_key", "token", "format", "formatversion", "maxlag"}
+
+
+def fixture_key(host, path, params):
+    """Key of a request in a recorded fixtures file: host, path and sorted identifying params."""
+    params = sorted((k, v) for k, v in params.items() if k not in VOLATILE_PARAMS)
+    return f"{host}{path}?{urlencode(params)}"
+
+
+def _hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _with_hashes(claim):
+    """Adds the snak and reference hashes Commons returns with saved statements."""
+    claim["mainsnak"] = {**claim["mainsnak"], "hash": _hash(claim["mainsnak"])}
+    qualifiers = claim.get("qualifiers") or {}
+    claim["qualifiers"] = {
+        prop: [{**snak, "hash": _hash(snak)} for snak in snaks]
+        for prop, snaks in qualifiers.items()
+    }
+    claim["qualifiers-order"] = list(qualifiers)
+    references = []
+    for reference in claim.get("references") or []:
+        snaks = reference.get("snaks", {})
+        references.append(
+            {
+                "hash": _hash(snaks),
+                "snaks": {
+                    prop: [{**snak, "hash": _hash(snak)} for snak in values]
+                    for prop, values in snaks.items()
+                },
+                "snaks-order": list(snaks),
+            }
+        )
+    claim["references"] = references
+    return claim
+
+
+class SyntheticCategory:
+    def __init__(self, n_files, pages_per_item=50, items_per_title=5, species=40):
+        self.n_files = n_files
+        self.pages_per_item = pages_per_item
+        self.items_per_title = items_per_title
+        self.species = species
+        self._lock = threading.Lock()
+        self.entities = {}
+        self.next_revision = 1000
+
+    def file_name(self, i):
+        return f"Benchmark plate {i} BHL{self.page_id(i)}.jpg"
+
+    def page_id(self, i):
+        return 1000000 + i
+
+    def item_id(self, i):
+        return 5000 + i // self.pages_per_item
+
+    def title_id(self, item_id):
+        return 900 + item_id // self.items_per_title
+
+    def flickr_id(self, i):
+        return 7000000 + i
+
+    def species_name(self, i):
+        return f"Benchmarkia species{i % self.species}"
+
+    def flickr_tags(self, i):
+        return [f"taxonomy:binomial={self.species_name(i)}"]
+
+    def file_index(self, title):
+        name = title.replace("File:", "", 1)
+        if not name.startswith("Benchmark plate "):
+            return None
+        try:
+            i = int(name.split(" ")[2])
+        except (IndexError, ValueError):
+            return None
+        return i if 0 <= i < self.n_files and name == self.file_name(i) else None
+
+    def page_pairs(self):
+        return [(str(self.page_id(i)), str(self.flickr_id(i))) for i in range(self.n_files)]
+
+    # BHL
+
+    def page_record(self, page_id):
+        i = page_id - 1000000
+        if not 0 <= i < self.n_files:
+            return None
+        return {
+            "PageID": page_id,
+            "ItemID": self.item_id(i),
+            "Volume": "1",
+            "PageTypes": [{"PageTypeName": "Illustration"}],
+            "PageNumbers": [{"Prefix": "Pl.", "Number": str(i + 1)}],
+            "Names": [{"NameCanonical": self.species_name(i)}],
+        }
+
+    def item_record(self, item_id, pages=False, names=False):
+        indexes = [
+            i
+            for i in range(
+                (item_id - 5000) * self.pages_per_item,
+                (item_id - 5000 + 1) * self.pages_per_item,
+            )
+            if 0 <= i < self.n_files
+        ]
+        if not indexes:
+            return None
+        record = {
+            "ItemID": item_id,
+            "TitleID": self.title_id(item_id),
+            "HoldingInstitution": "Q1150112",
+            "Sponsor": "Q1150112",
+            "Year": "1830",
+            "CopyrightStatus": "Public domain. The BHL considers that this work is no longer under copyright protection.",
+        }
+        if pages:
+            record["Pages"] = [self.page_record(self.page_id(i)) for i in indexes]
+            if not names:
+                for page in record["Pages"]:
+                    del page["Names"]
+        return record
+
+    def title_qid(self, title_id):
+        return f"Q{9000000 + title_id}"
+
+    def title_record(self, title_id):
+        # Every third title has no Wikidata identifier on BHL, so that it has
+        # to be found through P4327 on Wikidata.
+        identifiers = (
+            [{"IdentifierName": "Wikidata", "IdentifierValue": self.title_qid(title_id)}]
+            if title_id % 3
+            else []
+        )
+        return {
+            "TitleID": title_id,
+            "FullTitle": f"Benchmark title {title_id}",
+            "Identifiers": identifiers,
+        }
+
+    def write_bhl_export(self, directory):
+        """Writes the category as a BHL data export (see bhl_export.py)."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        item_ids = sorted({self.item_id(i) for i in range(self.n_files)})
+        title_ids = sorted({self.title_id(item_id) for item_id in item_ids})
+
+        def write(file_name, header, rows):
+            lines = ["\t".join(header)] + ["\t".join(str(v) for v in row) for row in rows]
+            (directory / file_name).write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+        write(
+            "title.txt",
+            ["TitleID", "FullTitle"],
+            [(t, self.title_record(t)["FullTitle"]) for t in title_ids],
+        )
+        write(
+            "titleidentifier.txt",
+            ["TitleID", "IdentifierName", "IdentifierValue"],
+            [
+                (t, identifier["IdentifierName"], identifier["IdentifierValue"])
+                for t in title_ids
+                for identifier in self.title_record(t)["Identifiers"]
+            ],
+        )
+        items = [self.item_record(item_id) for item_id in item_ids]
+        write(
+            "item.txt",
+            ["ItemID", "TitleID", "BarCode", "Year", "HoldingInstitution", "Sponsor", "CopyrightStatus"],
+            [
+                (
+                    item["ItemID"], item["TitleID"], f"benchmarkitem{item['ItemID']}", item["Year"],
+                    item["HoldingInstitution"], item["Sponsor"], item["CopyrightStatus"],
+                )
+                for item in items
+            ],
+        )
+        pages = [self.page_record(self.page_id(i)) for i in range(self.n_files)]
+        write(
+            "page.txt",
+            ["PageID", "ItemID", "SequenceOrder", "Year", "Volume", "Issue", "PagePrefix", "PageNumber", "PageTypeName"],
+            [
+                (
+                    page["PageID"], page["ItemID"], page["PageID"] % self.pages_per_item + 1, "",
+                    page["Volume"], "", page["PageNumbers"][0]["Prefix"],
+                    page["PageNumbers"][0]["Number"], page["PageTypes"][0]["PageTypeName"],
+                )
+                for page in pages
+            ],
+        )
+        write(
+            "pagename.txt",
+            ["NameFound", "NameConfirmed", "PageID"],
+            [
+                (name["NameCanonical"], name["NameCanonical"], page["PageID"])
+                for page in pages
+                for name in page["Names"]
+            ],
+        )
+
+    # Commons
+
+    def mediainfo_id(self, i):
+        return f"M{10000000 + i}"
+
+    def entity(self, mediainfo_id):
+        with self._lock:
+            return self.entities.get(mediainfo_id)
+
+    def lastrevid(self, mediainfo_id):
+        entity = self.entities.get(mediainfo_id)
+        return entity["lastrevid"] if entity else 100
+
+    def edit_entity(self, mediainfo_id, data, baserevid=None):
+        """
+        Applies a wbeditentity call. Claims given as {property: [...]} (as
+        WikibaseIntegrator sends the whole entity) replace the statements;
+        a list of claims is applied as a patch: statements with a known ID
+        are replaced or removed, the others added. With `baserevid`, returns
+        None if the entity is no longer at that revision.
+        """
+        with self._lock:
+            if baserevid and int(baserevid) != self.lastrevid(mediainfo_id):
+                return None
+            entity = self.entities.get(mediainfo_id) or {
+                "type": "mediainfo",
+                "id": mediainfo_id,
+                "pageid": int(mediainfo_id[1:]),
+                "ns": 6,
+                "title": "",
+                "labels": {},
+                "descriptions": {},
+                "statements": {},
+            }
+            claims = data.get("claims") or data.get("statements") or {}
+            if isinstance(claims, list):
+                patch = {claim["id"]: claim for claim in claims if "id" in claim}
+                statements = {}
+                for prop, current in entity["statements"].items():
+                    for claim in current:
+                        claim = patch.pop(claim["id"], claim)
+                        if "remove" not in claim:
+                            statements.setdefault(prop, []).append(claim)
+                new_claims = [claim for claim in claims if "id" not in claim]
+                by_property = {}
+                for claim in new_claims:
+                    by_property.setdefault(claim["mainsnak"]["property"], []).append(claim)
+                claims = {}
+                for prop, values in statements.items():
+                    claims[prop] = values
+                for prop, values in by_property.items():
+                    claims.setdefault(prop, []).extend(values)
+            statements = {}
+            for prop, values in claims.items():
+                for n, claim in enumerate(values):
+                    if "remove" in claim:
+                        continue
+                    claim = _with_hashes(dict(claim))
+                    claim.setdefault("id", f"{mediainfo_id}${self.next_revision}-{prop}-{n}")
+                    statements.setdefault(prop, []).append(claim)
+            entity["statements"] = statements
+            self.next_revision += 1
+            entity["lastrevid"] = self.next_revision
+            self.entities[mediainfo_id] = entity
+            return json.loads(json.dumps(entity))
+
+
+class MockServices:
+    def __init__(
+        self,
+        n_files=100,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        fixtures=None,
+        port=0,
+        seed=0,
+    ):
+        self.category = SyntheticCategory(n_files)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.fixtures = json.loads(Path(fixtures).read_text()) if fixtures else {}
+        self.requests = Counter()
+        self.operations = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests.clear()
+            self.operations.clear()
+
+    def _handler_class(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._respond(dict(parse_qsl(urlsplit(self.path).query)))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode("utf-8") if length else ""
+                params = dict(parse_qsl(urlsplit(self.path).query))
+                params.update(parse_qsl(body))
+                self._respond(params)
+
+            def _respond(self, params):
+                host, _, path = urlsplit(self.path).path.lstrip("/").partition("/")
+                status, body, headers = services.handle(host, "/" + path, params)
+                payload = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+    def handle(self, host, path, params):
+        operation = (
+            params.get("op")
+            or params.get("method")
+            or params.get("action")
+            or path.rsplit("/", 1)[-1]
+        )
+        with self._lock:
+            self.requests[host] += 1
+            self.operations[(host, operation)] += 1
+            fail = self.error_rate and self._random.random() < self.error_rate
+            delay = self.latency + (self._random.random() * self.jitter if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if fail:
+            return 503, {"error": "injected failure"}, {"Retry-After": "1"}
+
+        key = fixture_key(host, path, params)
+        if key in self.fixtures:
+            fixture = self.fixtures[key]
+            return fixture.get("status", 200), fixture.get("body", {}), {}
+
+        if path.endswith("/oauth2/access_token"):
+            return 200, {"access_token": "mock", "token_type": "Bearer", "expires_in": 14400}, {}
+        if "biodiversitylibrary.org" in host:
+            return 200, self._bhl(params), {}
+        if host == "api.flickr.com":
+            return 200, self._flickr(params), {}
+        if host == "api.gbif.org":
+            return 200, self._gbif(params), {}
+        if host == "query.wikidata.org":
+            return 200, self._sparql(params), {}
+        return 200, self._mediawiki(params), {}
+
+    def _bhl(self, params):
+        operation = params.get("op")
+        category = self.category
+        if operation == "GetPageMetadata":
+            record = category.page_record(int(params.get("pageid", 0)))
+        elif operation == "GetItemMetadata":
+            record = category.item_record(
+                int(params.get("id", 0)),
+                pages=params.get("pages") == "t",
+                names=params.get("names") == "t",
+            )
+        elif operation == "GetTitleMetadata":
+            record = category.title_record(int(params.get("id", 0)))
+        else:
+            return {"Status": "error", "ErrorMessage": f"Unsupported op {operation}"}
+        return {"Status": "ok", "ErrorMessage": None, "Result": [record] if record else []}
+
+    def _flickr(self, params):
+        i = int(params.get("photo_id") or 0) - 7000000
+        if not 0 <= i < self.category.n_files:
+            return {"stat": "fail", "message": "Photo not found"}
+        tags = [{"raw": tag} for tag in self.category.flickr_tags(i)]
+        return {"stat": "ok", "photo": {"id": params["photo_id"], "tags": {"tag": tags}}}
+
+    def _gbif(self, params):
+        name = params.get("name", "")
+        if not name.startswith("Benchmarkia "):
+            return {"matchType": "NONE", "synonym": False}
+        return {
+            "speciesKey": zlib.crc32(name.encode("utf-8")) % 10000000,
+            "matchType": "EXACT",
+            "synonym": False,
+            "species": name,
+        }
+
+    def _sparql(self, params):
+        query = params.get("query", "")
+        bindings = []
+        if "P4327" in query:
+            values = re.search(r"VALUES \?bhl_id \{([^}]*)\}", query)
+            for title_id in re.findall(r'"(\d+)"', values.group(1) if values else ""):
+                bindings.append(
+                    {
+                        "bhl_id": {"type": "literal", "value": title_id},
+                        "item": {
+                            "type": "uri",
+                            "value": f"http://www.wikidata.org/entity/{self.category.title_qid(int(title_id))}",
+                        },
+                    }
+                )
+        elif "P846" in query:
+            gbif_id = query.split('"')[1] if '"' in query else ""
+            if gbif_id:
+                bindings.append(
+                    {"item": {"type": "uri", "value": f"http://www.wikidata.org/entity/Q{int(gbif_id) + 20000000}"}}
+                )
+        return {"head": {"vars": ["item", "itemLabel"]}, "results": {"bindings": bindings}}
+
+    def _mediawiki(self, params):
+        category = self.category
+        action = params.get("action")
+        if action == "wbgetentities":
+            entities = {}
+            for mediainfo_id in params.get("ids", "").split("|"):
+                entity = category.entity(mediainfo_id)
+                entities[mediainfo_id] = entity or {"id": mediainfo_id, "missing": ""}
+            return {"entities": entities, "success": 1}
+        if action == "wbeditentity":
+            entity = category.edit_entity(
+                params["id"], json.loads(params.get("data") or "{}"), params.get("baserevid")
+            )
+            if entity is None:
+                return {"error": {"code": "editconflict", "info": "Edit conflict."}}
+            return {"entity": entity, "success": 1}
+        if action != "query":
+            return {"error": {"code": "badvalue", "info": f"Unsupported action {action}"}}
+        if params.get("meta") == "tokens":
+            return {"batchcomplete": True, "query": {"tokens": {"csrftoken": "mock+\\"}}}
+        if params.get("list") == "categorymembers":
+            return self._category_members(params.get("cmtitle", ""))
+        titles = [title for title in params.get("titles", "").split("|") if title]
+        prop = params.get("prop", "")
+        pages = []
+        for title in titles:
+            if prop == "categoryinfo":
+                size = category.n_files if title == f"Category:{SYNTHETIC_CATEGORY}" else 0
+                pages.append(
+                    {"title": title, "categoryinfo": {"size": size, "files": size, "subcats": 0}}
+                )
+                continue
+            i = category.file_index(title)
+            if i is None:
+                pages.append({"title": title, "missing": True})
+                continue
+            mediainfo_id = category.mediainfo_id(i)
+            page = {
+                "pageid": int(mediainfo_id[1:]),
+                "ns": 6,
+                "title": title,
+                "lastrevid": category.lastrevid(mediainfo_id),
+            }
+            if prop == "revisions":
+                page["revisions"] = [{"slots": {"main": {"content": self._wikitext(i)}}}]
+            pages.append(page)
+        return {"batchcomplete": True, "query": {"pages": pages}}
+
+    def _category_members(self, title):
+        if title != f"Category:{SYNTHETIC_CATEGORY}":
+            return {"batchcomplete": True, "query": {"categorymembers": []}}
+        members = [
+            {"title": f"File:{self.category.file_name(i)}", "type": "file"}
+            for i in range(self.category.n_files)
+        ]
+        return {"batchcomplete": True, "query": {"categorymembers": members}}
+
+    def _wikitext(self, i):
+        return (
+            "=={{int:filedesc}}==\n"
+            f"{{{{BHL\n| pageid = {self.category.page_id(i)}\n}}}}\n"
+            f"[https://www.flickr.com/photos/biodivlibrary/{self.category.flickr_id(i)} Flickr]\n"
+            f"[[Category:{SYNTHETIC_CATEGORY}]]"
+        )
+
+
+@contextmanager
+def route_to_mock(mock_url, hosts=MOCKED_HOSTS):
+    """Sends requests for `hosts` to the mock server, for `requests` and SPARQLWrapper."""
+    import SPARQLWrapper.Wrapper as sparql_wrapper
+
+    def rewrite(url):
+        parts = urlsplit(url)
+        if parts.hostname not in hosts:
+            return url
+        query = f"?{parts.query}" if parts.query else ""
+        return f"{mock_url}/{parts.hostname}{parts.path}{query}"
+
+    original_request = requests.Session.request
+    original_urlopener = sparql_wrapper.urlopener
+
+    def request(session, method, url, *args, **kwargs):
+        return original_request(session, method, rewrite(url), *args, **kwargs)
+
+    def urlopener(request, *args, **kwargs):
+        request.full_url = rewrite(request.full_url)
+        return original_urlopener(request, *args, **kwargs)
+
+    requests.Session.request = request
+    sparql_wrapper.urlopener = urlopener
+    try:
+        yield
+    finally:
+        requests.Session.request = original_request
+        sparql_wrapper.urlopener = original_urlopener
@@ -0,0 +1,234 @@
+import argparse
+import json
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HERE = Path(__file__).parent
+sys.path.append(str(HERE.parent))
+
+from mock_services import SYNTHETIC_CATEGORY, MockServices, route_to_mock
+
+# End-to-end throughput benchmark, against the local stand-in services.
+#
+# Runs generate_metadata over a synthetic category of N files, then
+# upload_metadata_to_commons over the resulting TSV, and reports for each
+# stage: files/s, requests per file (per host) and the peak RSS of the process.
+# Caches, snapshots and outputs go to a temporary directory, so every run
+# starts cold and nothing touches src/data.
+#
+#   python benchmarks/pipeline_benchmark.py --files 500 --latency 0.05
+#
+# With --planned, the upload runs as two stages instead: plan_upload, then
+# execute_plan. --conflicts N edits N of the files in between, as someone
+# else would, to exercise the conflict handling (--on_conflict).
+#
+# Unless --host_limits is given, the per-host rate limits are lifted, so the
+# numbers measure the pipeline rather than the limits.
+
+UNLIMITED_HOSTS = {
+    host: {"concurrency": 64}
+    for host in (
+        "commons.wikimedia.org",
+        "biodiversitylibrary.org",
+        "api.flickr.com",
+        "api.gbif.org",
+    )
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def stage_report(name, n_files, elapsed, services):
+    from http_metrics import METRICS
+
+    requests_by_host = dict(services.requests)
+    total_requests = sum(requests_by_host.values())
+    return {
+        "stage": name,
+        "files": n_files,
+        "seconds": round(elapsed, 3),
+        "files_per_second": round(n_files / elapsed, 2) if elapsed else None,
+        "requests_per_file": round(total_requests / n_files, 3) if n_files else None,
+        "requests_per_file_by_host": {
+            host: round(count / n_files, 3) for host, count in sorted(requests_by_host.items())
+        }
+        if n_files
+        else {},
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "request_metrics": METRICS.summary(),
+    }
+
+
+def use_temporary_storage(tmp_dir):
+    """Points every cache and snapshot at `tmp_dir`."""
+    import get_metadata
+    import helper
+    import upload
+    from bhl_flickr_index import BhlFlickrIndex
+    from disk_cache import DiskCache
+
+    cache_dir = tmp_dir / "cache"
+    helper.DATA = tmp_dir
+    helper.GBIF_CACHE = DiskCache(cache_dir / "gbif_names.sqlite")
+    get_metadata.BHL_CACHE = DiskCache(cache_dir / "bhl_api.sqlite")
+    upload.MEDIAINFO_SNAPSHOTS = DiskCache(cache_dir / "mediainfo_snapshots.sqlite")
+    get_metadata.BHL_TITLE_QIDS = tmp_dir / "bhl_title_qids.json"
+    get_metadata.BHL_EXPORT_PATH = tmp_dir / "bhl_export.sqlite"
+    get_metadata.FLICKR_TAG_STORE = None
+    get_metadata.FLICKR_TAG_STORE_PATH = cache_dir / "flickr_tags.sqlite"
+    return BhlFlickrIndex
+
+
+def start_stage(services):
+    from http_metrics import METRICS
+
+    services.reset_counts()
+    METRICS.reset()
+    return time.perf_counter()
+
+
+def run_benchmark(
+    n_files=200,
+    latency=0.0,
+    jitter=0.0,
+    error_rate=0.0,
+    fixtures=None,
+    upload_workers=4,
+    async_mode=False,
+    host_limits=False,
+    offline_bhl=False,
+    flickr_tag_store=False,
+    planned=False,
+    conflicts=0,
+    on_conflict="skip",
+):
+    import get_metadata
+    import upload
+    from bhl_export import import_bhl_export
+
+    reports = []
+    with tempfile.TemporaryDirectory() as tmp, MockServices(
+        n_files, latency=latency, jitter=jitter, error_rate=error_rate, fixtures=fixtures
+    ) as services, route_to_mock(services.url):
+        tmp_dir = Path(tmp)
+        BhlFlickrIndex = use_temporary_storage(tmp_dir)
+        get_metadata.BHL_FLICKR_INDEX = BhlFlickrIndex(services.category.page_pairs())
+        if flickr_tag_store:
+            category = services.category
+            get_metadata.get_flickr_tag_store().set_many(
+                [(category.flickr_id(i), category.flickr_tags(i)) for i in range(n_files)],
+                source="harvest",
+            )
+        if offline_bhl:
+            services.category.write_bhl_export(tmp_dir / "bhl_export")
+            import_bhl_export(tmp_dir / "bhl_export", get_metadata.BHL_EXPORT_PATH)
+
+        config = get_metadata.load_config("config.json")
+        config["INCLUDE_SUBCATEGORIES"] = False
+        if not host_limits:
+            config["HOST_LIMITS"] = UNLIMITED_HOSTS
+        output_file = tmp_dir / "benchmark.tsv"
+
+        start = start_stage(services)
+        rows = get_metadata.generate_metadata(
+            SYNTHETIC_CATEGORY,
+            output_file=output_file,
+            config=config,
+            auto_mode=True,
+            async_mode=async_mode,
+            offline_bhl=offline_bhl,
+        )
+        reports.append(
+            stage_report("generate_metadata", len(rows), time.perf_counter() - start, services)
+        )
+
+        if not planned:
+            start = start_stage(services)
+            upload.upload_metadata_to_commons(output_file, max_workers=upload_workers)
+            reports.append(
+                stage_report(
+                    "upload_metadata_to_commons", len(rows), time.perf_counter() - start, services
+                )
+            )
+            return reports
+
+        plan_file = output_file.with_suffix(".plan.jsonl")
+        start = start_stage(services)
+        entries = upload.plan_upload(output_file, plan_file)
+        reports.append(
+            stage_report("plan_upload", len(rows), time.perf_counter() - start, services)
+        )
+        category = services.category
+        for i in range(min(conflicts, n_files)):
+            # Someone else's edit, between planning and replay.
+            category.edit_entity(
+                category.mediainfo_id(i),
+                {"claims": [{"mainsnak": {"snaktype": "somevalue", "property": "P170"}, "type": "statement", "rank": "normal"}]},
+            )
+        start = start_stage(services)
+        upload.execute_plan(
+            plan_file, output_file, max_workers=upload_workers, on_conflict=on_conflict
+        )
+        reports.append(
+            stage_report("execute_plan", len(entries), time.perf_counter() - start, services)
+        )
+    return reports
+
+
+def print_reports(reports):
+    print()
+    print(f"{'Stage':<28}{'Files':>7}{'Seconds':>10}{'Files/s':>10}{'Req/file':>10}{'Peak RSS MB':>13}")
+    for report in reports:
+        print(
+            f"{report['stage']:<28}{report['files']:>7}{report['seconds']:>10}"
+            f"{report['files_per_second'] or 0:>10}{report['requests_per_file'] or 0:>10}"
+            f"{report['peak_rss_mb']:>13}"
+        )
+        for host, per_file in report["requests_per_file_by_host"].items():
+            print(f"    {host:<36}{per_file:>10} req/file")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark generate_metadata and upload against local mock services."
+    )
+    parser.add_argument("--files", type=int, default=200, help="Files in the synthetic category.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra latency, up to this many seconds.")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 503.")
+    parser.add_argument("--fixtures", type=str, help="JSON file of recorded responses (see mock_services.fixture_key).")
+    parser.add_argument("--upload_workers", type=int, default=4)
+    parser.add_argument("--async_mode", action="store_true", help="Use the concurrent harvest.")
+    parser.add_argument("--host_limits", action="store_true", help="Keep the configured per-host rate limits.")
+    parser.add_argument("--offline_bhl", action="store_true", help="Harvest from a BHL export index of the category.")
+    parser.add_argument("--flickr_tag_store", action="store_true", help="Start with every photo in the Flickr tag store.")
+    parser.add_argument("--planned", action="store_true", help="Upload through a plan file (plan, then replay).")
+    parser.add_argument("--conflicts", type=int, default=0, help="Files edited between planning and replay.")
+    parser.add_argument("--on_conflict", choices=["skip", "replan"], default="skip")
+    parser.add_argument("--json", type=str, help="Also write the reports to this JSON file.")
+    args = parser.parse_args()
+
+    reports = run_benchmark(
+        n_files=args.files,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        fixtures=args.fixtures,
+        upload_workers=args.upload_workers,
+        async_mode=args.async_mode,
+        host_limits=args.host_limits,
+        offline_bhl=args.offline_bhl,
+        flickr_tag_store=args.flickr_tag_store,
+        planned=args.planned,
+        conflicts=args.conflicts,
+        on_conflict=args.on_conflict,
+    )
+    print_reports(reports)
+    if args.json:
+        Path(args.json).write_text(json.dumps(reports, indent=2))
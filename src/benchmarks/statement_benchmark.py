@@ -0,0 +1,197 @@
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+
+HERE = Path(__file__).parent
+sys.path.append(str(HERE.parent))
+
+from wikibaseintegrator import WikibaseIntegrator
+
+import helper
+from claim_index import ClaimIndex
+from helper import INSTITUTIONS_DICT, build_statements
+from statement_compiler import compile_statements
+
+# Micro-benchmark for statement_compiler.compile_statements.
+#
+# Turns the same rows into claims JSON through the helper.py builders
+# (WikibaseIntegrator objects, then get_json()) and through the compiler,
+# checks that both give byte-identical JSON for every row, the statements
+# they remove from the entity included, and reports rows/s for each.
+#
+# GBIF names are answered from memory with made-up QIDs and nothing is
+# looked up online (helper.OFFLINE), so only statement building is timed.
+# Rows come from a metadata TSV (as written by get_metadata.py) or, without
+# one, are synthetic rows covering each builder; a share of them is compiled
+# against an entity that already has the minimal statements and some depicts,
+# or copyright and license statements to remove.
+#
+#   python benchmarks/statement_benchmark.py --tsv data/<category>.tsv
+
+SPECIES = [f"Genus{i} species{i}" for i in range(40)]
+
+
+def fake_gbif_qid(name):
+    return f"Q{9000000 + sum(name.encode('utf-8'))}"
+
+
+def item_claim(prop, qid):
+    return {
+        "mainsnak": {
+            "snaktype": "value",
+            "property": prop,
+            "datavalue": {
+                "value": {"entity-type": "item", "numeric-id": int(qid[1:]), "id": qid},
+                "type": "wikibase-entityid",
+            },
+        },
+        "type": "statement",
+        "rank": "normal",
+    }
+
+
+def entity_json(i, claims):
+    for n, claim in enumerate(claim for values in claims.values() for claim in values):
+        claim["id"] = f"M{i}$BENCH-{n}"
+    return {
+        "type": "mediainfo",
+        "id": f"M{i}",
+        "lastrevid": 1,
+        "labels": {},
+        "descriptions": {},
+        "statements": claims,
+    }
+
+
+def synthetic_rows(n_rows=2000, seed=0):
+    """(row, file name, entity JSON) triples shaped like BHL uploads."""
+    rng = random.Random(seed)
+    institutions = list(INSTITUTIONS_DICT)
+    cases = []
+    for i in range(n_rows):
+        page_id = str(1000000 + i)
+        flickr_id = str(7000000 + i) if i % 3 else ""
+        tags = [f"taxonomy:binomial={name}" for name in rng.sample(SPECIES, rng.randint(0, 3))]
+        if i % 7 == 0:
+            tags.append("illustrator:wikidata=Q5")
+        row = {
+            "File": f"Benchmark plate {i} BHL{page_id}.jpg",
+            "BHL Page ID": page_id,
+            "Flickr ID": flickr_id,
+            "Names": "; ".join(rng.sample(SPECIES, rng.randint(0, 4))),
+            "Is Extracted": "True" if i % 11 == 0 else "",
+            "Flickr Tags": ",".join(tags),
+            "Copyright Status": "NOT_IN_COPYRIGHT",
+            "Bibliography ID": str(500 + i % 20),
+            "Item ID": str(3000 + i % 60),
+            "Item Publication Date": rng.choice(["1820", "1842", "1875", "19xx", ""]),
+            "Page Types": rng.choice(["Illustration", "Illustration", "Map", "Text", "Text Illustration"]),
+            "Published In QID": f"Q{100 + i % 20}" if i % 5 else "",
+            "Volume": rng.choice(["v.1", "v.2", ""]),
+            "Page Number Prefix": rng.choice(["Pl.", "Tab.", "p.", ""]),
+            "Page Number Number": str(i % 90),
+            "Collection": rng.choice(institutions),
+            "Sponsor": rng.choice(["", rng.choice(institutions)]),
+        }
+        claims = {}
+        if i % 4 == 0:
+            for prop in ["P31", "P1433", "P687", "P195", "P859"]:
+                claims[prop] = [item_claim(prop, "Q1")]
+            claims["P180"] = [item_claim("P180", fake_gbif_qid(name)) for name in SPECIES[:20]]
+            claims["P6216"] = [item_claim("P6216", "Q50423863")]
+        if i % 6 == 0:
+            # A public domain statement next to a copyrighted one, and licenses.
+            claims["P6216"] = [item_claim("P6216", "Q19652"), item_claim("P6216", "Q50423863")]
+            claims["P275"] = [item_claim("P275", "Q18199165"), item_claim("P275", "Q6938433")]
+        cases.append((row, row["File"], entity_json(i, claims)))
+    return cases
+
+
+def tsv_rows(path):
+    metadata_df = pd.read_csv(path, sep="\t", dtype=str).fillna("")
+    return [
+        (row, row["File"].strip(), entity_json(i, {}))
+        for i, row in enumerate(metadata_df.to_dict("records"))
+    ]
+
+
+def builder_json(row, file_name, media, claim_index):
+    groups, had_minimum_data = build_statements(row, file_name, media, claim_index)
+    removals = [
+        {"id": claim.id, "remove": ""}
+        for prop in ("P6216", "P275")
+        for claim in media.claims.get(prop)
+        if claim.removed
+    ]
+    return [
+        (action.name, [claim.get_json() for claim in statements])
+        for action, statements in groups
+    ], had_minimum_data, removals
+
+
+def compiler_json(row, file_name, media, claim_index):
+    groups, had_minimum_data, removals = compile_statements(row, file_name, claim_index)
+    return [(action.name, statements) for action, statements in groups], had_minimum_data, removals
+
+
+def time_path(build, cases, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for case in cases:
+            build(*case)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_benchmark(cases, repeats=5):
+    wbi = WikibaseIntegrator()
+    prepared = [
+        (row, file_name, wbi.mediainfo.new().from_json(entity), ClaimIndex(entity["statements"]))
+        for row, file_name, entity in cases
+    ]
+    mismatches = sum(
+        1
+        for case in prepared
+        if json.dumps(builder_json(*case)) != json.dumps(compiler_json(*case))
+    )
+    reports = []
+    for name, build in (("helper builders", builder_json), ("statement compiler", compiler_json)):
+        seconds = time_path(build, prepared, repeats)
+        reports.append(
+            {
+                "path": name,
+                "rows": len(prepared),
+                "seconds": round(seconds, 4),
+                "rows_per_second": round(len(prepared) / seconds),
+            }
+        )
+    return mismatches, reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the statement compiler against the helper builders.")
+    parser.add_argument("--tsv", type=str, help="Metadata TSV to compile; synthetic rows if not given.")
+    parser.add_argument("--rows", type=int, default=2000, help="Synthetic rows.")
+    parser.add_argument("--repeats", type=int, default=5, help="Timing runs; the best is reported.")
+    args = parser.parse_args()
+
+    helper.OFFLINE = True
+    helper.get_wikidata_qid_from_gbif = fake_gbif_qid
+    if args.tsv:
+        cases = tsv_rows(args.tsv)
+        print(f"Rows: {args.tsv} ({len(cases)} rows)")
+    else:
+        cases = synthetic_rows(args.rows)
+        print(f"Using {len(cases)} synthetic rows.")
+
+    mismatches, reports = run_benchmark(cases, args.repeats)
+    print(f"Rows where the two paths disagree: {mismatches}")
+    print(f"{'Path':<22}{'Rows':>8}{'Seconds':>10}{'Rows/s':>10}")
+    for report in reports:
+        print(f"{report['path']:<22}{report['rows']:>8}{report['seconds']:>10}{report['rows_per_second']:>10}")
@@ -0,0 +1,203 @@
+import argparse
+import json
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+HERE = Path(__file__).parent
+sys.path.append(str(HERE.parent))
+
+from wikitext_ids import scan_wikitext
+
+# Micro-benchmark for wikitext_ids.scan_wikitext.
+#
+# Runs the per-token searches of scan_wikitext and a single-pass alternative
+# (one alternation regex of every token, run once over the page) over a
+# corpus of file pages and reports pages/s and MB/s for each. It checks first
+# that both give the same record for every page.
+#
+# A corpus is a JSON-lines file of {"file": ..., "wikitext": ...}. By default
+# the benchmark runs on corpus/wikitext_fixture.jsonl, 300 file pages written
+# after the markup of BHL uploads on Commons (Information blocks with BHL
+# metadata, {{BHL}} templates with irregular spacing, Flickr, Internet Archive
+# and BHL links, http links, commented-out IDs, non-ASCII text). They are not
+# recorded pages. To record a corpus from a real Commons category (needs
+# network access once), which is then used instead:
+#
+#   python benchmarks/wikitext_benchmark.py --build_from_category "Name" --limit 2000
+#
+# --synthetic runs on generated pages, one extraction path per page.
+
+FIXTURE_CORPUS = HERE / "corpus" / "wikitext_fixture.jsonl"
+RECORDED_CORPUS = HERE / "corpus" / "wikitext_corpus.jsonl"
+
+
+WIKITEXT_TOKENS = re.compile(
+    "|".join(
+        [
+            r"\{\{(?:(?P<bhl_template>(?=BHL))|(?P<extracted>Extracted from))",
+            r"\|\s*pageid\s*=\s*(?P<pageid>\d+)",
+            r"B(?P<consortium>HL Consortium)",
+            r"h(?:(?=ttps://archive\.org/stream/(?P<ia_item>[^#]+)#page/n(?P<ia_page>\d+))"
+            r"|(?P<flickr>ttps://www\.flickr\.com/photos/biodivlibrary/)(?P<flickr_id>\d+)?)",
+            r"biodiversitylibrary\.org/page(?:image/(?P<bhl_pageimage>\d+)|/(?P<bhl_page>\d+))",
+        ]
+    )
+)
+
+
+def alternation_scan(wikitext):
+    """scan_wikitext as one pass of a single alternation regex, kept for comparison."""
+    ids = {
+        "bhl_template": False,
+        "pageid": "",
+        "consortium": False,
+        "ia_url": "",
+        "ia_item": "",
+        "ia_page": "",
+        "flickr": False,
+        "flickr_id": "",
+        "bhl_page_urls": [],
+        "bhl_pageimage_urls": [],
+        "extracted": False,
+    }
+    if not wikitext:
+        return ids
+    # Each alternative ends with its own group, so lastgroup tells them apart.
+    for m in WIKITEXT_TOKENS.finditer(wikitext):
+        kind = m.lastgroup
+        if kind == "bhl_page":
+            ids["bhl_page_urls"].append(m.group(kind))
+        elif kind == "bhl_pageimage":
+            ids["bhl_pageimage_urls"].append(m.group(kind))
+        elif kind == "pageid":
+            if not ids["pageid"]:
+                ids["pageid"] = m.group(kind)
+        elif kind == "flickr_id":
+            ids["flickr"] = True
+            if not ids["flickr_id"]:
+                ids["flickr_id"] = m.group(kind)
+        elif kind == "ia_page":
+            if not ids["ia_url"]:
+                ids["ia_url"] = wikitext[m.start() : m.end(kind)]
+                ids["ia_item"] = m.group("ia_item")
+                ids["ia_page"] = m.group(kind)
+        elif kind == "flickr" or kind in ids:
+            # bhl_template, extracted, consortium and a Flickr URL without ID.
+            ids[kind] = True
+    return ids
+
+
+def build_corpus(category, path, limit=None):
+    from helper import get_category_wikitexts
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    count = 0
+    with path.open("w", encoding="utf-8") as f:
+        for file_name, wikitext in get_category_wikitexts(category):
+            f.write(json.dumps({"file": file_name, "wikitext": wikitext}) + "\n")
+            count += 1
+            if limit and count >= limit:
+                break
+    print(f"Stored {count} file pages in {path}")
+
+
+def load_corpus(path):
+    with Path(path).open(encoding="utf-8") as f:
+        return [json.loads(line)["wikitext"] for line in f if line.strip()]
+
+
+def synthetic_corpus(n_pages=2000, seed=0):
+    """File pages shaped like BHL uploads, one extraction path per page."""
+    rng = random.Random(seed)
+    filler = (
+        "Illustration from a nineteenth-century natural history work, scanned by "
+        "the Biodiversity Heritage Library and uploaded with its description. "
+    )
+    categories = "".join(f"[[Category:Botanical illustrations {i}]]\n" for i in range(8))
+    pages = []
+    for i in range(n_pages):
+        page_id = 1000000 + i
+        kind = i % 4
+        if kind == 0:
+            source = f"{{{{BHL\n| pageid = {page_id}\n| titleid = 900\n}}}}"
+        elif kind == 1:
+            source = (
+                "BHL Consortium\n"
+                f"https://archive.org/stream/benchmarkitem{i}/benchmarkitem{i}#page/n{i % 300}/mode/1up"
+            )
+        elif kind == 2:
+            source = f"https://www.flickr.com/photos/biodivlibrary/{7000000 + i}"
+        else:
+            source = (
+                f"https://www.biodiversitylibrary.org/page/{page_id} "
+                f"https://www.biodiversitylibrary.org/pageimage/{page_id}"
+            )
+        extracted = "{{Extracted from|File:Benchmark.jpg}}\n" if rng.random() < 0.3 else ""
+        pages.append(
+            "=={{int:filedesc}}==\n{{Information\n|description="
+            + filler * rng.randint(2, 12)
+            + f"\n|source={source}\n}}}}\n{extracted}"
+            + "=={{int:license-header}}==\n{{PD-old-100-expired}}\n"
+            + categories
+        )
+    return pages
+
+
+def time_scan(scan, pages, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for wikitext in pages:
+            scan(wikitext)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_benchmark(pages, repeats=5):
+    mismatches = sum(1 for wikitext in pages if scan_wikitext(wikitext) != alternation_scan(wikitext))
+    megabytes = sum(len(wikitext.encode("utf-8")) for wikitext in pages) / 1e6
+    reports = []
+    for name, scan in (("scan_wikitext", scan_wikitext), ("single alternation", alternation_scan)):
+        seconds = time_scan(scan, pages, repeats)
+        reports.append(
+            {
+                "extractor": name,
+                "pages": len(pages),
+                "seconds": round(seconds, 4),
+                "pages_per_second": round(len(pages) / seconds),
+                "mb_per_second": round(megabytes / seconds, 1),
+            }
+        )
+    return mismatches, reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the wikitext identifier extractor.")
+    parser.add_argument("--corpus", type=str, help="JSON-lines corpus of file pages.")
+    parser.add_argument("--build_from_category", type=str, help="Record the file pages of this Commons category as the corpus.")
+    parser.add_argument("--limit", type=int, help="Store at most this many pages.")
+    parser.add_argument("--synthetic", action="store_true", help="Use generated pages instead of a corpus.")
+    parser.add_argument("--repeats", type=int, default=5, help="Timing runs; the best is reported.")
+    args = parser.parse_args()
+
+    if args.build_from_category:
+        build_corpus(args.build_from_category, Path(args.corpus or RECORDED_CORPUS), args.limit)
+    if args.synthetic:
+        pages = synthetic_corpus()
+        print(f"Using {len(pages)} synthetic pages.")
+    else:
+        corpus_path = Path(args.corpus or (RECORDED_CORPUS if RECORDED_CORPUS.exists() else FIXTURE_CORPUS))
+        pages = load_corpus(corpus_path)
+        print(f"Corpus: {corpus_path} ({len(pages)} pages)")
+
+    mismatches, reports = run_benchmark(pages, args.repeats)
+    print(f"Pages where the two extractors disagree: {mismatches}")
+    print(f"{'Extractor':<22}{'Pages':>8}{'Seconds':>10}{'Pages/s':>10}{'MB/s':>8}")
+    for report in reports:
+        print(
+            f"{report['extractor']:<22}{report['pages']:>8}{report['seconds']:>10}"
+            f"{report['pages_per_second']:>10}{report['mb_per_second']:>8}"
+        )
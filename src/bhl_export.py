@@ -0,0 +1,298 @@
+import argparse
+import csv
+import io
+import sqlite3
+import sys
+import threading
+import zipfile
+from pathlib import Path
+
+HERE = Path(__file__).parent
+DATA = HERE / "data"
+DEFAULT_INDEX_PATH = DATA / "bhl_export.sqlite"
+
+INSERT_BATCH_SIZE = 10000
+
+# Local index of the BHL data export, for harvesting without the BHL API.
+#
+# BHL publishes its title, item, page and name tables as tab-separated files
+# (https://www.biodiversitylibrary.org/data/, data.zip). import_bhl_export
+# streams them, from the directory or straight from the zip, into a SQLite
+# file with the indexes the pipeline needs: page -> item -> title, item ->
+# pages in order, and the IA identifier (BarCode) -> item.
+#
+# BhlExportIndex answers in the shape of the api3 results (GetPageMetadata,
+# GetItemMetadata, GetTitleMetadata), so get_metadata.py can use either.
+# Only the columns the pipeline reads are kept. Columns missing from an
+# export (older exports have no Sponsor or CopyrightStatus) are left empty.
+#
+#   python bhl_export.py path/to/data.zip
+
+# table: (export file, {column: [header names in the export, first found wins]})
+TABLES = {
+    "title": (
+        "title.txt",
+        {"TitleID": ["TitleID"], "FullTitle": ["FullTitle"]},
+    ),
+    "title_identifier": (
+        "titleidentifier.txt",
+        {
+            "TitleID": ["TitleID"],
+            "IdentifierName": ["IdentifierName"],
+            "IdentifierValue": ["IdentifierValue"],
+        },
+    ),
+    "item": (
+        "item.txt",
+        {
+            "ItemID": ["ItemID"],
+            "TitleID": ["TitleID"],
+            "BarCode": ["BarCode"],
+            "Volume": ["VolumeInfo", "Volume"],
+            "Year": ["Year"],
+            "HoldingInstitution": ["HoldingInstitution", "InstitutionName"],
+            "Sponsor": ["Sponsor"],
+            "CopyrightStatus": ["CopyrightStatus"],
+        },
+    ),
+    "page": (
+        "page.txt",
+        {
+            "PageID": ["PageID"],
+            "ItemID": ["ItemID"],
+            "SequenceOrder": ["SequenceOrder"],
+            "Year": ["Year"],
+            "Volume": ["Volume"],
+            "Issue": ["Issue"],
+            "PagePrefix": ["PagePrefix"],
+            "PageNumber": ["PageNumber"],
+            "PageTypeName": ["PageTypeName"],
+        },
+    ),
+    "page_name": (
+        "pagename.txt",
+        {"PageID": ["PageID"], "Name": ["NameConfirmed", "NameFound"]},
+    ),
+}
+
+INTEGER_COLUMNS = {"TitleID", "ItemID", "PageID", "SequenceOrder"}
+
+INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS title_id ON title (TitleID)",
+    "CREATE INDEX IF NOT EXISTS title_identifier_title ON title_identifier (TitleID)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS item_id ON item (ItemID)",
+    "CREATE INDEX IF NOT EXISTS item_barcode ON item (BarCode)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS page_id ON page (PageID)",
+    "CREATE INDEX IF NOT EXISTS page_item ON page (ItemID, SequenceOrder)",
+    "CREATE INDEX IF NOT EXISTS page_name_page ON page_name (PageID)",
+]
+
+
+def _open_export_files(export_path):
+    """Yields (file name, text stream) for the export files in a directory or zip."""
+    export_path = Path(export_path)
+    wanted = {file_name for file_name, _ in TABLES.values()}
+    if export_path.is_dir():
+        for file_name in sorted(wanted):
+            path = export_path / file_name
+            if path.exists():
+                with path.open(encoding="utf-8-sig", newline="") as f:
+                    yield file_name, f
+        return
+    with zipfile.ZipFile(export_path) as archive:
+        for member in archive.namelist():
+            file_name = Path(member).name
+            if file_name in wanted:
+                with archive.open(member) as raw:
+                    yield file_name, io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+
+
+def _to_integer(value):
+    value = (value or "").strip()
+    return int(value) if value.isdigit() else None
+
+
+def _read_rows(stream, columns):
+    reader = csv.reader(stream, delimiter="\t", quoting=csv.QUOTE_NONE)
+    header = next(reader, [])
+    positions = []
+    for column, aliases in columns.items():
+        found = next((header.index(alias) for alias in aliases if alias in header), None)
+        positions.append((column, found))
+    for fields in reader:
+        row = []
+        for column, position in positions:
+            value = fields[position] if position is not None and position < len(fields) else ""
+            row.append(_to_integer(value) if column in INTEGER_COLUMNS else value.strip())
+        yield row
+
+
+def import_bhl_export(export_path, index_path=DEFAULT_INDEX_PATH):
+    """
+    Builds the SQLite index from a BHL data export (directory or data.zip).
+    The index is written next to `index_path` and moved into place at the
+    end, so a failed import leaves the previous index untouched.
+    """
+    csv.field_size_limit(sys.maxsize)
+    index_path = Path(index_path)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = index_path.with_suffix(index_path.suffix + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+
+    conn = sqlite3.connect(tmp_path)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    for table, (_, columns) in TABLES.items():
+        conn.execute(f"CREATE TABLE {table} ({', '.join(columns)})")
+
+    tables_by_file = {file_name: table for table, (file_name, _) in TABLES.items()}
+    counts = {}
+    for file_name, stream in _open_export_files(export_path):
+        table = tables_by_file[file_name]
+        columns = TABLES[table][1]
+        insert = f"INSERT INTO {table} VALUES ({', '.join('?' * len(columns))})"
+        batch = []
+        counts[table] = 0
+        for row in _read_rows(stream, columns):
+            batch.append(row)
+            if len(batch) >= INSERT_BATCH_SIZE:
+                conn.executemany(insert, batch)
+                counts[table] += len(batch)
+                batch = []
+        conn.executemany(insert, batch)
+        counts[table] += len(batch)
+        conn.commit()
+        print(f"Imported {counts[table]} rows from {file_name}")
+
+    missing = [file_name for file_name in tables_by_file if tables_by_file[file_name] not in counts]
+    if missing:
+        print(f"Not in the export: {', '.join(sorted(missing))}")
+    for statement in INDEXES:
+        conn.execute(statement)
+    conn.commit()
+    conn.close()
+    tmp_path.replace(index_path)
+    return counts
+
+
+class BhlExportIndex:
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = Path(path)
+        if not self.path.exists():
+            raise FileNotFoundError(
+                f"No BHL export index at {self.path}; build it with bhl_export.py"
+            )
+        self._local = threading.local()
+
+    def _connection(self):
+        # One read-only connection per thread, as in DiskCache.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def _page_records(self, pages):
+        conn = self._connection()
+        records = []
+        for page in pages:
+            names = conn.execute(
+                "SELECT Name FROM page_name WHERE PageID = ?", (page["PageID"],)
+            ).fetchall()
+            page_types = [
+                page_type.strip()
+                for page_type in (page["PageTypeName"] or "").split(",")
+                if page_type.strip()
+            ]
+            page_numbers = (
+                [{"Prefix": page["PagePrefix"], "Number": page["PageNumber"]}]
+                if page["PagePrefix"] or page["PageNumber"]
+                else []
+            )
+            records.append(
+                {
+                    "PageID": page["PageID"],
+                    "ItemID": page["ItemID"],
+                    "Year": page["Year"],
+                    "Volume": page["Volume"],
+                    "Issue": page["Issue"],
+                    "PageTypes": [{"PageTypeName": name} for name in page_types],
+                    "PageNumbers": page_numbers,
+                    "Names": [{"NameCanonical": name["Name"]} for name in names if name["Name"]],
+                }
+            )
+        return records
+
+    def page_metadata(self, page_id):
+        """GetPageMetadata-shaped result: [page], or [] if the page isn't in the export."""
+        page_id = _to_integer(str(page_id))
+        page = self._connection().execute(
+            "SELECT * FROM page WHERE PageID = ?", (page_id,)
+        ).fetchone()
+        return self._page_records([page]) if page else []
+
+    def _item_record(self, item, pages=False):
+        record = {
+            "ItemID": item["ItemID"],
+            "TitleID": item["TitleID"],
+            "BarCode": item["BarCode"],
+            "Volume": item["Volume"],
+            "Year": item["Year"],
+            "HoldingInstitution": item["HoldingInstitution"],
+            "Sponsor": item["Sponsor"],
+            "CopyrightStatus": item["CopyrightStatus"],
+        }
+        if pages:
+            rows = self._connection().execute(
+                "SELECT * FROM page WHERE ItemID = ? ORDER BY SequenceOrder",
+                (item["ItemID"],),
+            ).fetchall()
+            record["Pages"] = self._page_records(rows)
+        return record
+
+    def item_metadata(self, item_id, pages=False):
+        """GetItemMetadata-shaped result for a BHL item ID."""
+        item = self._connection().execute(
+            "SELECT * FROM item WHERE ItemID = ?", (_to_integer(str(item_id)),)
+        ).fetchone()
+        return [self._item_record(item, pages)] if item else []
+
+    def item_metadata_by_ia(self, ia_identifier, pages=True):
+        """GetItemMetadata-shaped result for an Internet Archive identifier."""
+        item = self._connection().execute(
+            "SELECT * FROM item WHERE BarCode = ?", (ia_identifier,)
+        ).fetchone()
+        return [self._item_record(item, pages)] if item else []
+
+    def title_metadata(self, title_id):
+        """GetTitleMetadata-shaped result, with the title's identifiers."""
+        conn = self._connection()
+        title_id = _to_integer(str(title_id))
+        title = conn.execute("SELECT * FROM title WHERE TitleID = ?", (title_id,)).fetchone()
+        if not title:
+            return []
+        identifiers = conn.execute(
+            "SELECT IdentifierName, IdentifierValue FROM title_identifier WHERE TitleID = ?",
+            (title_id,),
+        ).fetchall()
+        return [
+            {
+                "TitleID": title["TitleID"],
+                "FullTitle": title["FullTitle"],
+                "Identifiers": [dict(identifier) for identifier in identifiers],
+            }
+        ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Index a BHL data export (directory or data.zip) for --offline_bhl."
+    )
+    parser.add_argument("export", type=str, help="Export directory or data.zip.")
+    parser.add_argument(
+        "--index", type=str, default=str(DEFAULT_INDEX_PATH), help="SQLite file to write."
+    )
+    args = parser.parse_args()
+    import_bhl_export(args.export, args.index)
+    print(f"BHL export index written to: {args.index}")
@@ -0,0 +1,135 @@
+import json
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+
+# Two-way lookup between BHL page IDs and Flickr photo IDs.
+#
+# Built once from the BHL Flickr harvest (see bhl_to_flickr_map/), it answers
+# page -> photo and photo -> page in O(1), instead of scanning the values of
+# the page -> photo dictionary for every file.
+#
+# The harvest also writes a compact binary form (bhl_flickr_index.bin) that
+# MappedBhlFlickrIndex memory-maps and binary-searches, so loading it costs
+# next to nothing. Layout, all integers unsigned 64-bit in native byte order:
+#
+#   magic (8 bytes) | n_pages | n_photos
+#   pages sorted (n_pages)  | photo for each of those pages (n_pages)
+#   photos sorted (n_photos) | page for each of those photos (n_photos)
+
+BINARY_MAGIC = b"BHLFLKR1"
+HEADER = struct.Struct("=8sQQ")
+
+
+class BhlFlickrIndex:
+    def __init__(self, pairs=()):
+        self.page_to_photo = {}
+        self.photo_to_page = {}
+        for page_id, photo_id in pairs:
+            self.add(page_id, photo_id)
+
+    def add(self, page_id, photo_id):
+        page_id, photo_id = str(page_id), str(photo_id)
+        if not page_id or not photo_id:
+            return
+        self.page_to_photo[page_id] = photo_id
+        # Keep the first page seen for a photo, as the old linear scan did.
+        self.photo_to_page.setdefault(photo_id, page_id)
+
+    @classmethod
+    def from_json(cls, path):
+        """Loads a {page_id: photo_id} JSON file, e.g. dicts/bhl_flickr_dict.json."""
+        return cls(json.loads(Path(path).read_text()).items())
+
+    def photo_for_page(self, page_id):
+        return self.page_to_photo.get(str(page_id), "")
+
+    def page_for_photo(self, photo_id):
+        return self.photo_to_page.get(str(photo_id), "")
+
+    def __len__(self):
+        return len(self.page_to_photo)
+
+
+def write_binary_index(path, pairs_by_page, n_pages, pairs_by_photo, n_photos):
+    """
+    Writes bhl_flickr_index.bin from sorted (key, value) integer pairs.
+
+    `pairs_by_page` and `pairs_by_photo` are callables returning a fresh
+    iterator over the pairs, as each one is read twice (keys, then values).
+    Only a small buffer is held in memory, so the pairs may be streamed from disk.
+    """
+
+    def write_column(f, pairs, column):
+        buffer = array("Q")
+        for pair in pairs:
+            buffer.append(pair[column])
+            if len(buffer) >= 65536:
+                buffer.tofile(f)
+                buffer = array("Q")
+        buffer.tofile(f)
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(BINARY_MAGIC, n_pages, n_photos))
+        for pairs in (pairs_by_page, pairs_by_photo):
+            write_column(f, pairs(), 0)
+            write_column(f, pairs(), 1)
+
+
+class MappedBhlFlickrIndex:
+    """Read-only BhlFlickrIndex backed by a memory-mapped bhl_flickr_index.bin."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n_pages, n_photos = HEADER.unpack_from(self._mmap)
+        if magic != BINARY_MAGIC:
+            raise ValueError(f"{path} is not a BHL/Flickr binary index.")
+        words = memoryview(self._mmap)[HEADER.size :].cast("Q")
+        self._pages = words[:n_pages]
+        self._photos_by_page = words[n_pages : 2 * n_pages]
+        offset = 2 * n_pages
+        self._photos = words[offset : offset + n_photos]
+        self._pages_by_photo = words[offset + n_photos : offset + 2 * n_photos]
+
+    @staticmethod
+    def _lookup(keys, values, key):
+        key = str(key)
+        if not key.isdigit():
+            return ""
+        key = int(key)
+        position = bisect_left(keys, key)
+        if position < len(keys) and keys[position] == key:
+            return str(values[position])
+        return ""
+
+    def photo_for_page(self, page_id):
+        return self._lookup(self._pages, self._photos_by_page, page_id)
+
+    def page_for_photo(self, photo_id):
+        return self._lookup(self._photos, self._pages_by_photo, photo_id)
+
+    def __len__(self):
+        return len(self._pages)
+
+
+def load_bhl_flickr_index(dicts_dir):
+    """
+    Loads the BHL/Flickr index from `dicts_dir`, preferring the binary form
+    when it is present and at least as recent as the JSON dictionary.
+    """
+    binary_path = Path(dicts_dir) / "bhl_flickr_index.bin"
+    json_path = Path(dicts_dir) / "bhl_flickr_dict.json"
+    if binary_path.exists() and (
+        not json_path.exists()
+        or binary_path.stat().st_mtime >= json_path.stat().st_mtime
+    ):
+        return MappedBhlFlickrIndex(binary_path)
+    if json_path.exists():
+        return BhlFlickrIndex.from_json(json_path)
+    raise FileNotFoundError(
+        f"No BHL/Flickr mapping in {dicts_dir}. "
+        "Run bhl_to_flickr_map/process_flickr_harvest.py to build it."
+    )
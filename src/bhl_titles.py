@@ -0,0 +1,95 @@
+import json
+from pathlib import Path
+
+from wdcuration import query_wikidata
+
+from http_metrics import METRICS
+
+SPARQL_BATCH_SIZE = 200
+
+# BHL title ID -> Wikidata QID resolution, done once per run for all titles.
+#
+# A title resolves, in order, from the persisted mapping (dicts/bhl_title_qids.json),
+# from the single Wikidata identifier in its BHL metadata, or from a
+# Wikidata item with that BHL title ID (P4327). The remaining titles are
+# looked up in one SPARQL query per SPARQL_BATCH_SIZE titles, with a VALUES
+# clause. Titles with no match or several matches are returned together,
+# so they can be reported before any file is processed.
+
+
+def load_title_qids(path):
+    path = Path(path)
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def save_title_qids(title_qids, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(dict(sorted(title_qids.items())), indent=2))
+
+
+def bhl_wikidata_identifiers(biblio_data):
+    """Wikidata QIDs listed in a title's BHL metadata (GetTitleMetadata result)."""
+    if not biblio_data:
+        return []
+    return [
+        identifier.get("IdentifierValue")
+        for identifier in biblio_data[0].get("Identifiers", [])
+        if identifier.get("IdentifierName") == "Wikidata"
+    ]
+
+
+def query_title_qids(title_ids, batch_size=SPARQL_BATCH_SIZE):
+    """Returns {title_id: [QIDs of items with that BHL title ID (P4327)]}."""
+    title_ids = [str(title_id) for title_id in title_ids]
+    found = {title_id: [] for title_id in title_ids}
+    for start in range(0, len(title_ids), batch_size):
+        batch = title_ids[start : start + batch_size]
+        values = " ".join(json.dumps(title_id) for title_id in batch)
+        query = f"""
+        SELECT ?bhl_id ?item
+        WHERE
+        {{
+          VALUES ?bhl_id {{ {values} }}
+          ?item wdt:P4327 ?bhl_id .
+        }} """
+        with METRICS.timed("query.wikidata.org", "sparql:P4327"):
+            results = query_wikidata(query)
+        for result in results:
+            qid = result["item"].split("/")[-1]
+            if qid not in found[result["bhl_id"]]:
+                found[result["bhl_id"]].append(qid)
+    return found
+
+
+def resolve_title_qids(titles, known=None):
+    """
+    Resolves {title_id: biblio_data} to QIDs.
+
+    Returns (resolved, unresolved): resolved is {title_id: QID}; unresolved
+    is {title_id: [candidate QIDs]} for titles with no match or several.
+    """
+    known = known or {}
+    resolved = {}
+    to_query = []
+    for title_id, biblio_data in titles.items():
+        title_id = str(title_id)
+        if known.get(title_id):
+            resolved[title_id] = known[title_id]
+            continue
+        qids = bhl_wikidata_identifiers(biblio_data)
+        if len(qids) == 1:
+            resolved[title_id] = qids[0]
+        else:
+            to_query.append(title_id)
+
+    unresolved = {}
+    if to_query:
+        for title_id, qids in query_title_qids(to_query).items():
+            if len(qids) == 1:
+                resolved[title_id] = qids[0]
+            else:
+                unresolved[title_id] = qids
+    return resolved, unresolved
@@ -1,20 +1,37 @@
+import argparse
 import requests
 import zipfile
 import json
 import csv
+import io
+import re
+import sqlite3
+import sys
 from pathlib import Path
 HERE = Path(__file__).parent
+sys.path.append(str(HERE.parent))
+
+from bhl_flickr_index import write_binary_index
+from flickr_tag_store import FlickrTagStore, fetch_flickr_tags, tags_from_harvest_record
+
+# Streaming ingestion of the BHL Flickr harvest.
+#
+# Zips are streamed to disk, archive members are read in place (no extraction),
+# records are parsed incrementally and written to the outputs as they come.
+# Page/photo pairs are staged in a temporary SQLite table, so building the
+# JSON dictionary and the binary index needs no more memory than a single
+# record, however large the harvest is.
+#
+# Tags found in the records go to the Flickr tag store (dicts/flickr_tags.sqlite,
+# see flickr_tag_store.py). With --crawl_tags, the photos still missing from
+# the store are then fetched from the Flickr API, one request each; the crawl
+# can be interrupted and picks up where it stopped.
+
 # Define base directories
 base_dir = HERE
 zip_dir = base_dir / "zips"
-extracted_dir = base_dir / "extracted"
 tsv_dir = base_dir / "tsv"
 
-# Create directories if they don't exist
-zip_dir.mkdir(parents=True, exist_ok=True)
-extracted_dir.mkdir(parents=True, exist_ok=True)
-tsv_dir.mkdir(parents=True, exist_ok=True)
-
 # List of zip file URLs (using raw GitHub URLs)
 zip_urls = [
     "https://raw.githubusercontent.com/gbhl/bhl-us-data-sets/master/Flickr-Harvest/BHLFlickrDetails1.zip",
@@ -23,89 +40,277 @@ zip_urls = [
     "https://raw.githubusercontent.com/gbhl/bhl-us-data-sets/master/Flickr-Harvest/BHLFlickrDetails4.zip"
 ]
 
-# Download each zip file and save it to disk
-for url in zip_urls:
-    filename = Path(url).name  # Extract file name from URL
-    zip_path = zip_dir / filename
-    print(f"Downloading {url} to {zip_path} ...")
-    response = requests.get(url)
-    if response.status_code != 200:
-        print(f"Failed to download {url}")
-        continue
-    zip_path.write_bytes(response.content)
-    print(f"Saved {zip_path}")
-
-# Extract the downloaded zip files into separate folders under 'extracted'
-for zip_file in zip_dir.glob("*.zip"):
-    print(f"Extracting {zip_file}...")
-    with zipfile.ZipFile(zip_file, "r") as z:
-        # Create a subfolder named after the zip file (without extension)
-        extract_subdir = extracted_dir / zip_file.stem
-        extract_subdir.mkdir(exist_ok=True)
-        z.extractall(extract_subdir)
-        print(f"Extracted to {extract_subdir}")
-
-# Function to read file content with fallback encodings
-def read_file_with_encodings(file_path, encodings=("utf-8", "utf-16", "latin-1")):
-    raw_bytes = file_path.read_bytes()
-    for enc in encodings:
-        try:
-            return raw_bytes.decode(enc)
-        except UnicodeDecodeError:
-            continue
-    raise UnicodeDecodeError(f"Could not decode {file_path} with tried encodings.")
-
-# Initialize a list to collect master records
-master_rows = []
-
-# Recursively search for all files in the extracted directory.
-# We assume the files contain JSON data.
-for file_path in extracted_dir.rglob("*"):
-    if file_path.is_file():
-        print(f"Processing {file_path}...")
-        try:
-            content = read_file_with_encodings(file_path)
-        except Exception as e:
-            print(f"Could not read {file_path}: {e}")
-            continue
-
-        # Try loading the file content as JSON.
-        try:
-            # Some files may be a single JSON array
-            data = json.loads(content)
-        except json.JSONDecodeError:
-            # Otherwise, assume newline-delimited JSON records
-            data = []
-            for line in content.splitlines():
-                line = line.strip()
-                if line:
-                    try:
-                        data.append(json.loads(line))
-                    except json.JSONDecodeError:
-                        continue
-
-        # Process each JSON record if it contains a "Pages" list.
-        for page in data.get("Pages", []):
+CHUNK_SIZE = 1 << 20
+PAGES_KEY = re.compile(r'"Pages"\s*:\s*\[')
+STAGING_BATCH_SIZE = 10000
+
+
+def download_zip(url, zip_path):
+    """Streams a zip to disk in chunks, via a .part file so partial downloads are never used."""
+    part_path = zip_path.with_suffix(".part")
+    with requests.get(url, stream=True) as response:
+        if response.status_code != 200:
+            print(f"Failed to download {url}")
+            return False
+        with part_path.open("wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+    part_path.replace(zip_path)
+    return True
+
+
+def open_text_member(raw):
+    """Wraps a binary archive member in a text stream, picking the encoding from its BOM."""
+    raw = io.BufferedReader(raw, buffer_size=CHUNK_SIZE)
+    head = raw.peek(4)[:4]
+    if head.startswith((b"\xff\xfe", b"\xfe\xff")):
+        encoding = "utf-16"
+    elif head.startswith(b"\xef\xbb\xbf"):
+        encoding = "utf-8-sig"
+    else:
+        encoding = "utf-8"
+    return io.TextIOWrapper(raw, encoding=encoding, errors="replace")
+
+
+def next_record_boundary(buffer, position):
+    """Where the element after a malformed one may start: past the next newline or "},{"."""
+    boundaries = []
+    newline = buffer.find("\n", position + 1)
+    if newline != -1:
+        boundaries.append(newline + 1)
+    separator = buffer.find("},{", position + 1)
+    if separator != -1:
+        boundaries.append(separator + 2)
+    return min(boundaries, default=None)
+
+
+def iter_pages_from_stream(text_stream, chunk_size=CHUNK_SIZE):
+    """
+    Yields each element of every "Pages" array in a JSON text stream.
+
+    Works for a single JSON document as well as newline-delimited records,
+    and only keeps the not-yet-parsed part of the stream in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    in_pages = False
+    eof = False
+
+    while True:
+        if in_pages:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                in_pages = False
+                position += 1
+                continue
+            if position < len(buffer):
+                try:
+                    page, position = decoder.raw_decode(buffer, position)
+                    if isinstance(page, dict) and "Pages" in page:
+                        # A whole record, reached by skipping past a malformed
+                        # element to the next line of a newline-delimited file.
+                        yield from page["Pages"]
+                    else:
+                        yield page
+                    continue
+                except json.JSONDecodeError:
+                    # Usually a record cut at the chunk boundary, so read more
+                    # below; with more than a chunk buffered, it is malformed.
+                    if eof or len(buffer) - position > chunk_size:
+                        boundary = next_record_boundary(buffer, position)
+                        if boundary is not None:
+                            print("Skipping malformed record.")
+                            position = boundary
+                            continue
+                        if eof:
+                            print("Skipping truncated or malformed record at end of file.")
+                            return
+        else:
+            match = PAGES_KEY.search(buffer, position)
+            if match:
+                position = match.end()
+                in_pages = True
+                continue
+            # Keep a short tail, in case the key itself was cut by the chunk boundary.
+            position = max(position, len(buffer) - 32)
+
+        if eof:
+            return
+        chunk = text_stream.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def iter_harvest_pages(zip_path):
+    """Yields page records from every member of a harvest zip, without extracting it."""
+    with zipfile.ZipFile(zip_path, "r") as z:
+        for member in z.infolist():
+            if member.is_dir():
+                continue
+            print(f"Processing {zip_path.name}:{member.filename}...")
+            with z.open(member) as raw:
+                yield from iter_pages_from_stream(open_text_member(raw))
+
+
+def stage_pairs(staging, pairs):
+    staging.executemany(
+        "INSERT INTO pairs (page, photo, page_num, photo_num) VALUES (?, ?, ?, ?)",
+        [
+            (
+                page,
+                photo,
+                int(page) if page.isdigit() else None,
+                int(photo) if photo.isdigit() else None,
+            )
+            for page, photo in pairs
+        ],
+    )
+
+
+def write_json_dict(staging, output_json_file):
+    """Writes the {page_id: photo_id} dictionary (last record wins) record by record."""
+    rows = staging.execute(
+        "SELECT page, photo FROM pairs WHERE seq IN "
+        "(SELECT MAX(seq) FROM pairs GROUP BY page) ORDER BY seq"
+    )
+    with output_json_file.open("w", encoding="utf-8") as f:
+        f.write("{")
+        for i, (page, photo) in enumerate(rows):
+            f.write(",\n  " if i else "\n  ")
+            f.write(f"{json.dumps(page)}: {json.dumps(photo)}")
+        f.write("\n}")
+
+
+def write_binary(staging, output_binary_file):
+    # Same rules as BhlFlickrIndex: last photo for a page, first page for a photo.
+    by_page = (
+        "SELECT page_num, photo_num FROM pairs "
+        "WHERE seq IN (SELECT MAX(seq) FROM pairs GROUP BY page) "
+        "AND page_num IS NOT NULL AND photo_num IS NOT NULL ORDER BY page_num"
+    )
+    by_photo = (
+        "SELECT photo_num, page_num FROM pairs "
+        "WHERE seq IN (SELECT MIN(seq) FROM pairs GROUP BY photo) "
+        "AND page_num IS NOT NULL AND photo_num IS NOT NULL ORDER BY photo_num"
+    )
+    n_pages = staging.execute(f"SELECT COUNT(*) FROM ({by_page})").fetchone()[0]
+    n_photos = staging.execute(f"SELECT COUNT(*) FROM ({by_photo})").fetchone()[0]
+    write_binary_index(
+        output_binary_file,
+        lambda: staging.execute(by_page),
+        n_pages,
+        lambda: staging.execute(by_photo),
+        n_photos,
+    )
+    return n_pages, n_photos
+
+
+def crawl_missing_tags(staging, store):
+    """Fetches the tags of every harvested photo that is not in the store yet."""
+    from login import FLICKR_API_KEY
+
+    photos = [photo for (photo,) in staging.execute("SELECT DISTINCT photo FROM pairs")]
+    missing = [photo for photo in photos if photo not in store]
+    print(f"Crawling Flickr tags for {len(missing)} of {len(photos)} photos...")
+    for i, photo in enumerate(missing, 1):
+        tags = fetch_flickr_tags(photo, FLICKR_API_KEY)
+        if tags is not None:
+            store.set(photo, tags, source="crawl")
+        if i % 1000 == 0:
+            print(f"{i} of {len(missing)} photos crawled.")
+
+
+def main(crawl_tags=False):
+    # Create directories if they don't exist
+    zip_dir.mkdir(parents=True, exist_ok=True)
+    tsv_dir.mkdir(parents=True, exist_ok=True)
+
+    # Download each zip file and save it to disk
+    for url in zip_urls:
+        filename = Path(url).name  # Extract file name from URL
+        zip_path = zip_dir / filename
+        print(f"Downloading {url} to {zip_path} ...")
+        if download_zip(url, zip_path):
+            print(f"Saved {zip_path}")
+
+    staging_file = tsv_dir / "staging.sqlite"
+    staging_file.unlink(missing_ok=True)
+    staging = sqlite3.connect(staging_file)
+    staging.execute(
+        "CREATE TABLE pairs (seq INTEGER PRIMARY KEY, page TEXT NOT NULL, "
+        "photo TEXT NOT NULL, page_num INTEGER, photo_num INTEGER)"
+    )
+
+    tag_store = FlickrTagStore(HERE.parent / "dicts" / "flickr_tags.sqlite")
+    pending_tags = []
+    tagged_records = 0
+
+    # Write out the master TSV file as records are parsed
+    output_file = tsv_dir / "master.tsv"
+    record_count = 0
+    with output_file.open("w", newline='', encoding="utf-8") as tsvfile:
+        writer = csv.writer(tsvfile, delimiter="\t")
+        # Write header
+        writer.writerow(["Title", "Title ID", "Flickr ID", "BHL Page ID"])
+        pending_pairs = []
+        for zip_file in sorted(zip_dir.glob("*.zip")):
+            for page in iter_harvest_pages(zip_file):
+                if not isinstance(page, dict):
+                    continue
                 title = page.get("Title", "")
                 title_id = page.get("TitleID", "")
                 flickr_id = page.get("PhotoID", "")
                 page_id = page.get("PageID", "")
-                master_rows.append([title, title_id, flickr_id, page_id])
+                writer.writerow([title, title_id, flickr_id, page_id])
+                record_count += 1
+                if page_id and flickr_id:
+                    pending_pairs.append((str(page_id), str(flickr_id)))
+                tags = tags_from_harvest_record(page)
+                if flickr_id and tags is not None:
+                    pending_tags.append((str(flickr_id), tags))
+                    tagged_records += 1
+                if len(pending_pairs) >= STAGING_BATCH_SIZE:
+                    stage_pairs(staging, pending_pairs)
+                    pending_pairs = []
+                if len(pending_tags) >= STAGING_BATCH_SIZE:
+                    tag_store.set_many(pending_tags, source="harvest")
+                    pending_tags = []
+        stage_pairs(staging, pending_pairs)
+        staging.commit()
+        tag_store.set_many(pending_tags, source="harvest")
+
+    print(f"Master TSV file '{output_file}' has been created with {record_count} records.")
+    print(f"{tagged_records} records carried Flickr tags; {len(tag_store)} photos in the tag store.")
+
+    staging.execute("CREATE INDEX pairs_page ON pairs (page)")
+    staging.execute("CREATE INDEX pairs_photo ON pairs (photo)")
+
+    # Save as BHL:Flickr dict in JSON format
+    output_json_file = HERE.parent / "dicts" / "bhl_flickr_dict.json"
+    write_json_dict(staging, output_json_file)
+
+    # Also save the compact, memory-mappable form used by get_metadata.py
+    output_binary_file = HERE.parent / "dicts" / "bhl_flickr_index.bin"
+    n_pages, n_photos = write_binary(staging, output_binary_file)
+    print(f"Indexed {n_pages} pages and {n_photos} photos in '{output_binary_file}'.")
 
-# Write out the master TSV file
-output_file = tsv_dir / "master.tsv"
-with output_file.open("w", newline='', encoding="utf-8") as tsvfile:
-    writer = csv.writer(tsvfile, delimiter="\t")
-    # Write header
-    writer.writerow(["Title", "Title ID", "Flickr ID", "BHL Page ID"])
-    # Write each record row
-    for row in master_rows:
-        writer.writerow(row)
+    if crawl_tags:
+        crawl_missing_tags(staging, tag_store)
 
-print(f"Master TSV file '{output_file}' has been created with {len(master_rows)} records.")
+    staging.close()
+    staging_file.unlink()
 
-# Save as BHL:Flickr dict in JSON format
 
-bhl_flickr_dict = {row[3]: row[2] for row in master_rows}
-output_json_file = HERE.parent / "dicts" /  "bhl_flickr_dict.json"
-output_json_file.write_text(json.dumps(bhl_flickr_dict, indent=2))
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process the BHL Flickr harvest.")
+    parser.add_argument(
+        "--crawl_tags",
+        action="store_true",
+        help="Fetch Flickr tags for the photos whose harvest records have none (1 request/s).",
+    )
+    args = parser.parse_args()
+    main(crawl_tags=args.crawl_tags)
@@ -0,0 +1,193 @@
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+from http_metrics import http_get
+
+COMMONS_API_ENDPOINT = "https://commons.wikimedia.org/w/api.php"
+MAX_WORKERS = 8
+MAX_ATTEMPTS = 3
+
+# Crawler for Commons category trees.
+#
+# Members are listed following cmcontinue, so large categories are complete.
+# Categories are visited level by level (each level fetched concurrently) and
+# each category is only crawled once, which protects against the category
+# cycles that exist on Commons. The resulting tree is saved as a JSON snapshot;
+# on later runs only the categories whose `categoryinfo` counts changed are
+# listed again.
+
+
+def _api_get(params, endpoint=COMMONS_API_ENDPOINT):
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            operation = params.get("list") or params.get("prop") or params.get("action")
+            r = http_get(endpoint, operation, params=params)
+            r.raise_for_status()
+            data = r.json()
+            if "error" in data:
+                raise RuntimeError(data["error"].get("info", data["error"]))
+            return data
+        except (requests.RequestException, ValueError, RuntimeError) as e:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            logging.warning(f"Commons API request failed ({e}), retrying...")
+            time.sleep(2**attempt)
+
+
+def get_category_members(category_name, endpoint=COMMONS_API_ENDPOINT):
+    """Returns (files, subcategories) directly in a category, following continuation."""
+    params = {
+        "action": "query",
+        "list": "categorymembers",
+        "cmtitle": f"Category:{category_name}",
+        "cmtype": "file|subcat",
+        "cmprop": "title|type",
+        "cmlimit": "max",
+        "format": "json",
+        "formatversion": "2",
+    }
+    files = []
+    subcategories = []
+    while True:
+        data = _api_get(params, endpoint)
+        for member in data.get("query", {}).get("categorymembers", []):
+            if member["type"] == "file":
+                files.append(member["title"].replace("File:", "", 1))
+            elif member["type"] == "subcat":
+                subcategories.append(member["title"].replace("Category:", "", 1))
+        if "continue" not in data:
+            break
+        params = {**params, **data["continue"]}
+    return files, subcategories
+
+
+def get_category_info(category_names, endpoint=COMMONS_API_ENDPOINT, batch_size=50):
+    """Returns the `categoryinfo` member counts for each category, 50 per request."""
+    category_names = list(category_names)
+    info = {}
+    for start in range(0, len(category_names), batch_size):
+        batch = category_names[start : start + batch_size]
+        params = {
+            "action": "query",
+            "prop": "categoryinfo",
+            "titles": "|".join(f"Category:{name}" for name in batch),
+            "format": "json",
+            "formatversion": "2",
+        }
+        data = _api_get(params, endpoint)
+        query = data.get("query", {})
+        renamed = {entry["to"]: entry["from"] for entry in query.get("normalized", [])}
+        for page in query.get("pages", []):
+            title = renamed.get(page["title"], page["title"])
+            info[title.replace("Category:", "", 1)] = page.get("categoryinfo", {})
+    return info
+
+
+def load_snapshot(snapshot_path):
+    if snapshot_path and Path(snapshot_path).exists():
+        return json.loads(Path(snapshot_path).read_text())
+    return {"categories": {}}
+
+
+def save_snapshot(snapshot, snapshot_path):
+    snapshot_path = Path(snapshot_path)
+    snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = snapshot_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(snapshot, indent=2))
+    tmp_path.replace(snapshot_path)
+
+
+def crawl_category_tree(
+    category_name,
+    include_subcategories=True,
+    snapshot_path=None,
+    max_workers=MAX_WORKERS,
+    endpoint=COMMONS_API_ENDPOINT,
+):
+    """
+    Crawls a category (and optionally its subcategories) and returns the tree
+    as {category: {"files": [...], "subcats": [...], "info": {...}}}.
+
+    If `snapshot_path` holds a previous crawl, categories whose categoryinfo
+    counts are unchanged are reused from it instead of being listed again.
+    """
+    previous = load_snapshot(snapshot_path)["categories"]
+    tree = {}
+    visited = {category_name}
+    level = [category_name]
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while level:
+            current_info = get_category_info(level, endpoint)
+            to_fetch = []
+            for name in level:
+                known = previous.get(name)
+                if known and current_info.get(name) == known.get("info"):
+                    tree[name] = known
+                else:
+                    to_fetch.append(name)
+
+            futures = {
+                name: executor.submit(get_category_members, name, endpoint)
+                for name in to_fetch
+            }
+            for name, future in futures.items():
+                try:
+                    files, subcategories = future.result()
+                except Exception as e:
+                    logging.error(f"Could not list Category:{name}: {e}")
+                    failed.append(name)
+                    continue
+                tree[name] = {
+                    "files": files,
+                    "subcats": subcategories,
+                    "info": current_info.get(name, {}),
+                }
+
+            if not include_subcategories:
+                break
+            next_level = []
+            for name in level:
+                for subcategory in tree.get(name, {}).get("subcats", []):
+                    if subcategory not in visited:
+                        visited.add(subcategory)
+                        next_level.append(subcategory)
+            level = next_level
+
+    if snapshot_path:
+        # Keep previous entries that were not crawled this time (failed, or
+        # not reached because subcategories were excluded) for later reuse.
+        save_snapshot(
+            {"root": category_name, "categories": {**previous, **tree}}, snapshot_path
+        )
+    if failed:
+        raise RuntimeError(
+            f"Could not list {len(failed)} categories: {', '.join(failed[:10])}"
+        )
+    return tree
+
+
+def files_in_tree(tree, category_name, include_subcategories=True):
+    """Flattens a crawled tree into a list of unique files, in depth-first order."""
+    files = []
+    seen_files = set()
+    seen_categories = set()
+    stack = [category_name]
+    while stack:
+        name = stack.pop()
+        if name in seen_categories or name not in tree:
+            continue
+        seen_categories.add(name)
+        for file in tree[name]["files"]:
+            if file not in seen_files:
+                seen_files.add(file)
+                files.append(file)
+        if include_subcategories:
+            stack.extend(reversed(tree[name]["subcats"]))
+    return files
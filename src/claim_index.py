@@ -0,0 +1,63 @@
+import json
+
+# Read-only index of the statements an entity was loaded with.
+#
+# Built once per entity from its claims JSON (upload.build_edit reuses the
+# copy EntityEdit already serialized), and handed to the helper.py builders
+# for their "is this already on the file?" checks, instead of each builder
+# serializing the whole claim set again with media.claims.get_json().
+#
+# For each property it keeps the set of mainsnak values: the comparable part
+# of the datavalue, i.e. the ID of an entity, the time string of a date, the
+# text of a string or URL. The builders only compare values, so qualifiers
+# and references are not indexed; the statement IDs are kept, so a builder
+# can name the statements to remove. Statements marked for removal are left
+# out; "somevalue"/"novalue" statements have no value, but still count for
+# `prop in index`.
+
+
+def snak_value(snak):
+    """The comparable value of a snak, or None if it has no value."""
+    value = snak.get("datavalue", {}).get("value")
+    if isinstance(value, dict):
+        for key in ("id", "time", "text", "amount"):
+            if key in value:
+                return value[key]
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+class ClaimIndex:
+    def __init__(self, claims_json):
+        # {property: {value, ...}}
+        self._index = {}
+        # {property: [(statement ID, value), ...]}, in entity order
+        self._statements = {}
+        self._properties = set()
+        for prop, claims in claims_json.items():
+            values = set()
+            statements = []
+            for claim in claims:
+                if "remove" in claim:
+                    continue
+                self._properties.add(prop)
+                value = snak_value(claim.get("mainsnak", {}))
+                if value is not None:
+                    values.add(value)
+                statements.append((claim.get("id"), value))
+            self._index[prop] = values
+            self._statements[prop] = statements
+
+    def __contains__(self, prop):
+        return prop in self._properties
+
+    def values(self, prop):
+        """Set of the values stated for `prop`."""
+        return set(self._index.get(prop, ()))
+
+    def statements(self, prop):
+        """(statement ID, value) of each statement on `prop`."""
+        return list(self._statements.get(prop, ()))
+
+    def has(self, prop, value):
+        return value in self._index.get(prop, ())
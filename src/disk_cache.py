@@ -0,0 +1,116 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# SQLite-backed key/value cache shared by the pipeline scripts.
+# Entries are keyed by (operation, key), e.g. ("GetPageMetadata", "12345"),
+# and stored as JSON. WAL mode plus a busy timeout lets several runs
+# (e.g. two categories harvested at once) share the same file.
+
+EVICTION_CHECK_INTERVAL = 500
+
+
+class DiskCache:
+    def __init__(self, path, ttl_seconds=None, max_entries=None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes_since_eviction = 0
+        self._lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache (
+                    operation TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    PRIMARY KEY (operation, key)
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)"
+            )
+
+    def _connection(self):
+        # sqlite3 connections can't be shared across threads, so keep one per thread.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _is_expired(self, created):
+        if not self.ttl_seconds:
+            return False
+        return time.time() - created > self.ttl_seconds
+
+    def get(self, operation, key, default=None):
+        conn = self._connection()
+        found = conn.execute(
+            "SELECT value, created FROM cache WHERE operation = ? AND key = ?",
+            (operation, str(key)),
+        ).fetchone()
+        if found is None or self._is_expired(found[1]):
+            return default
+        conn.execute(
+            "UPDATE cache SET accessed = ? WHERE operation = ? AND key = ?",
+            (time.time(), operation, str(key)),
+        )
+        return json.loads(found[0])
+
+    def __contains__(self, operation_and_key):
+        operation, key = operation_and_key
+        found = (
+            self._connection()
+            .execute(
+                "SELECT created FROM cache WHERE operation = ? AND key = ?",
+                (operation, str(key)),
+            )
+            .fetchone()
+        )
+        return found is not None and not self._is_expired(found[0])
+
+    def set(self, operation, key, value):
+        now = time.time()
+        self._connection().execute(
+            "INSERT OR REPLACE INTO cache (operation, key, value, created, accessed) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (operation, str(key), json.dumps(value), now, now),
+        )
+        with self._lock:
+            self._writes_since_eviction += 1
+            should_evict = self._writes_since_eviction >= EVICTION_CHECK_INTERVAL
+            if should_evict:
+                self._writes_since_eviction = 0
+        if should_evict:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones above max_entries."""
+        conn = self._connection()
+        if self.ttl_seconds:
+            conn.execute(
+                "DELETE FROM cache WHERE created < ?", (time.time() - self.ttl_seconds,)
+            )
+        if self.max_entries:
+            (count,) = conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+            excess = count - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM cache WHERE rowid IN "
+                    "(SELECT rowid FROM cache ORDER BY accessed ASC LIMIT ?)",
+                    (excess,),
+                )
+
+    def __len__(self):
+        (count,) = self._connection().execute("SELECT COUNT(*) FROM cache").fetchone()
+        return count
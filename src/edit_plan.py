@@ -0,0 +1,90 @@
+import json
+from pathlib import Path
+
+from wikibaseintegrator.wbi_exceptions import MWApiError
+from wikibaseintegrator.wbi_helpers import edit_entity
+
+# Upload plans: the edits upload.py would make, worked out before any write.
+#
+# Planning (upload.py --plan) loads the entity of every file, runs the
+# statement builders and keeps, for each file that would change, one JSON
+# line with the exact edit:
+#
+#   {"file": ..., "mediainfo_id": "M123", "base_revid": 456,
+#    "row_hash": ..., "row": {...}, "claims": [...], "remove": [...],
+#    "delta": {"P180": {"added": 2, "removed": 0}}}
+#
+# "claims" holds the new and modified statements, "remove" the GUIDs of the
+# statements to delete, and "base_revid" the revision they were computed
+# from. The plan can be read, diffed and timed before anything is written.
+#
+# Replaying (upload.py --execute_plan) sends each edit as it is, in one
+# wbeditentity call with baserevid, without loading entities or running the
+# builders. A file whose revision is no longer base_revid has been edited
+# since planning; that conflict is found in the batched revision check before
+# the writes, or reported by Commons as "editconflict". Conflicting files are
+# skipped, or re-planned against their current entity (--on_conflict replan).
+
+
+class EditConflict(Exception):
+    """The entity was edited after the plan was made."""
+
+
+def plan_entry(file_name, mediainfo_id, base_revid, row, row_hash, edit):
+    """The plan line of a file, from the EntityEdit its row was built into."""
+    claims, removed = edit.changes()
+    return {
+        "file": file_name,
+        "mediainfo_id": mediainfo_id,
+        "base_revid": base_revid,
+        "row_hash": row_hash,
+        "row": {key: str(value) for key, value in dict(row).items()},
+        "claims": claims,
+        "remove": removed,
+        "delta": edit.delta(),
+    }
+
+
+def write_plan(entries, path):
+    """Writes the plan lines; the file is moved into place once complete."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with tmp_path.open("w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    tmp_path.replace(path)
+
+
+def read_plan(path):
+    with Path(path).open(encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def edit_data(entry):
+    """The wbeditentity data of a plan line: its statements, then its removals."""
+    return {
+        "claims": entry["claims"]
+        + [{"id": claim_id, "remove": ""} for claim_id in entry["remove"]]
+    }
+
+
+def apply_entry(wbi, summary, entry):
+    """
+    Sends the edit of a plan line, based on its base revision. Returns the
+    new revision ID; raises EditConflict if the entity changed since.
+    """
+    try:
+        result = edit_entity(
+            data=edit_data(entry),
+            id=entry["mediainfo_id"],
+            baserevid=entry["base_revid"],
+            summary=summary,
+            login=wbi.login,
+            is_bot=wbi.is_bot,
+        )
+    except MWApiError as e:
+        if e.code == "editconflict":
+            raise EditConflict(entry["file"]) from e
+        raise
+    return result["entity"].get("lastrevid")
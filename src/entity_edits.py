@@ -0,0 +1,164 @@
+import hashlib
+import json
+from collections import Counter
+
+from wikibaseintegrator import wbi_enums
+
+# Coalesced writes for upload.py.
+#
+# Statement additions (each group with its own ActionIfExists) and removals
+# are applied to the local entity as they are queued, and the entity is then
+# sent with a single wbeditentity call: one revision, one round trip and one
+# edit-rate token per file, however many groups of changes were queued.
+#
+# Before writing, the claims are compared with the ones the entity was loaded
+# with through an order-independent hash (see claims_hash). When the merge
+# left the entity as it already is on Commons, the write is skipped.
+
+
+def _canonical_snak(snak):
+    value = snak.get("datavalue", {}).get("value")
+    if isinstance(value, dict) and "id" in value:
+        # Entity IDs come with or without "numeric-id"; the ID alone identifies them.
+        value = value["id"]
+    return [snak.get("property"), snak.get("snaktype", "value"), value]
+
+
+def _canonical_snaks(snaks):
+    return sorted(
+        (_canonical_snak(snak) for values in snaks.values() for snak in values),
+        key=json.dumps,
+    )
+
+
+def _canonical_claim(claim):
+    return [
+        _canonical_snak(claim["mainsnak"]),
+        claim.get("rank", "normal"),
+        _canonical_snaks(claim.get("qualifiers", {})),
+        sorted(
+            (
+                _canonical_snaks(reference.get("snaks", {}))
+                for reference in claim.get("references", [])
+            ),
+            key=json.dumps,
+        ),
+    ]
+
+
+def claims_hash(claims_json):
+    """
+    Hash of a claims JSON dict (as from media.claims.get_json()) that only
+    depends on the mainsnaks, ranks, qualifiers and references, not on their
+    order, statement IDs or snak hashes. Claims marked for removal are left out.
+    """
+    canonical = sorted(
+        (
+            _canonical_claim(claim)
+            for claims in claims_json.values()
+            for claim in claims
+            if "remove" not in claim
+        ),
+        key=json.dumps,
+    )
+    serialized = json.dumps(canonical, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(serialized).hexdigest()
+
+
+def claims_delta(before_json, after_json):
+    """
+    Per-property statement changes between two claims JSON dicts, as
+    {property: {"added": n, "removed": n}}. A statement whose qualifiers or
+    references changed counts as one removed and one added.
+    """
+
+    def canonical_claims(claims_json):
+        return Counter(
+            (prop, json.dumps(_canonical_claim(claim), sort_keys=True))
+            for prop, claims in claims_json.items()
+            for claim in claims
+            if "remove" not in claim
+        )
+
+    before = canonical_claims(before_json)
+    after = canonical_claims(after_json)
+    delta = {}
+    for change, claims in (("added", after - before), ("removed", before - after)):
+        for (prop, _), count in claims.items():
+            delta.setdefault(prop, {"added": 0, "removed": 0})[change] += count
+    return delta
+
+
+class EntityEdit:
+    def __init__(self, media):
+        self.media = media
+        # Entity JSON of the last write, as Commons returned it (see write).
+        self.entity_json = None
+        # Serialized so that later changes to the claim objects can't leak into it.
+        self.base_claims = json.loads(json.dumps(media.claims.get_json()))
+        self.base_hash = claims_hash(self.base_claims)
+
+    def add(
+        self,
+        statements,
+        action_if_exists=wbi_enums.ActionIfExists.MERGE_REFS_OR_APPEND,
+    ):
+        statements = list(statements)
+        if statements:
+            self.media.claims.add(statements, action_if_exists=action_if_exists)
+
+    @property
+    def has_changes(self):
+        # Removals made directly on the entity (e.g. by the helper builders) count too.
+        return claims_hash(self.media.claims.get_json()) != self.base_hash
+
+    def delta(self):
+        """Statement changes queued so far, by property (see claims_delta)."""
+        return claims_delta(self.base_claims, self.media.claims.get_json())
+
+    def changes(self):
+        """
+        The queued changes as (claims, removed): the JSON of the new and
+        modified statements, and the GUIDs of the statements to remove.
+        Statements left as they were loaded are not included.
+        """
+        base_by_id = {
+            claim["id"]: claim
+            for claims in self.base_claims.values()
+            for claim in claims
+            if "id" in claim
+        }
+        claims, removed, kept = [], [], set()
+        for prop_claims in self.media.claims.get_json().values():
+            for claim in prop_claims:
+                claim_id = claim.get("id")
+                if "remove" in claim:
+                    removed.append(claim_id)
+                    continue
+                if claim_id in base_by_id:
+                    kept.add(claim_id)
+                    # Snak hashes and ordering don't count as a change.
+                    if _canonical_claim(claim) == _canonical_claim(base_by_id[claim_id]):
+                        continue
+                claims.append(claim)
+        removed += [
+            claim_id
+            for claim_id in base_by_id
+            if claim_id not in kept and claim_id not in removed
+        ]
+        return claims, removed
+
+    def write(self, summary):
+        """
+        Sends every queued change in one wbeditentity call. Returns False,
+        without calling the API, when the claims would be left unchanged.
+        """
+        if not self.has_changes:
+            return False
+        # MediaInfoEntity.write in two steps, to keep the response's entity
+        # JSON (with its reference hashes) for upload.save_snapshot.
+        self.entity_json = self.media._write(data=self.media.get_json(), summary=summary)
+        self.media = self.media.from_json(self.entity_json)
+        self.base_claims = json.loads(json.dumps(self.media.claims.get_json()))
+        self.base_hash = claims_hash(self.base_claims)
+        return True
@@ -0,0 +1,122 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from http_metrics import http_get
+
+FLICKR_API_ENDPOINT = "https://api.flickr.com/services/rest/"
+HARVEST_TAG_KEYS = ("Tags", "FlickrTags")
+
+# Local store of Flickr tags, keyed by photo ID.
+#
+# Built by bhl_to_flickr_map/process_flickr_harvest.py from the tags carried
+# in the harvest records and, with --crawl_tags, by asking the Flickr API
+# once for each remaining photo (resumable: photos already stored are
+# skipped). get_metadata.get_flickr_tags reads the store first and writes
+# what it fetches back to it, so each photo costs at most one request ever.
+#
+# A photo with no tags is stored as an empty list; a photo that isn't in the
+# store at all is a miss.
+
+
+def tags_from_harvest_record(page):
+    """
+    Raw tags of a harvest page record, or None if the record carries no tag
+    field (which is not the same as having no tags).
+    """
+    for key in HARVEST_TAG_KEYS:
+        if key in page and page[key] is not None:
+            tags = page[key]
+            if isinstance(tags, str):
+                tags = [tags]
+            raw_tags = []
+            for tag in tags:
+                if isinstance(tag, dict):
+                    tag = tag.get("raw") or tag.get("Raw")
+                if tag:
+                    raw_tags.append(str(tag))
+            return raw_tags
+    return None
+
+
+def fetch_flickr_tags(photo_id, api_key):
+    """
+    Raw tags of a photo from flickr.tags.getListPhoto, or None if the request
+    failed (failures are not stored, so they are retried).
+    """
+    params = {
+        "method": "flickr.tags.getListPhoto",
+        "api_key": api_key,
+        "photo_id": photo_id,
+        "format": "json",
+        "nojsoncallback": 1,  # Prevent JSONP callback, get plain JSON
+    }
+    response = http_get(FLICKR_API_ENDPOINT, "flickr.tags.getListPhoto", params=params)
+    if response.status_code != 200:
+        print("Failed to fetch tags. HTTP Status Code:", response.status_code)
+        return None
+    data = response.json()
+    if data.get("stat") != "ok":
+        print("Error:", data.get("message"))
+        return None
+    return [tag["raw"] for tag in data["photo"]["tags"]["tag"]]
+
+
+class FlickrTagStore:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._connection().execute(
+            """
+            CREATE TABLE IF NOT EXISTS tags (
+                photo TEXT PRIMARY KEY,
+                tags TEXT NOT NULL,
+                source TEXT NOT NULL,
+                updated REAL NOT NULL
+            )
+            """
+        )
+
+    def _connection(self):
+        # One connection per thread, as in DiskCache.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, photo_id):
+        found = self._connection().execute(
+            "SELECT tags FROM tags WHERE photo = ?", (str(photo_id),)
+        ).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def __contains__(self, photo_id):
+        return (
+            self._connection()
+            .execute("SELECT 1 FROM tags WHERE photo = ?", (str(photo_id),))
+            .fetchone()
+            is not None
+        )
+
+    def set_many(self, tags_by_photo, source):
+        """Stores (photo_id, tags) pairs in one transaction."""
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT OR REPLACE INTO tags (photo, tags, source, updated) VALUES (?, ?, ?, ?)",
+            [(str(photo), json.dumps(tags), source, now) for photo, tags in tags_by_photo],
+        )
+        conn.execute("COMMIT")
+
+    def set(self, photo_id, tags, source="api"):
+        self.set_many([(photo_id, tags)], source)
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM tags").fetchone()[0]
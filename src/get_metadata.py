@@ -1,22 +1,55 @@
 import re
-import requests
 import json
 import argparse
 
-import pandas as pd
-
 from wdcuration import render_qs_url
 from pathlib import Path
 from tqdm import tqdm
 from login import *
 from helper import *
+from disk_cache import DiskCache
+from bhl_flickr_index import load_bhl_flickr_index
+from rate_limits import configure_host_limits
+from http_metrics import METRICS, export_run_metrics, http_get
+from async_harvest import WINDOW_SIZE, harvest_records
+from bhl_titles import load_title_qids, resolve_title_qids, save_title_qids
+from bhl_export import BhlExportIndex
+from flickr_tag_store import FlickrTagStore, fetch_flickr_tags
+from wikitext_ids import scan_wikitext, single_bhl_url_page_id
+from row_journal import RowJournal, compact_journal, iter_resumed_rows
 
 HERE = Path(__file__).parent
 DATA = HERE / "data"
 DICTS = HERE / "dicts"
-API_CACHE = {}
+# BHL title ID -> publication QID, kept across runs (see bhl_titles.py).
+BHL_TITLE_QIDS = DICTS / "bhl_title_qids.json"
+
+BHL_FLICKR_INDEX = None
+# Set by generate_metadata in offline BHL mode; BHL metadata is then read
+# from the local data-export index (bhl_export.py) instead of api3.
+BHL_EXPORT = None
+BHL_EXPORT_PATH = DATA / "bhl_export.sqlite"
+
+
+def get_bhl_flickr_index():
+    # Loaded on first use; the memory-mapped binary form makes this near-instant.
+    global BHL_FLICKR_INDEX
+    if BHL_FLICKR_INDEX is None:
+        BHL_FLICKR_INDEX = load_bhl_flickr_index(DICTS)
+    return BHL_FLICKR_INDEX
 
-BHL_TO_FLICKR_DICT = json.loads(DICTS.joinpath("bhl_flickr_dict.json").read_text())
+
+FLICKR_TAG_STORE = None
+FLICKR_TAG_STORE_PATH = DICTS / "flickr_tags.sqlite"
+
+
+def get_flickr_tag_store():
+    # Built by bhl_to_flickr_map/process_flickr_harvest.py; filled further by
+    # get_flickr_tags as it fetches photos that are missing.
+    global FLICKR_TAG_STORE
+    if FLICKR_TAG_STORE is None:
+        FLICKR_TAG_STORE = FlickrTagStore(FLICKR_TAG_STORE_PATH)
+    return FLICKR_TAG_STORE
 
 
 def load_config(config_file_name):
@@ -43,12 +76,27 @@ WIKIDATA_SPARQL_ENDPOINT = config["WIKIDATA_SPARQL_ENDPOINT"]
 BHL_BASE_URL = config["BHL_BASE_URL"]
 SET_PROMINENT = config["SET_PROMINENT"]
 ADD_EMPTY_IF_SPONSOR_MISSING = config["ADD_EMPTY_IF_SPONSOR_MISSING"]
+BHL_ITEM_PREFETCH = config.get("BHL_ITEM_PREFETCH", True)
+BHL_API_URL = f"{BHL_BASE_URL}/api3"
+
+# Persistent cache for BHL API responses, shared across runs.
+BHL_CACHE = DiskCache(
+    DATA / "cache" / "bhl_api.sqlite",
+    ttl_seconds=config.get("BHL_CACHE_TTL_DAYS", 30) * 24 * 60 * 60,
+    max_entries=config.get("BHL_CACHE_MAX_ENTRIES", 500000),
+)
 
 CATEGORY_NAME = CATEGORY_RAW.replace("_", " ").replace("Category:", "").strip()
 
 
 def generate_metadata(
-    category_name, app_mode=False, output_file=None, config=None, auto_mode=False
+    category_name,
+    app_mode=False,
+    output_file=None,
+    config=None,
+    auto_mode=False,
+    async_mode=False,
+    offline_bhl=False,
 ):
     global CATEGORY_NAME
     global SKIP_CREATOR
@@ -66,6 +114,8 @@ def generate_metadata(
     global SKIP_EXISTING_INSTANCE_OF
     global INCLUDE_SUBCATEGORIES
     global GET_FLICKR_TAGS
+    global BHL_ITEM_PREFETCH
+    global BHL_EXPORT
 
     SKIP_CREATOR = config["SKIP_CREATOR"]
     INFER_BHL_PAGE_FROM_FLICKR_ID = config["INFER_BHL_PAGE_FROM_FLICKR_ID"]
@@ -81,185 +131,259 @@ def generate_metadata(
     SING = config["ADD_EMPTY_IF_SPONSOR_MISSING"]
     INCLUDE_SUBCATEGORIES = config["INCLUDE_SUBCATEGORIES"]
     GET_FLICKR_TAGS = config["GET_FLICKR_TAGS"]
+    BHL_ITEM_PREFETCH = config.get("BHL_ITEM_PREFETCH", True)
+    BHL_CACHE.ttl_seconds = config.get("BHL_CACHE_TTL_DAYS", 30) * 24 * 60 * 60
+    BHL_CACHE.max_entries = config.get("BHL_CACHE_MAX_ENTRIES", 500000)
+    configure_host_limits(config.get("HOST_LIMITS"))
+    async_mode = async_mode or config.get("ASYNC_HARVEST", False)
+    if offline_bhl or config.get("OFFLINE_BHL", False):
+        BHL_EXPORT = BhlExportIndex(BHL_EXPORT_PATH)
+        # Every page is a local lookup; there is nothing to prefetch.
+        BHL_ITEM_PREFETCH = False
+    else:
+        BHL_EXPORT = None
     CATEGORY_NAME = CATEGORY_RAW.replace("_", " ").replace("Category:", "").strip()
 
-    pre_set_biblio_wikidata_id_dict = {}
     files = get_files_in_category(category_name, INCLUDE_SUBCATEGORIES)
-    # Initialize the rows list
-    if RESUME and output_file.exists():
-        df_existing = pd.read_csv(output_file, sep="\t")
-        rows = df_existing.to_dict("records")
-        processed_files = set(df_existing["File"].tolist())
-    else:
-        rows = []
-        processed_files = set()
+    # Initialize the rows list, from the last TSV and the checkpoint journal
+    journal_path = output_file.with_suffix(".journal.jsonl") if output_file else None
+    rows = []
+    if RESUME and output_file:
+        rows.extend(iter_resumed_rows(output_file, journal_path))
+    elif journal_path:
+        journal_path.unlink(missing_ok=True)
+    processed_files = set(row["File"] for row in rows)
+    journal = RowJournal(journal_path) if journal_path else None
 
     processed_counter = 0
-    processed_creators = False
 
-    for file in tqdm(files):
-        if file in processed_files:
-            continue
-        wikitext = get_commons_wikitext(file)
-        bhl_page_id = ""
+    pending_files = [file for file in files if file not in processed_files]
+    if async_mode:
+        records = harvest_records(
+            pending_files,
+            fetch_file_record,
+            prefetch=prefetch_bhl_records if BHL_ITEM_PREFETCH else None,
+            parse=scan_wikitext,
+        )
+    else:
+        records = serial_records(pending_files)
+
+    # One pass collects every record, so that all publication QIDs are
+    # resolved, and ambiguous titles reported (or asked about) together,
+    # before any row is built. Records don't carry the wikitext and their BHL
+    # responses are in BHL_CACHE, so holding them is cheap.
+    records = [
+        record for record in tqdm(records, total=len(pending_files)) if record is not None
+    ]
+    titles = {str(record["biblio_id"]): record["biblio_data"] for record in records}
+    publication_qids = resolve_publication_qids(titles, auto_mode)
+
+    # Rows are then built and checkpointed one window at a time. Records come
+    # back in file order in both modes.
+    for start in range(0, len(records), WINDOW_SIZE):
+        for record in records[start : start + WINDOW_SIZE]:
+            publication_qid = publication_qids.get(str(record["biblio_id"]))
+            if not publication_qid:
+                continue
+            row = build_metadata_row(record, publication_qid)
+
+            processed_counter += 1
+            rows.append(row)
+
+            # Checkpoint each row as it is produced
+            if journal:
+                journal.append(row)
+        if journal:
+            journal.sync()
+
+    if journal:
+        journal.close()
+        compact_journal(
+            journal_path, output_file, keep_existing=RESUME, fieldnames=METADATA_COLUMNS
+        )
+    return rows
 
-        if "{{BHL" in wikitext:
-            bhl_page_id = find_page_id_in_bhl_template(wikitext)
-        else:
-            if "BHL Consortium" in wikitext and INFER_FROM_INTERNET_ARCHIVE:
-                bhl_page_id = infer_bhl_page_id_from_ia_via_wikitext(
-                    wikitext, INTERNET_ARCHIVE_OFFSET
-                )
-            elif (
-                "https://www.flickr.com/photos/biodivlibrary/" in wikitext
-                and INFER_BHL_PAGE_FROM_FLICKR_ID
-            ):
-                # If the file has a Flickr URL in the wikitext, extract the ID.
-                bhl_page_id = get_page_from_flickr_id_via_wikitext(wikitext)
-            else:
-                bhl_page_id = search_for_bhl_urls(wikitext)
-
-        if not bhl_page_id:
-            continue
-        bhl_page_id = str(bhl_page_id)
 
-        # Overwrite flickr_id if we have a mapping.
-        if bhl_page_id in BHL_TO_FLICKR_DICT.keys():
-            flickr_id = BHL_TO_FLICKR_DICT[bhl_page_id]
-        else:
-            flickr_id = ""
-        page_data = get_bhl_page_data(bhl_page_id)
-        if not page_data or not page_data[0]:
-            continue
+def extract_bhl_page_id(ids):
+    """The BHL page ID of a file, from the scan_wikitext record of its page."""
+    if ids["bhl_template"]:
+        return ids["pageid"]
+    if ids["consortium"] and INFER_FROM_INTERNET_ARCHIVE:
+        return infer_bhl_page_id_from_ia_ids(ids, INTERNET_ARCHIVE_OFFSET)
+    if ids["flickr"] and INFER_BHL_PAGE_FROM_FLICKR_ID:
+        # If the file has a Flickr URL in the wikitext, extract the ID.
+        return get_page_from_flickr_id(ids["flickr_id"])
+    return single_bhl_url_page_id(ids)
 
-        item_id = page_data[0].get("ItemID")
-        item_data = get_bhl_item_data(item_id)
-        biblio_id = item_data[0].get("TitleID")
-        biblio_data = get_bhl_title_data(biblio_id)
-        wiki_ids_counter = 0
-        if pre_set_biblio_wikidata_id_dict.get(biblio_id):
-            publication_qid = pre_set_biblio_wikidata_id_dict.get(biblio_id)
-        else:
-            for identifiers in biblio_data[0].get("Identifiers", []):
-                if identifiers.get("IdentifierName") == "Wikidata":
-                    publication_qid = identifiers.get("IdentifierValue")
-                    wiki_ids_counter += 1
-            if wiki_ids_counter != 1:
-                print(
-                    f"Unexpected number of Wikidata IDs ({wiki_ids_counter}) for BHL Title ID {biblio_id}."
-                )
-                print(f"https://www.biodiversitylibrary.org/title/{biblio_id}")
-                print(f"Trying to infer from Wikidata")
-
-                def infer_wikidata_id_from_bhl_title(biblio_id):
-                    query = """
-                    SELECT ?item ?itemLabel 
-                    WHERE
-                    {
-                      {?item wdt:P4327 ?bhl_id . }
-                    } """
-                    query = query.replace("?bhl_id", f'"{biblio_id}"')
-                    from wdcuration import query_wikidata
-
-                    results = query_wikidata(query)
-                    if len(results) == 1:
-                        return [results[0]["item"].split("/")[-1]]
-                    else:
-                        print("Multiple or no results found on Wikidata.")
-                        # return a list of QIDs
-                        qids = [result["item"].split("/")[-1] for result in results]
-                        print(qids)
-                        return qids
-
-                wikidata_qids = infer_wikidata_id_from_bhl_title(biblio_id)
-
-                if len(wikidata_qids) != 1:
-                    if auto_mode:
-                        exit()
-
-                if len(wikidata_qids) == 1:
-                    publication_qid = wikidata_qids[0]
-                else:
-                    qs_url = (
-                        "https://bhl-qs-generator-production.up.railway.app/?bhl="
-                        + biblio_id
-                    )
-                    print(qs_url)
-                    publication_qid = input("Enter the Wikidata QID: ").strip()
 
+def fetch_file_record(file, wikitext_ids):
+    """
+    Does the network-bound work for one file: finds its BHL page and fetches
+    the BHL page, item and title metadata and the Flickr tags. `wikitext_ids`
+    is the scan_wikitext record of the file page.
+
+    Returns None if the file can't be linked to a BHL page. Safe to run from
+    several threads at once (see async_harvest.py).
+    """
+    bhl_page_id = extract_bhl_page_id(wikitext_ids)
+    if not bhl_page_id:
+        return None
+    bhl_page_id = str(bhl_page_id)
+
+    # Overwrite flickr_id if we have a mapping.
+    flickr_id = get_bhl_flickr_index().photo_for_page(bhl_page_id)
+    page_data = get_bhl_page_data(bhl_page_id)
+    if not page_data or not page_data[0]:
+        return None
+
+    item_id = page_data[0].get("ItemID")
+    item_data = get_bhl_item_data(item_id)
+    biblio_id = item_data[0].get("TitleID")
+    biblio_data = get_bhl_title_data(biblio_id)
+
+    if GET_FLICKR_TAGS:
+        flickr_tags = get_flickr_tags(flickr_id)
+    else:
+        flickr_tags = ""
+
+    return {
+        "file": file,
+        "is_extracted": wikitext_ids["extracted"],
+        "bhl_page_id": bhl_page_id,
+        "flickr_id": flickr_id,
+        "page_data": page_data,
+        "item_id": item_id,
+        "item_data": item_data,
+        "biblio_id": biblio_id,
+        "biblio_data": biblio_data,
+        "flickr_tags": flickr_tags,
+    }
+
+
+def resolve_publication_qids(titles, auto_mode=False):
+    """
+    Resolves {biblio_id: biblio_data} to publication QIDs, before any row is
+    built, and saves new resolutions to BHL_TITLE_QIDS.
+
+    Titles that are not on Wikidata, or are there more than once, are listed
+    together. In auto mode their files are skipped; otherwise the QIDs are
+    asked for, one title after the other.
+    """
+    known = load_title_qids(BHL_TITLE_QIDS)
+    resolved, unresolved = resolve_title_qids(titles, known)
+
+    if unresolved:
+        print(f"Could not resolve the Wikidata QID of {len(unresolved)} BHL title(s):")
+        for biblio_id, qids in sorted(unresolved.items()):
+            found = ", ".join(qids) if qids else "no item"
+            print(f"  https://www.biodiversitylibrary.org/title/{biblio_id} ({found} on Wikidata)")
+            print(f"    https://bhl-qs-generator-production.up.railway.app/?bhl={biblio_id}")
+        if auto_mode:
+            print(
+                f"Skipping their files. Add the QIDs to {BHL_TITLE_QIDS} and run again."
+            )
+        else:
+            for biblio_id in sorted(unresolved):
+                publication_qid = input(
+                    f"Enter the Wikidata QID for BHL Title ID {biblio_id}: "
+                ).strip()
                 if not publication_qid.startswith("Q"):
                     raise ValueError("Invalid Wikidata QID entered.")
-                pre_set_biblio_wikidata_id_dict[biblio_id] = publication_qid
-
-        page_types = "; ".join(
-            [a.get("PageTypeName", "") for a in page_data[0].get("PageTypes", [])]
-        )
-        names = "; ".join(
-            list(
-                set(
-                    name.get("NameCanonical", "")
-                    for name in page_data[0].get("Names", [])
-                )
+                resolved[biblio_id] = publication_qid
+
+    new = {biblio_id: qid for biblio_id, qid in resolved.items() if known.get(biblio_id) != qid}
+    if new:
+        save_title_qids({**known, **new}, BHL_TITLE_QIDS)
+    return resolved
+
+
+# The columns of build_metadata_row, in order.
+METADATA_COLUMNS = [
+    "File",
+    "BHL Page ID",
+    "Page Types",
+    "Page Number String",
+    "Page Number Prefix",
+    "Page Number Number",
+    "Published In QID",
+    "Collection",
+    "Sponsor",
+    "Bibliography ID",
+    "Names",
+    "Item Publication Date",
+    "Item ID",
+    "Flickr ID",
+    "Flickr Tags",
+    "Copyright Status",
+    "Volume",
+    "Is Extracted",
+]
+
+
+def build_metadata_row(record, publication_qid):
+    page_data = record["page_data"]
+    item_data = record["item_data"]
+    file = record["file"]
+    bhl_page_id = record["bhl_page_id"]
+    biblio_id = record["biblio_id"]
+    item_id = record["item_id"]
+    flickr_id = record["flickr_id"]
+    flickr_tags = record["flickr_tags"]
+
+    page_types = "; ".join(
+        [a.get("PageTypeName", "") for a in page_data[0].get("PageTypes", [])]
+    )
+    names = "; ".join(
+        list(
+            set(
+                name.get("NameCanonical", "")
+                for name in page_data[0].get("Names", [])
             )
         )
-        if page_data[0].get("PageNumbers", [{}]):
-            pagenumber_string = [
-                f"{a['Prefix']} {a['Number']}"
-                for a in page_data[0].get("PageNumbers", [])
-            ]
-            page_number_prefix = (
-                page_data[0].get("PageNumbers", [{}])[0].get("Prefix", "")
-            )
-            page_number_number = (
-                page_data[0].get("PageNumbers", [{}])[0].get("Number", "")
-            )
-        else:
-            pagenumber_string = ""
-            page_number_prefix = ""
-            page_number_number = ""
-        volume = page_data[0].get("Volume", "")
-        holding_institution = item_data[0].get("HoldingInstitution", "")
-        sponsor = item_data[0].get("Sponsor", "")
-        item_publication_date = item_data[0].get("Year", "")
-        copyright_status = item_data[0].get("CopyrightStatus")
-
-        if GET_FLICKR_TAGS:
-            flickr_tags = get_flickr_tags(flickr_id)
-        else:
-            flickr_tags = ""
-        is_extracted = False
-        if "{{Extracted from" in wikitext:
-            is_extracted = True
-        row = {
-            "File": file or "",
-            "BHL Page ID": bhl_page_id or "",
-            "Page Types": page_types or "",
-            "Page Number String": pagenumber_string or "",
-            "Page Number Prefix": page_number_prefix or "",
-            "Page Number Number": page_number_number or "",
-            "Published In QID": publication_qid or "",
-            "Collection": holding_institution or "",
-            "Sponsor": sponsor or "",
-            "Bibliography ID": biblio_id or "",
-            "Names": names or "",
-            "Item Publication Date": item_publication_date or "",
-            "Item ID": item_id or "",
-            "Flickr ID": flickr_id or "",
-            "Flickr Tags": flickr_tags or "",
-            "Copyright Status": copyright_status or "",
-            "Volume": volume or "",
-            "Is Extracted": is_extracted,
-        }
-
-        processed_counter += 1
-        rows.append(row)
-
-        # Periodically save progress, e.g., every 10 rows:
-        if RESUME and output_file:
-            if len(rows) % 10 == 0:
-                pd.DataFrame(rows).to_csv(output_file, sep="\t", index=False)
-
-    return rows
+    )
+    if page_data[0].get("PageNumbers", [{}]):
+        pagenumber_string = [
+            f"{a['Prefix']} {a['Number']}"
+            for a in page_data[0].get("PageNumbers", [])
+        ]
+        page_number_prefix = (
+            page_data[0].get("PageNumbers", [{}])[0].get("Prefix", "")
+        )
+        page_number_number = (
+            page_data[0].get("PageNumbers", [{}])[0].get("Number", "")
+        )
+    else:
+        pagenumber_string = ""
+        page_number_prefix = ""
+        page_number_number = ""
+    volume = page_data[0].get("Volume", "")
+    holding_institution = item_data[0].get("HoldingInstitution", "")
+    sponsor = item_data[0].get("Sponsor", "")
+    item_publication_date = item_data[0].get("Year", "")
+    copyright_status = item_data[0].get("CopyrightStatus")
+
+    is_extracted = record["is_extracted"]
+    row = {
+        "File": file or "",
+        "BHL Page ID": bhl_page_id or "",
+        "Page Types": page_types or "",
+        "Page Number String": pagenumber_string or "",
+        "Page Number Prefix": page_number_prefix or "",
+        "Page Number Number": page_number_number or "",
+        "Published In QID": publication_qid or "",
+        "Collection": holding_institution or "",
+        "Sponsor": sponsor or "",
+        "Bibliography ID": biblio_id or "",
+        "Names": names or "",
+        "Item Publication Date": item_publication_date or "",
+        "Item ID": item_id or "",
+        "Flickr ID": flickr_id or "",
+        "Flickr Tags": flickr_tags or "",
+        "Copyright Status": copyright_status or "",
+        "Volume": volume or "",
+        "Is Extracted": is_extracted,
+    }
+    return row
 
 
 # BHL API calls
@@ -280,59 +404,46 @@ def infer_bhl_page_id_from_ia_url(
       item_id = 'monographofjacam00scla'
       ia_page_number = 125
     and then calculates target_order = ia_page_number - offset.
+
+    Returns the BHL page ID, or None if it can't be determined.
     """
-    # Cache to store API results (local to this call; consider a module-level cache for efficiency)
-    global API_CACHE
     # Extract the IA item identifier from the URL.
     m_item = re.search(r"/stream/([^/]+)/", ia_url)
     if not m_item:
         print("Unable to extract IA item identifier from URL.")
-        return None, None, None
+        return None
     item_id = m_item.group(1)
 
     # Extract the IA page number from the URL; pattern like "page/n125"
     m_page = re.search(r"page/n(\d+)", ia_url)
     if not m_page:
         print("Unable to extract IA page number from URL.")
-        return None, None, None
+        return None
     ia_page_number = int(m_page.group(1))
 
     # Adjust the page number by the offset to get the target digital order.
     target_order = ia_page_number - offset
     if target_order < 1:
         print("Calculated target order is less than 1.")
-        return None, None, None
+        return None
 
-    # Check the cache for metadata
-    if item_id in API_CACHE:
-        data = API_CACHE[item_id]
+    if BHL_EXPORT is not None:
+        result = BHL_EXPORT.item_metadata_by_ia(item_id)
     else:
-        api_url = "https://www.biodiversitylibrary.org/api3"
-        params = {
-            "op": "GetItemMetadata",
-            "id": item_id,
-            "idtype": "ia",  # The id is an Internet Archive identifier.
-            "pages": "t",  # Include page metadata.
-            "format": "json",
-            "apikey": BHL_API_KEY,
-        }
-
-        response = requests.get(api_url, params=params)
-        if response.status_code != 200:
-            print("BHL API request failed with status code:", response.status_code)
-            return None, None, None
-
-        data = response.json()
-        if data.get("Status") != "ok":
-            print("BHL API returned an error:", data.get("ErrorMessage"))
-            return None, None, None
-
-        # Cache the result
-        API_CACHE[item_id] = data
-
-    # Get the list of pages from the API response.
+        result = call_bhl_api(
+            "GetItemMetadata:ia",
+            item_id,
+            {
+                "op": "GetItemMetadata",
+                "id": item_id,
+                "idtype": "ia",  # The id is an Internet Archive identifier.
+                "pages": "t",  # Include page metadata.
+            },
+        )
+    if result is None:
+        return None
+
     # The response's "Result" is assumed to be a list; we use the first element.
-    result = data.get("Result", [])
     if not result:
         print("No result in BHL API response.")
         return None
@@ -351,145 +462,199 @@ def infer_bhl_page_id_from_ia_url(
     return bhl_page_id
 
 
-# Impleement get_bhl_title_data with caching
+def call_bhl_api(operation, cache_key, params):
+    """
+    Calls the BHL API (api3), going through the on-disk BHL_CACHE first.
+
+    Returns the "Result" of the response, or None if the request failed.
+    Failed requests are not cached, so they are retried on the next run.
+    """
+    cached = BHL_CACHE.get(operation, cache_key)
+    METRICS.record_cache("bhl", operation, cached is not None)
+    if cached is not None:
+        return cached
+
+    params = {**params, "format": "json", "apikey": BHL_API_KEY}
+    response = http_get(BHL_API_URL, operation, params=params)
+    if response.status_code != 200:
+        print(
+            f"BHL API request {operation} failed for ID {cache_key}. HTTP Status Code: {response.status_code}"
+        )
+        return None
+
+    data = response.json()
+    if data.get("Status") != "ok":
+        print(f"BHL API returned an error for {operation} {cache_key}:", data.get("ErrorMessage"))
+        return None
+
+    result = data.get("Result", [])
+    BHL_CACHE.set(operation, cache_key, result)
+    return result
 
 
 def get_bhl_title_data(biblio_id):
-    global API_CACHE
-    if biblio_id in API_CACHE:
-        return API_CACHE["biblio_ids"][biblio_id]
-    api_url = "https://www.biodiversitylibrary.org/api3"
-    params = {
-        "op": "GetTitleMetadata",
-        "id": biblio_id,
-        "format": "json",
-        "apikey": BHL_API_KEY,
-    }
-    response = requests.get(api_url, params=params)
-    if response.status_code == 200:
-        title_data = response.json().get("Result", {})
+    if BHL_EXPORT is not None:
+        title_data = BHL_EXPORT.title_metadata(biblio_id) or None
     else:
-        print(
-            f"Failed to fetch BHL title metadata for Title ID {biblio_id}. HTTP Status Code: {response.status_code}"
+        title_data = call_bhl_api(
+            "GetTitleMetadata", biblio_id, {"op": "GetTitleMetadata", "id": biblio_id}
         )
-        title_data = {}
+    if title_data is None:
+        print(f"Failed to fetch BHL title metadata for Title ID {biblio_id}.")
+        return {}
     return title_data
 
 
 def get_bhl_item_data(item_id):
-    global API_CACHE
-    if item_id in API_CACHE:
-        return API_CACHE["item_ids"][item_id]
-    api_url = "https://www.biodiversitylibrary.org/api3"
-    params = {
-        "op": "GetItemMetadata",
-        "id": item_id,
-        "idtype": "bhl",
-        "format": "json",
-        "apikey": BHL_API_KEY,
-    }
-    response = requests.get(api_url, params=params)
-    if response.status_code == 200:
-        item_data = response.json().get("Result", {})
+    if BHL_EXPORT is not None:
+        item_data = BHL_EXPORT.item_metadata(item_id) or None
     else:
-        print(
-            f"Failed to fetch BHL item metadata for Item ID {item_id}. HTTP Status Code: {response.status_code}"
+        item_data = call_bhl_api(
+            "GetItemMetadata",
+            item_id,
+            {"op": "GetItemMetadata", "id": item_id, "idtype": "bhl"},
         )
-        item_data = {}
+    if item_data is None:
+        print(f"Failed to fetch BHL item metadata for Item ID {item_id}.")
+        return {}
     return item_data
 
 
 def get_bhl_page_data(bhl_page_id):
-    api_url = "https://www.biodiversitylibrary.org/api3"
-    params = {
-        "op": "GetPageMetadata",
-        "pageid": bhl_page_id,
-        "ocr": "false",
-        "names": "true",
-        "format": "json",
-        "apikey": BHL_API_KEY,
-    }
-    response = requests.get(api_url, params=params)
-
-    if response.status_code == 200:
-        page_data = response.json().get("Result", {})
+    if BHL_EXPORT is not None:
+        page_data = BHL_EXPORT.page_metadata(bhl_page_id) or None
     else:
-        print(
-            f"Failed to fetch BHL page metadata for Page ID {bhl_page_id}. HTTP Status Code: {response.status_code}"
+        page_data = call_bhl_api(
+            "GetPageMetadata",
+            bhl_page_id,
+            {
+                "op": "GetPageMetadata",
+                "pageid": bhl_page_id,
+                "ocr": "false",
+                "names": "true",
+            },
         )
-        page_data = {}
+    if page_data is None:
+        print(f"Failed to fetch BHL page metadata for Page ID {bhl_page_id}.")
+        return {}
     return page_data
 
 
-# Flickr API calls
-def get_flickr_tags(photo_id):
-    API_ENDPOINT = "https://www.flickr.com/services/rest/"
-    params = {
-        "method": "flickr.tags.getListPhoto",
-        "api_key": FLICKR_API_KEY,
-        "photo_id": photo_id,
-        "format": "json",
-        "nojsoncallback": 1,  # Prevent JSONP callback, get plain JSON
-    }
-    response = requests.get(API_ENDPOINT, params=params)
-    tag_raw_content = []
-    if response.status_code == 200:
-        data = response.json()
-        if data.get("stat") == "ok":
-            print("Tags for Photo ID", photo_id)
-            tags = data["photo"]["tags"]["tag"]
-            for tag in tags:
-                print(f"- {tag['raw']}")
-                tag_raw_content.append(tag["raw"])
-        else:
-            print("Error:", data.get("message"))
-    else:
-        print("Failed to fetch tags. HTTP Status Code:", response.status_code)
-    return tag_raw_content
+def prefetch_bhl_item(item_id):
+    """
+    Fetches an item with all of its pages and their names, and fills the
+    GetItemMetadata and GetPageMetadata cache entries from it.
 
+    Pages that come back without a "Names" list are left out, so they are
+    still fetched with GetPageMetadata. Returns the item record, or None.
+    """
+    result = call_bhl_api(
+        "GetItemMetadata:pages",
+        item_id,
+        {"op": "GetItemMetadata", "id": item_id, "idtype": "bhl", "pages": "t", "names": "t"},
+    )
+    if not result:
+        return None
+    item = dict(result[0])
+    pages = item.pop("Pages", None) or []
+    if ("GetItemMetadata", item_id) not in BHL_CACHE:
+        BHL_CACHE.set("GetItemMetadata", item_id, [item])
+    for page in pages:
+        if page.get("PageID") is None or "Names" not in page:
+            continue
+        if ("GetPageMetadata", page["PageID"]) not in BHL_CACHE:
+            BHL_CACHE.set("GetPageMetadata", page["PageID"], [page])
+    return item
 
-# Text processing functions
+
+def prefetch_bhl_records(scanned):
+    """
+    Prefetch stage for a batch of (file, scan_wikitext record) pairs.
+
+    The first uncached page of each item is fetched on its own, to learn its
+    item; the item is then fetched once with all of its pages, which fills
+    the cache for the other pages. Each title is fetched once. BHL requests
+    scale with the number of items rather than the number of files.
+    """
+    items = set()
+    titles = set()
+    for file, wikitext_ids in scanned:
+        bhl_page_id = extract_bhl_page_id(wikitext_ids)
+        if not bhl_page_id or ("GetPageMetadata", bhl_page_id) in BHL_CACHE:
+            continue
+        page_data = get_bhl_page_data(str(bhl_page_id))
+        if not page_data or not page_data[0]:
+            continue
+        item_id = page_data[0].get("ItemID")
+        if item_id is None or item_id in items:
+            continue
+        items.add(item_id)
+        item = prefetch_bhl_item(item_id)
+        title_id = item.get("TitleID") if item else None
+        if title_id is not None and title_id not in titles:
+            titles.add(title_id)
+            get_bhl_title_data(title_id)
+
+
+def serial_records(files, window_size=WINDOW_SIZE):
+    """Yields fetch_file_record for each file, prefetching BHL items per window."""
+    for start in range(0, len(files), window_size):
+        scanned = [
+            (file, scan_wikitext(wikitext))
+            for file, wikitext in get_commons_wikitexts(files[start : start + window_size])
+        ]
+        if BHL_ITEM_PREFETCH:
+            prefetch_bhl_records(scanned)
+        for file, wikitext_ids in scanned:
+            yield fetch_file_record(file, wikitext_ids)
+
+
+# Flickr API calls
+def get_flickr_tags(photo_id):
+    """Raw Flickr tags of a photo, from the local tag store or else the Flickr API."""
+    if not photo_id:
+        return []
+    store = get_flickr_tag_store()
+    tags = store.get(photo_id)
+    METRICS.record_cache("flickr_tags", "flickr.tags.getListPhoto", tags is not None)
+    if tags is not None:
+        return tags
+    tags = fetch_flickr_tags(photo_id, FLICKR_API_KEY)
+    if tags is None:
+        return []
+    store.set(photo_id, tags)
+    return tags
+
+
+# Text processing functions (see wikitext_ids.py for the scan itself)
 def find_page_id_in_bhl_template(wikitext):
-    if not wikitext:
-        return {"pageid": ""}
-    m = re.search(r"\|\s*pageid\s*=\s*(\d+)", wikitext)
-    if m:
-        return m.group(1).strip()
-    return ""
+    return scan_wikitext(wikitext)["pageid"]
 
 
-def infer_bhl_page_id_from_ia_via_wikitext(wikitext, offset):
-    m = re.search(r"https://archive\.org/stream/([^#]+)#page/n(\d+)", wikitext)
-    if m:
-        ia_url = m.group(0)  # The full URL.
-        inferred_page_id = infer_bhl_page_id_from_ia_url(ia_url, offset)
+def infer_bhl_page_id_from_ia_ids(ids, offset):
+    if ids["ia_url"]:
+        inferred_page_id = infer_bhl_page_id_from_ia_url(ids["ia_url"], offset)
         if inferred_page_id:
             return str(inferred_page_id)
     return ""
 
 
+def infer_bhl_page_id_from_ia_via_wikitext(wikitext, offset):
+    return infer_bhl_page_id_from_ia_ids(scan_wikitext(wikitext), offset)
+
+
+def get_page_from_flickr_id(flickr_id):
+    if not flickr_id:
+        return ""
+    return get_bhl_flickr_index().page_for_photo(flickr_id)
+
+
 def get_page_from_flickr_id_via_wikitext(wikitext):
-    m = re.search(r"https://www\.flickr\.com/photos/biodivlibrary/(\d+)", wikitext)
-    if m:
-        flickr_id = m.group(1)
-        flickr_id = flickr_id.split("/")[0]  # Remove any additional URL components.
-
-        # Check the reverse of the BHL_TO_FLICKR_DICT to see if we have a mapping.
-    if flickr_id in BHL_TO_FLICKR_DICT.values():
-        bhl_page_id = next(
-            key for key, value in BHL_TO_FLICKR_DICT.items() if value == flickr_id
-        )
-    return bhl_page_id
+    return get_page_from_flickr_id(scan_wikitext(wikitext)["flickr_id"])
 
 
 def search_for_bhl_urls(wikitext):
-    bhl_ids = re.findall(r"biodiversitylibrary\.org/page/(\d+)", wikitext)
-    bhl_ids += re.findall(r"biodiversitylibrary\.org/pageimage/(\d+)", wikitext)
-    if len(set(bhl_ids)) == 1:
-        bhl_page_id = bhl_ids[0]
-    else:
-        bhl_page_id = ""
-    return bhl_page_id
+    return single_bhl_url_page_id(scan_wikitext(wikitext))
 
 
 # Main logic
@@ -502,6 +667,17 @@ if __name__ == "__main__":
     parser.add_argument(
         "--category_raw", type=str, help="Specify the raw category name."
     )
+    parser.add_argument(
+        "--async_mode",
+        action="store_true",
+        help="Fetch metadata for many files concurrently (per-host limits apply).",
+    )
+    parser.add_argument(
+        "--offline_bhl",
+        "--offline-bhl",
+        action="store_true",
+        help="Read BHL metadata from the local data-export index (see bhl_export.py).",
+    )
     args = parser.parse_args()
 
     if args.auto_mode:
@@ -522,8 +698,17 @@ if __name__ == "__main__":
     output_file = DATA / f"{CATEGORY_NAME.replace(' ', '_')}.tsv"
     print(f"Generating metadata for category: {CATEGORY_NAME}")
     data = generate_metadata(
-        CATEGORY_NAME, output_file=output_file, config=config, auto_mode=args.auto_mode
+        CATEGORY_NAME,
+        output_file=output_file,
+        config=config,
+        auto_mode=args.auto_mode,
+        async_mode=args.async_mode,
+        offline_bhl=args.offline_bhl,
+    )
+    # generate_metadata compacts its checkpoint journal into output_file.
+    print(f"Data written to: {output_file} ({len(data)} rows)")
+    export_run_metrics(
+        "harvest",
+        DATA / "metrics" / f"{CATEGORY_NAME.replace(' ', '_')}_harvest.json",
+        config.get("METRICS_TEXTFILE_DIR"),
     )
-    df = pd.DataFrame(data)
-    df.to_csv(output_file, sep="\t", index=False)
-    print(f"Data written to: {output_file}")
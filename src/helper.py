@@ -1,6 +1,8 @@
 import requests
 import json
 import logging
+import re
+import unicodedata
 
 from wikibaseintegrator.datatypes import Item, ExternalID, Time, URL, String
 from wikibaseintegrator.models import Qualifiers, References, Reference
@@ -10,17 +12,33 @@ from wdcuration import add_key_and_save_to_independent_dict, lookup_id
 from wikibaseintegrator import wbi_enums
 
 import random
+import threading
 from pathlib import Path
 
+from category_tree import crawl_category_tree, files_in_tree
+from http_metrics import METRICS, http_get
+from disk_cache import DiskCache
+
 
 HERE = Path(__file__).parent
 DATA = HERE / "data"
 DICTS = HERE / "dicts"
 LIST_OF_PLATE_PREFIXES = ["Pl.", "Tab.", "Taf."]
 INSTITUTIONS_DICT = json.loads(DICTS.joinpath("institutions.json").read_text())
+# Upload workers share INSTITUTIONS_DICT, and adding a key may prompt the user.
+INSTITUTIONS_LOCK = threading.Lock()
 
 COMMONS_API_ENDPOINT = "https://commons.wikimedia.org/w/api.php"
 
+# GBIF name matches and their Wikidata QIDs, shared across runs.
+GBIF_CACHE = DiskCache(
+    DATA / "cache" / "gbif_names.sqlite", ttl_seconds=90 * 24 * 60 * 60
+)
+
+# When True (upload.py --dry_run), the builders only use local data: GBIF
+# names, VIAF IDs and institutions that are not cached yet are not looked up.
+OFFLINE = False
+
 logging.basicConfig(level=logging.INFO)
 
 
@@ -52,7 +70,11 @@ def get_artist_qids_from_flickr_tags(flickr_tags):
         elif "artist:viaf" in tag:
             # remove all non-alphanumeric characters
             viaf = tag.split("artist:viaf=")[1].strip().replace("'", "")
-            qid = lookup_id(viaf, "P214")
+            if OFFLINE:
+                logging.warning(f"Offline: not looking up VIAF ID {viaf}")
+                continue
+            with METRICS.timed("query.wikidata.org", "lookup_id:P214"):
+                qid = lookup_id(viaf, "P214")
             if qid:
                 qids.append(qid)
     return qids
@@ -87,7 +109,25 @@ def get_species_names_from_flickr_binomial_tags(flickr_tags):
     return names
 
 
-def add_depicts_claim(row, new_statements, media):
+def is_likely_a_crop(row, file_name):
+    bhl_page_id = row["BHL Page ID"].strip()
+    try:
+        flickr_id = row["Flickr ID"].strip()
+    except:
+        flickr_id = ""
+
+    file_is_likely_a_crop = True  # Assume it is a crop for safety
+
+    if bhl_page_id in file_name:
+        file_is_likely_a_crop = False
+    if flickr_id != "" and flickr_id not in file_name:
+        file_is_likely_a_crop = False
+    if "(cropped)" in file_name:
+        file_is_likely_a_crop = True
+    return file_is_likely_a_crop
+
+
+def add_depicts_claim(row, new_statements, claim_index):
 
     rank = "preferred"
     bhl_names = row.get("Names", "").strip().split("; ")
@@ -98,13 +138,7 @@ def add_depicts_claim(row, new_statements, media):
     ):  # Avoid adding depicts statements for extracted images; some are e.g monograms
         return
 
-    current_p180_qids = []
-    claims_in_media = media.claims.get_json()
-    if "P180" in claims_in_media:
-        p180_values = claims_in_media["P180"]
-        current_p180_qids = [
-            value["mainsnak"]["datavalue"]["value"]["id"] for value in p180_values
-        ]
+    current_p180_qids = claim_index.values("P180")
 
     if bhl_names:
         bhl_page_id = row.get("BHL Page ID", "").strip()
@@ -224,7 +258,7 @@ def add_creator_statements(row, new_statements):
         new_statements.append(claim_creator_artist)
 
 
-def add_public_domain_statement(row, media, new_statements):
+def add_public_domain_statement(row, media, claim_index, new_statements):
     copyright_status = row.get("Copyright Status", "")
     if (
         copyright_status == "NOT_IN_COPYRIGHT"
@@ -247,28 +281,23 @@ def add_public_domain_statement(row, media, new_statements):
             prop_nr="P6216", value=copyright_status_qid, references=references
         )
         # Remove lingering "copyrighted" or "cc-by" statements:
-        claims_p6216 = media.claims.get("P6216")
-        for claim in claims_p6216:
-            claim_p6216_id = claim.mainsnak.datavalue.get("value").get("id")
-            if claim_p6216_id and claim_p6216_id != "Q19652":
+        if claim_index.values("P6216") - {copyright_status_qid}:
+            claims_p6216 = media.claims.get("P6216")
+            for claim in claims_p6216:
+                claim_p6216_id = claim.mainsnak.datavalue.get("value").get("id")
+                if claim_p6216_id and claim_p6216_id != "Q19652":
+                    claim.remove()
+
+        if "P275" in claim_index:
+            claims_p275 = media.claims.get("P275")
+            for claim in claims_p275:
                 claim.remove()
-
-        claims_p275 = media.claims.get("P275")
-        for claim in claims_p275:
-            claim.remove()
         new_statements.append(copyright_status_claim)
 
 
-def add_inception_claim(row, media, new_statements):
+def add_inception_claim(row, claim_index, new_statements):
     inception_str = row.get("Item Publication Date", "").strip()
-    claims_in_media = media.claims.get_json()
-    current_p571_dates = []
-    if "P571" in claims_in_media:
-        p571_values = claims_in_media["P571"]
-        current_p571_dates = [
-            value["mainsnak"]["datavalue"]["value"]["time"][1:5]
-            for value in p571_values
-        ]
+    current_p571_dates = {time[1:5] for time in claim_index.values("P571")}
 
     if inception_str and inception_str not in current_p571_dates:
         if len(inception_str) != 4 or not inception_str.isdigit():
@@ -398,12 +427,19 @@ def add_collection_claim(row, new_statements):
 
 
 def get_institution_as_a_qid(collection):
+    with INSTITUTIONS_LOCK:
+        return _get_institution_as_a_qid(collection)
+
+
+def _get_institution_as_a_qid(collection):
     global INSTITUTIONS_DICT
     if collection in INSTITUTIONS_DICT:
         collection = INSTITUTIONS_DICT[collection]
 
         # test if collection is a QID
     if not collection.startswith("Q"):
+        if OFFLINE:
+            raise ValueError(f"Offline: no QID known for institution '{collection}'")
         INSTITUTIONS_DICT = add_key_and_save_to_independent_dict(
             dictionary=INSTITUTIONS_DICT,
             dictionary_path=DICTS.joinpath("institutions.json"),
@@ -413,10 +449,10 @@ def get_institution_as_a_qid(collection):
     return collection
 
 
-def add_instance_claim(row, new_statements, media):
+def add_instance_claim(row, new_statements, claim_index):
 
     # By default, skip adding instances if some instance is present
-    if "P31" in media.claims.get_json():
+    if "P31" in claim_index:
         return 1
 
     page_type_to_qid = {
@@ -450,21 +486,11 @@ def add_instance_claim(row, new_statements, media):
             return 1
 
 
-def add_published_in_claim(row, new_statements, media):
+def add_published_in_claim(row, new_statements, claim_index):
     # Test
     published_in = row.get("Published In QID", "").strip()
-    claims = media.claims.get_json()
-    if "P1433" in claims:
-        for publication_entry in claims["P1433"]:
-            try:
-
-                if (
-                    publication_entry["mainsnak"]["datavalue"]["value"]["id"]
-                    == published_in
-                ):
-                    return 1
-            except:
-                continue
+    if claim_index.has("P1433", published_in):
+        return 1
     if published_in:
         qualifiers = Qualifiers()
         qualifiers.add(Item(prop_nr="P518", value="Q112134971"))  # analog work
@@ -510,51 +536,14 @@ def generate_custom_edit_summary():
 
 
 def get_files_in_category(category_name, include_subcategories=False):
-    files = []
-    # Get files in the current category
-    params = {
-        "action": "query",
-        "list": "categorymembers",
-        "cmtitle": f"Category:{category_name}",
-        "cmtype": "file",
-        "cmlimit": "max",
-        "format": "json",
-    }
-    try:
-        r = requests.get(COMMONS_API_ENDPOINT, params=params)
-        data = r.json()
-        files += [
-            member["title"].replace("File:", "")
-            for member in data.get("query", {}).get("categorymembers", [])
-        ]
-    except Exception:
-        pass
-
-    # If requested, get files from subcategories as well
-    if include_subcategories:
-        subcat_params = {
-            "action": "query",
-            "list": "categorymembers",
-            "cmtitle": f"Category:{category_name}",
-            "cmtype": "subcat",
-            "cmlimit": "max",
-            "format": "json",
-        }
-        try:
-            r = requests.get(COMMONS_API_ENDPOINT, params=subcat_params)
-            data = r.json()
-            subcategories = data.get("query", {}).get("categorymembers", [])
-            for subcat in subcategories:
-                # Remove the "Category:" prefix to get the clean category name
-                subcat_name = subcat["title"].replace("Category:", "")
-                # Recursively get files from this subcategory (including its subcategories)
-                files.extend(
-                    get_files_in_category(subcat_name, include_subcategories=True)
-                )
-        except Exception:
-            pass
-
-    return files
+    snapshot_path = DATA / "category_trees" / f"{category_name.replace(' ', '_')}.json"
+    tree = crawl_category_tree(
+        category_name,
+        include_subcategories=include_subcategories,
+        snapshot_path=snapshot_path,
+        endpoint=COMMONS_API_ENDPOINT,
+    )
+    return files_in_tree(tree, category_name, include_subcategories)
 
 
 def get_commons_wikitext(filename):
@@ -568,7 +557,7 @@ def get_commons_wikitext(filename):
         "format": "json",
     }
     try:
-        r = requests.get(COMMONS_API_ENDPOINT, params=params)
+        r = http_get(COMMONS_API_ENDPOINT, "query:revisions", params=params)
         data = r.json()
         pages = data.get("query", {}).get("pages", [])
         if not pages or "missing" in pages[0]:
@@ -578,6 +567,93 @@ def get_commons_wikitext(filename):
         return ""
 
 
+def _pages_by_requested_title(data, titles):
+    """Maps each requested title to its page entry, following API title normalization."""
+    query = data.get("query", {})
+    renamed = {entry["to"]: entry["from"] for entry in query.get("normalized", [])}
+    pages = {}
+    for page in query.get("pages", []):
+        title = renamed.get(page.get("title"), page.get("title"))
+        pages[title] = page
+    return pages
+
+
+def get_commons_wikitexts(filenames, batch_size=50):
+    """
+    Batched version of get_commons_wikitext.
+
+    Sends up to `batch_size` titles (50 is the API limit for regular users)
+    per action=query&prop=revisions request and yields (file, wikitext) pairs
+    in the same order as `filenames`. Missing files yield an empty wikitext.
+    """
+    filenames = list(filenames)
+    for start in range(0, len(filenames), batch_size):
+        batch = filenames[start : start + batch_size]
+        titles = ["File:" + filename for filename in batch]
+        params = {
+            "action": "query",
+            "prop": "revisions",
+            "titles": "|".join(titles),
+            "rvslots": "main",
+            "rvprop": "content",
+            "formatversion": "2",
+            "format": "json",
+        }
+        contents = {}
+        try:
+            # Large batches may be split by the API; follow rvcontinue until done.
+            while True:
+                r = http_get(COMMONS_API_ENDPOINT, "query:revisions", params=params)
+                data = r.json()
+                for title, page in _pages_by_requested_title(data, titles).items():
+                    revisions = page.get("revisions")
+                    if revisions:
+                        contents[title] = revisions[0]["slots"]["main"]["content"]
+                if "continue" not in data:
+                    break
+                params = {**params, **data["continue"]}
+        except Exception as e:
+            logging.error(f"Batched wikitext request failed: {e}")
+        for filename, title in zip(batch, titles):
+            yield filename, contents.get(title, "")
+
+
+def get_category_wikitexts(category_name, batch_size=50):
+    """
+    Yields (file, wikitext) pairs for the files directly in a category.
+
+    Uses generator=categorymembers so that listing the category and fetching
+    the content come back in the same requests.
+    """
+    params = {
+        "action": "query",
+        "generator": "categorymembers",
+        "gcmtitle": f"Category:{category_name}",
+        "gcmtype": "file",
+        "gcmlimit": batch_size,
+        "prop": "revisions",
+        "rvslots": "main",
+        "rvprop": "content",
+        "formatversion": "2",
+        "format": "json",
+    }
+    while True:
+        r = http_get(COMMONS_API_ENDPOINT, "categorymembers:revisions", params=params)
+        data = r.json()
+        for page in data.get("query", {}).get("pages", []):
+            revisions = page.get("revisions")
+            if not revisions:
+                # Content for this page will come in a continuation response.
+                continue
+            yield (
+                page["title"].replace("File:", "", 1),
+                revisions[0]["slots"]["main"]["content"],
+            )
+        if "continue" not in data:
+            break
+        params = {**params, **data["continue"]}
+
+
 def get_media_info_id(file_name):
     API_URL = "https://commons.wikimedia.org/w/api.php"
     if "File:" in file_name:
@@ -589,7 +665,7 @@ def get_media_info_id(file_name):
         "format": "json",
     }
     try:
-        response = requests.get(API_URL, params=params)
+        response = http_get(API_URL, "query:info", params=params)
         data = response.json()
         pages = data.get("query", {}).get("pages", {})
         if not pages:
@@ -604,22 +680,72 @@ def get_media_info_id(file_name):
         return f"Error: API request failed. {e}"
 
 
-def get_wikidata_qid_from_gbif(name):
+def normalize_taxon_name(name):
+    """
+    Cache key for a scientific name: case, whitespace and stray punctuation
+    are ignored, so "Psittacus  cyanogaster." and "psittacus cyanogaster" match.
+    """
+    name = unicodedata.normalize("NFKC", str(name))
+    name = re.sub(r"[^\w\s-]", " ", name)
+    return " ".join(name.split()).lower()
+
+
+def match_name_on_gbif(name):
+    """
+    Matches a name on GBIF and resolves the species to a Wikidata QID (P846).
+
+    Results, including names without a match or QID, are kept in GBIF_CACHE.
+    Returns None, caching nothing, if GBIF or Wikidata could not be reached.
+    """
+    key = normalize_taxon_name(name)
+    cached = GBIF_CACHE.get("species_match", key)
+    METRICS.record_cache("gbif", "species_match", cached is not None)
+    if cached is not None:
+        return cached
+    if OFFLINE:
+        logging.warning(f"Offline: '{name}' is not in the GBIF cache")
+        return None
+
     # GBIF species match endpoint
-    url = "http://api.gbif.org/v1/species/match"
-    params = {"name": name}
+    url = "https://api.gbif.org/v1/species/match"
+    params = {"name": " ".join(str(name).split())}
 
-    response = requests.get(url, params=params)
+    response = http_get(url, "species/match", params=params)
     if response.status_code != 200:
         print("Error: Unable to reach GBIF API")
-        return
+        return None
 
     data = response.json()
     gbif_id = data.get("speciesKey")
-    qid = lookup_id(gbif_id, property="P846")
+    qid = ""
+    if gbif_id:
+        try:
+            with METRICS.timed("query.wikidata.org", "lookup_id:P846"):
+                qid = lookup_id(gbif_id, property="P846")
+        except Exception as e:
+            # Not cached: a failed lookup is not the same as "no QID".
+            logging.warning(f"Wikidata lookup failed for GBIF {gbif_id} ('{name}'): {e}")
+            return None
+    match = {
+        "name": name,
+        "speciesKey": gbif_id,
+        "matchType": data.get("matchType"),
+        "synonym": data.get("synonym", False),
+        "species": data.get("species"),
+        "qid": qid or "",
+    }
+    GBIF_CACHE.set("species_match", key, match)
+    return match
+
+
+def get_wikidata_qid_from_gbif(name):
+    match = match_name_on_gbif(name)
+    if match is None:
+        return
+    qid = match["qid"]
     # If GBIF identifies the name as a synonym, it returns "synonym": true
-    if data.get("synonym", False):
-        current_species_name = data.get("species")
+    if match["synonym"]:
+        current_species_name = match["species"]
         if current_species_name:
             print(
                 f"'{name}' is a synonym. The current accepted name is: {current_species_name}"
@@ -629,3 +755,48 @@ def get_wikidata_qid_from_gbif(name):
         print(f"Error: Unable to find Wikidata QID for '{name}'")
         return ""
     return qid
+
+
+def build_statements(row, file_name, media, claim_index):
+    """
+    Runs the add_* builders for one TSV row.
+
+    Returns (groups, had_minimum_data): groups is a list of (ActionIfExists,
+    [statements]) to add, in order. Files that already have the minimal
+    statements only get depicts and the public domain statement.
+    """
+    file_is_likely_a_crop = is_likely_a_crop(row, file_name)
+    new_statements = []
+
+    # skipping most info if mimimum statements are in (instance of, published in, bhl page id, collection, sponsor)
+    minimal_statements = ["P31", "P1433", "P687", "P195", "P859"]
+    if all(claim in claim_index for claim in minimal_statements):
+        # Always adding depicts information (unless file is a crop)
+        if not file_is_likely_a_crop:
+            add_depicts_claim(row, new_statements, claim_index)
+
+        # Always adding public domain statement, replacing all other information
+        public_domain_statements = []
+        add_public_domain_statement(row, media, claim_index, public_domain_statements)
+        return [
+            (wbi_enums.ActionIfExists.MERGE_REFS_OR_APPEND, new_statements),
+            (wbi_enums.ActionIfExists.REPLACE_ALL, public_domain_statements),
+        ], True
+
+    add_instance_claim(row, new_statements, claim_index)
+    add_public_domain_statement(row, media, claim_index, new_statements)
+    add_published_in_claim(row, new_statements, claim_index)
+    add_collection_claim(row, new_statements)
+    if row["Sponsor"] == "":
+        add_blank_sponsor(row, new_statements)
+    add_digital_sponsor_claim(row, new_statements)
+    add_bhl_id_claim(row, new_statements)
+    add_flickr_id_claim(row, new_statements)
+
+    if not file_is_likely_a_crop:
+        if row.get("Page Types", "") == "Illustration":
+            add_creator_statements(row, new_statements)
+            add_depicts_claim(row, new_statements, claim_index)
+
+    add_inception_claim(row, claim_index, new_statements)
+    return [(wbi_enums.ActionIfExists.MERGE_REFS_OR_APPEND, new_statements)], False
@@ -0,0 +1,302 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
+
+from rate_limits import host_limit
+
+# Instrumentation for outgoing API calls.
+#
+# Network calls go through http_get(url, operation, ...), which applies the
+# per-host limit from rate_limits.py and records, for each (host, operation):
+# a latency histogram, status codes, bytes received and errors. Latency is
+# timed from when the limiter lets the request through; the time spent
+# waiting for it has a histogram of its own. Calls that
+# don't use `requests` directly (SPARQL through wdcuration) are wrapped in
+# `with METRICS.timed(host, operation):`. Caches report hits and misses with
+# METRICS.record_cache(). At the end of a run the totals can be written as a
+# JSON summary and as a Prometheus textfile (node_exporter textfile collector).
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_PREFIX = "bhl_sdc"
+
+
+class _EndpointStats:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.statuses = {}
+        self.bytes = 0
+        self.errors = 0
+        self.wait_bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.wait_seconds = 0.0
+
+    def observe(self, seconds, status, n_bytes):
+        self.bucket_counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes += n_bytes
+        if status == "error" or (isinstance(status, int) and status >= 400):
+            self.errors += 1
+
+    def observe_wait(self, seconds):
+        self.wait_bucket_counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.wait_seconds += seconds
+
+    def quantile(self, q):
+        """Upper bound of the histogram bucket holding the q-th quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS, self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return self.max_seconds
+
+    def summary(self):
+        return {
+            "requests": self.count,
+            "errors": self.errors,
+            "statuses": {str(status): n for status, n in sorted(self.statuses.items(), key=str)},
+            "bytes": self.bytes,
+            "seconds_total": round(self.total_seconds, 3),
+            "seconds_mean": round(self.total_seconds / self.count, 4) if self.count else None,
+            "seconds_p50": self.quantile(0.5),
+            "seconds_p95": self.quantile(0.95),
+            "seconds_max": round(self.max_seconds, 4),
+            "latency_buckets": dict(
+                zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], self.bucket_counts)
+            ),
+            "limiter_wait_seconds_total": round(self.wait_seconds, 3),
+            "limiter_wait_buckets": dict(
+                zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], self.wait_bucket_counts)
+            ),
+        }
+
+
+class HttpMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+            self.caches = {}
+            self.started = time.time()
+
+    def observe(self, host, operation, seconds, status, n_bytes=0):
+        with self._lock:
+            stats = self.endpoints.setdefault((host, operation), _EndpointStats())
+            stats.observe(seconds, status, n_bytes)
+
+    def observe_wait(self, host, operation, seconds):
+        """Time a request waited for its per-host limit before being sent."""
+        with self._lock:
+            stats = self.endpoints.setdefault((host, operation), _EndpointStats())
+            stats.observe_wait(seconds)
+
+    def record_cache(self, cache, operation, hit):
+        with self._lock:
+            counts = self.caches.setdefault((cache, operation), {"hits": 0, "misses": 0})
+            counts["hits" if hit else "misses"] += 1
+
+    @contextmanager
+    def timed(self, host, operation):
+        """Times a call made without `requests`; an exception counts as an error."""
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            self.observe(host, operation, time.perf_counter() - start, status)
+
+    def summary(self):
+        with self._lock:
+            endpoints = {}
+            for (host, operation), stats in sorted(self.endpoints.items()):
+                endpoints.setdefault(host, {})[operation] = stats.summary()
+            caches = {}
+            for (cache, operation), counts in sorted(self.caches.items()):
+                total = counts["hits"] + counts["misses"]
+                caches.setdefault(cache, {})[operation] = {
+                    **counts,
+                    "hit_rate": round(counts["hits"] / total, 3) if total else None,
+                }
+            return {
+                "started": self.started,
+                "duration_seconds": round(time.time() - self.started, 3),
+                "endpoints": endpoints,
+                "caches": caches,
+            }
+
+    def write_json(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.summary(), indent=2))
+
+    def write_prometheus_textfile(self, path):
+        """Writes the metrics in Prometheus text format, atomically (as the textfile collector expects)."""
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+
+        def labels(**values):
+            escaped = {
+                key: str(value).replace("\\", "\\\\").replace('"', '\\"')
+                for key, value in values.items()
+            }
+            return "{" + ",".join(f'{key}="{value}"' for key, value in escaped.items()) + "}"
+
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            caches = sorted(self.caches.items())
+
+            metric("http_request_duration_seconds", "histogram", "Latency of outgoing API requests.")
+            for (host, operation), stats in endpoints:
+                cumulative = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), stats.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(
+                        f"{METRIC_PREFIX}_http_request_duration_seconds_bucket"
+                        f"{labels(host=host, operation=operation, le=bound)} {cumulative}"
+                    )
+                lines.append(
+                    f"{METRIC_PREFIX}_http_request_duration_seconds_sum"
+                    f"{labels(host=host, operation=operation)} {stats.total_seconds}"
+                )
+                lines.append(
+                    f"{METRIC_PREFIX}_http_request_duration_seconds_count"
+                    f"{labels(host=host, operation=operation)} {stats.count}"
+                )
+
+            metric(
+                "http_limiter_wait_seconds",
+                "histogram",
+                "Time outgoing API requests waited for their per-host limit.",
+            )
+            for (host, operation), stats in endpoints:
+                cumulative = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), stats.wait_bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(
+                        f"{METRIC_PREFIX}_http_limiter_wait_seconds_bucket"
+                        f"{labels(host=host, operation=operation, le=bound)} {cumulative}"
+                    )
+                lines.append(
+                    f"{METRIC_PREFIX}_http_limiter_wait_seconds_sum"
+                    f"{labels(host=host, operation=operation)} {stats.wait_seconds}"
+                )
+                lines.append(
+                    f"{METRIC_PREFIX}_http_limiter_wait_seconds_count"
+                    f"{labels(host=host, operation=operation)} {cumulative}"
+                )
+
+            metric("http_requests_total", "counter", "Outgoing API requests by status.")
+            for (host, operation), stats in endpoints:
+                for status, n in sorted(stats.statuses.items(), key=str):
+                    lines.append(
+                        f"{METRIC_PREFIX}_http_requests_total"
+                        f"{labels(host=host, operation=operation, status=status)} {n}"
+                    )
+
+            metric("http_response_bytes_total", "counter", "Bytes received from APIs.")
+            for (host, operation), stats in endpoints:
+                lines.append(
+                    f"{METRIC_PREFIX}_http_response_bytes_total"
+                    f"{labels(host=host, operation=operation)} {stats.bytes}"
+                )
+
+            metric("cache_lookups_total", "counter", "Cache lookups by result.")
+            for (cache, operation), counts in caches:
+                for result, key in (("hit", "hits"), ("miss", "misses")):
+                    lines.append(
+                        f"{METRIC_PREFIX}_cache_lookups_total"
+                        f"{labels(cache=cache, operation=operation, result=result)} {counts[key]}"
+                    )
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        tmp_path.write_text("\n".join(lines) + "\n")
+        tmp_path.replace(path)
+
+    def print_summary(self):
+        """Prints one line per host: requests, errors, time spent (and waited) and cache hit rates."""
+        summary = self.summary()
+        print(
+            f"{'Host':<32}{'Requests':>10}{'Errors':>8}{'Total s':>10}{'Mean s':>9}{'p95 s':>8}{'Wait s':>9}"
+        )
+        for host, operations in summary["endpoints"].items():
+            requests_total = sum(op["requests"] for op in operations.values())
+            errors = sum(op["errors"] for op in operations.values())
+            seconds = sum(op["seconds_total"] for op in operations.values())
+            p95 = max((op["seconds_p95"] or 0) for op in operations.values())
+            wait = sum(op["limiter_wait_seconds_total"] for op in operations.values())
+            mean = seconds / requests_total if requests_total else 0
+            print(
+                f"{host:<32}{requests_total:>10}{errors:>8}{seconds:>10.1f}{mean:>9.3f}{p95:>8}{wait:>9.1f}"
+            )
+        for cache, operations in summary["caches"].items():
+            for operation, counts in operations.items():
+                print(
+                    f"Cache {cache}/{operation}: {counts['hits']} hits, "
+                    f"{counts['misses']} misses (hit rate {counts['hit_rate']})"
+                )
+
+
+METRICS = HttpMetrics()
+
+
+def export_run_metrics(stage, json_path, textfile_dir=None):
+    """
+    End-of-run export: prints the per-host summary, writes the JSON summary
+    to `json_path` and, if `textfile_dir` is set, a Prometheus textfile
+    named bhl_sdc_<stage>.prom in that directory.
+    """
+    print()
+    METRICS.print_summary()
+    METRICS.write_json(json_path)
+    print(f"Request metrics written to: {json_path}")
+    if textfile_dir:
+        METRICS.write_prometheus_textfile(Path(textfile_dir) / f"{METRIC_PREFIX}_{stage}.prom")
+
+
+def http_get(url, operation, **kwargs):
+    """
+    requests.get, within the per-host limit, recorded in METRICS under
+    (host, operation). Connection errors are recorded and re-raised.
+
+    The latency recorded starts once the limiter lets the request through;
+    the wait before that is recorded separately (observe_wait).
+    """
+    host = urlparse(url).hostname or ""
+    queued = time.perf_counter()
+    with host_limit(url):
+        start = time.perf_counter()
+        METRICS.observe_wait(host, operation, start - queued)
+        try:
+            response = requests.get(url, **kwargs)
+        except requests.RequestException:
+            METRICS.observe(host, operation, time.perf_counter() - start, "error")
+            raise
+        n_bytes = 0 if kwargs.get("stream") else len(response.content)
+        seconds = time.perf_counter() - start
+    METRICS.observe(host, operation, seconds, response.status_code, n_bytes)
+    return response
@@ -0,0 +1,68 @@
+import threading
+import time
+from contextlib import nullcontext
+from urllib.parse import urlparse
+
+# Per-host concurrency and rate limits for outgoing API requests.
+#
+# Every network call wraps its request in `with host_limit(url):`. The limits
+# are thread-safe, so they hold both for the serial pipeline and for the
+# concurrent engine in async_harvest.py. Hosts match by suffix, so
+# "biodiversitylibrary.org" also covers "www.biodiversitylibrary.org".
+
+HOST_LIMITS = {
+    "commons.wikimedia.org": {"concurrency": 4, "requests_per_second": 20},
+    "biodiversitylibrary.org": {"concurrency": 8, "requests_per_second": 10},
+    "api.flickr.com": {"concurrency": 4, "requests_per_second": 1},
+    "api.gbif.org": {"concurrency": 8, "requests_per_second": 20},
+}
+
+
+class HostLimiter:
+    def __init__(self, concurrency, requests_per_second=None):
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def __enter__(self):
+        self._slots.acquire()
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._slots.release()
+        return False
+
+
+_LIMITERS = {}
+
+
+def configure_host_limits(host_limits=None):
+    """(Re)creates the limiters, optionally overriding HOST_LIMITS entries from config."""
+    limits = {**HOST_LIMITS, **(host_limits or {})}
+    _LIMITERS.clear()
+    for host, limit in limits.items():
+        _LIMITERS[host] = HostLimiter(
+            limit["concurrency"], limit.get("requests_per_second")
+        )
+
+
+def host_limit(url):
+    hostname = urlparse(url).hostname or ""
+    for host, limiter in _LIMITERS.items():
+        if hostname == host or hostname.endswith("." + host):
+            return limiter
+    return nullcontext()
+
+
+def total_concurrency():
+    return sum(limiter._slots._initial_value for limiter in _LIMITERS.values())
+
+
+configure_host_limits()
@@ -0,0 +1,142 @@
+import csv
+import json
+import os
+from pathlib import Path
+
+FSYNC_EVERY = 50
+
+# Append-only checkpoint journal for generate_metadata.
+#
+# Each metadata row is appended as one JSON line as soon as it is produced,
+# so checkpointing costs O(1) per row and a crash can at worst leave a
+# partial last line, which is ignored on resume. At the end of a run the
+# journal is compacted into the TSV and removed. A crash between the two
+# leaves rows in both; they are read once, by file name (iter_resumed_rows).
+
+
+class RowJournal:
+    def __init__(self, path, fsync_every=FSYNC_EVERY):
+        self.path = Path(path)
+        self.fsync_every = fsync_every
+        self._drop_partial_line()
+        self._file = self.path.open("a", encoding="utf-8")
+        self._unsynced = 0
+
+    def _drop_partial_line(self):
+        # A crash mid-write can leave a line without its newline; cut it off so
+        # the next row doesn't get glued to it.
+        if not self.path.exists():
+            return
+        with self.path.open("rb+") as f:
+            data_end = f.seek(0, os.SEEK_END)
+            position = data_end
+            while position > 0:
+                step = min(4096, position)
+                f.seek(position - step)
+                chunk = f.read(step)
+                newline = chunk.rfind(b"\n")
+                if newline != -1:
+                    position = position - step + newline + 1
+                    break
+                position -= step
+            if position != data_end:
+                f.truncate(position)
+
+    def append(self, row):
+        self._file.write(json.dumps(row) + "\n")
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def iter_journal_rows(path):
+    """Yields the rows of a journal, skipping a trailing line cut by a crash."""
+    path = Path(path)
+    if not path.exists():
+        return
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                break
+
+
+def iter_tsv_rows(path):
+    path = Path(path)
+    if not path.exists():
+        return
+    with path.open("r", newline="", encoding="utf-8") as f:
+        yield from csv.DictReader(f, delimiter="\t")
+
+
+def iter_resumed_rows(output_file, journal_path, keep_existing=True):
+    """
+    Yields the rows of `output_file` (unless `keep_existing` is False), then
+    those of the journal, each file only once.
+    """
+    seen = set()
+    sources = [iter_journal_rows(journal_path)]
+    if keep_existing:
+        sources.insert(0, iter_tsv_rows(output_file))
+    for source in sources:
+        for row in source:
+            if row["File"] in seen:
+                continue
+            seen.add(row["File"])
+            yield row
+
+
+def compact_journal(journal_path, output_file, keep_existing=True, fieldnames=None):
+    """
+    Appends the journal rows to the rows already in `output_file` (unless
+    `keep_existing` is False), rewrites it once (through a temporary file, so
+    it is never left half-written) and removes the journal.
+
+    The columns are those of the first row, or `fieldnames` if there are no
+    rows, so that the TSV always has its header.
+    """
+    journal_path = Path(journal_path)
+    output_file = Path(output_file)
+    tmp_file = output_file.with_suffix(".tmp")
+
+    rows = iter_resumed_rows(output_file, journal_path, keep_existing)
+    first_row = next(rows, None)
+    if first_row is not None:
+        fieldnames = list(first_row)
+    with tmp_file.open("w", newline="", encoding="utf-8") as f:
+        if fieldnames:
+            writer = csv.DictWriter(
+                f,
+                fieldnames=fieldnames,
+                delimiter="\t",
+                lineterminator="\n",
+                extrasaction="ignore",
+            )
+            writer.writeheader()
+            if first_row is not None:
+                writer.writerow(first_row)
+            for row in rows:
+                writer.writerow(row)
+    tmp_file.replace(output_file)
+    journal_path.unlink(missing_ok=True)
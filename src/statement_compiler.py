@@ -0,0 +1,437 @@
+import logging
+import re
+from functools import lru_cache
+
+from wikibaseintegrator import wbi_enums
+
+import helper
+from helper import (
+    LIST_OF_PLATE_PREFIXES,
+    get_artist_qids_from_flickr_tags,
+    get_illustrator_qid_from_flickr_illustrator_tags,
+    get_institution_as_a_qid,
+    get_species_names_from_flickr_binomial_tags,
+    is_likely_a_crop,
+)
+
+# Compiles a metadata row straight into MediaInfo claims JSON.
+#
+# compile_statements makes the same decisions as helper.build_statements and
+# the add_* builders, but writes each statement as the JSON that
+# claim.get_json() gives for the WikibaseIntegrator object, key order
+# included, without building Item/Qualifiers/References objects first
+# (benchmarks/statement_benchmark.py checks that the two are byte-identical
+# and compares their speed).
+#
+# The snaks, qualifier sets and references that only depend on a constant or
+# on a bibliography, item, page or Flickr ID are built once and shared by
+# every statement that uses them (see the lru_cache'd functions below), so
+# the compiled JSON must be treated as read-only; serialize or copy it
+# before changing it.
+#
+# The statements add_public_domain_statement removes from the entity (P6216
+# other than public domain, and P275) come out as a separate list of
+# {"id": ..., "remove": ""}, the form wbeditentity takes for a removal.
+
+GBIF_MATCHING = "Q132907038"  # inferred from GBIF scientific name matching services
+BHL_OCR = "Q132359710"  # inferred from the BHL OCR
+FLICKR_TAG = "Q131782980"  # inferred from Flickr tag
+PUBLICATION_DATE = "Q110393725"  # inferred from publication date
+ANALOG_WORK = "Q112134971"
+PUBLIC_DOMAIN = "Q19652"
+
+PAGE_TYPE_TO_QID = {
+    "Illustration": "Q178659",
+    "Table of Contents": "Q1456936",
+    "Foldout": "Q2649400",
+    "Map": "Q4006",
+    "Title Page": "Q1339862",
+}
+
+MINIMAL_STATEMENTS = ["P31", "P1433", "P687", "P195", "P859"]
+
+# The checks of the WikibaseIntegrator Item and URL datatypes: a value they
+# reject raises ValueError here too.
+ITEM_ID_PATTERN = re.compile(r"^(?:[a-zA-Z]+:|.+\/entity\/)?Q?([0-9]+)$")
+URL_PATTERN = re.compile(r'^([a-z][a-z\d+.-]*):([^][<>\"\x00-\x20\x7F])+$')
+
+
+# Snaks, in the shape of Snak.get_json().
+
+
+@lru_cache(maxsize=None)
+def item_snak(prop, qid):
+    datavalue = {}
+    if qid:
+        matches = ITEM_ID_PATTERN.match(qid)
+        if not matches:
+            raise ValueError(f"Invalid item ID ({qid}), format must be 'Q[0-9]+'")
+        numeric_id = int(matches.group(1))
+        datavalue = {
+            "value": {"entity-type": "item", "numeric-id": numeric_id, "id": f"Q{numeric_id}"},
+            "type": "wikibase-entityid",
+        }
+    return {
+        "snaktype": "value",
+        "property": prop,
+        "datatype": "wikibase-item",
+        "datavalue": datavalue,
+    }
+
+
+def string_snak(prop, value, datatype="string"):
+    return {
+        "snaktype": "value",
+        "property": prop,
+        "datatype": datatype,
+        "datavalue": {"value": value, "type": "string"} if value else {},
+    }
+
+
+def url_snak(prop, url):
+    if not URL_PATTERN.match(url):
+        raise ValueError(f"Invalid URL {url}")
+    return string_snak(prop, url, "url")
+
+
+def year_snak(prop, year):
+    return {
+        "snaktype": "value",
+        "property": prop,
+        "datatype": "time",
+        "datavalue": {
+            "value": {
+                "time": f"+{year}-01-01T00:00:00Z",
+                "before": 0,
+                "after": 0,
+                "precision": wbi_enums.WikibaseTimePrecision.YEAR.value,
+                "timezone": 0,
+                "calendarmodel": "http://www.wikidata.org/entity/Q1985727",
+            },
+            "type": "time",
+        },
+    }
+
+
+def statement(mainsnak, rank="normal", qualifiers=None, references=None):
+    """A new statement, in the shape of Claim.get_json()."""
+    claim = {"mainsnak": mainsnak, "type": "statement", "rank": rank}
+    if qualifiers:
+        claim["qualifiers"] = qualifiers
+        claim["qualifiers-order"] = []
+    if references:
+        claim["references"] = references
+    return claim
+
+
+def reference(snaks):
+    return {"snaks": snaks, "snaks-order": []}
+
+
+def removal(statement_id):
+    return {"id": statement_id, "remove": ""}
+
+
+# Interned qualifier sets and references.
+
+ANALOG_WORK_QUALIFIERS = {"P518": [item_snak("P518", ANALOG_WORK)]}
+DIGITIZATION_SPONSOR_QUALIFIERS = {"P3831": [item_snak("P3831", "Q131344184")]}
+HOLDING_INSTITUTION_QUALIFIERS = {"P3831": [item_snak("P3831", "Q131597993")]}
+ILLUSTRATOR_QUALIFIERS = {
+    "P518": [item_snak("P518", ANALOG_WORK)],
+    "P3831": [item_snak("P3831", "Q644687")],
+}
+ARTIST_QUALIFIERS = {
+    "P518": [item_snak("P518", ANALOG_WORK)],
+    "P3831": [item_snak("P3831", "Q483501")],
+}
+INCEPTION_QUALIFIERS = {
+    "P1480": [item_snak("P1480", "Q110290992")],  # no later than
+    "P518": [item_snak("P518", ANALOG_WORK)],
+}
+
+
+@lru_cache(maxsize=4096)
+def bibliography_references(bib_id):
+    url = f"https://www.biodiversitylibrary.org/bibliography/{bib_id}"
+    return [reference({"P854": [url_snak("P854", url)]})]
+
+
+@lru_cache(maxsize=4096)
+def inception_references(item_id):
+    snaks = {"P887": [item_snak("P887", PUBLICATION_DATE)]}
+    if item_id:
+        url = f"https://www.biodiversitylibrary.org/item/{item_id}"
+        snaks["P854"] = [url_snak("P854", url)]
+    return [reference(snaks)]
+
+
+@lru_cache(maxsize=4096)
+def page_references(bhl_page_id):
+    url = f"https://www.biodiversitylibrary.org/page/{bhl_page_id}"
+    return [reference({"P854": [url_snak("P854", url)]})]
+
+
+@lru_cache(maxsize=4096)
+def flickr_tag_references(flickr_id):
+    url = f"https://www.flickr.com/photo.gne?id={flickr_id}"
+    return [
+        reference(
+            {
+                "P887": [item_snak("P887", FLICKR_TAG)],
+                "P854": [url_snak("P854", url)],
+            }
+        )
+    ]
+
+
+@lru_cache(maxsize=4096)
+def depicts_source_snaks(source, url):
+    """The inferred-from snaks and URL of a depicts reference, without the name."""
+    return (
+        [item_snak("P887", GBIF_MATCHING), item_snak("P887", source)],
+        [url_snak("P854", url)],
+    )
+
+
+def depicts_references(name, source, url):
+    inferred_from, urls = depicts_source_snaks(source, url)
+    return [
+        reference(
+            {"P887": inferred_from, "P5997": [string_snak("P5997", name)], "P854": urls}
+        )
+    ]
+
+
+# Statements, one function per helper.add_* builder.
+
+
+def depicts_statements(row, claim_index):
+    statements = []
+    rank = "preferred"
+    bhl_names = row.get("Names", "").strip().split("; ")
+    if row.get("Is Extracted", "").strip() == "True":
+        return statements
+    current_p180_qids = claim_index.values("P180")
+
+    bhl_page_id = row.get("BHL Page ID", "").strip()
+    if bhl_page_id:
+        if len(bhl_names) > 1:
+            rank = "normal"
+        url = f"https://biodiversitylibrary.org/page/{bhl_page_id}"
+        for name in bhl_names:
+            if name == "" or len(name.split(" ")) == 1:
+                continue
+            qid = helper.get_wikidata_qid_from_gbif(name)
+            if qid and qid not in current_p180_qids:
+                statements.append(
+                    statement(
+                        item_snak("P180", qid),
+                        rank,
+                        references=depicts_references(name, BHL_OCR, url),
+                    )
+                )
+
+    flickr_tags = row.get("Flickr Tags", "").strip().split(",")
+    url = f"https://www.flickr.com/photo.gne?id={row.get('Flickr ID', '').strip()}"
+    flickr_species_names = get_species_names_from_flickr_binomial_tags(flickr_tags)
+    if len(flickr_species_names) > 1:
+        rank = "normal"
+    for name in flickr_species_names:
+        qid = helper.get_wikidata_qid_from_gbif(name)
+        if qid and qid not in current_p180_qids:
+            statements.append(
+                statement(
+                    item_snak("P180", qid),
+                    rank,
+                    references=depicts_references(name, FLICKR_TAG, url),
+                )
+            )
+    return statements
+
+
+def creator_statements(row):
+    statements = []
+    if row.get("Is Extracted", "").strip() == "True":
+        return statements
+    flickr_tags = row.get("Flickr Tags", "").strip().split(",")
+    references = flickr_tag_references(row.get("Flickr ID", "").strip())
+    illustrator_qids = get_illustrator_qid_from_flickr_illustrator_tags(flickr_tags)
+    for qid in illustrator_qids:
+        statements.append(
+            statement(item_snak("P170", qid), "normal", ILLUSTRATOR_QUALIFIERS, references)
+        )
+    for qid in get_artist_qids_from_flickr_tags(flickr_tags):
+        if qid in illustrator_qids:
+            continue
+        statements.append(
+            statement(item_snak("P170", qid), "normal", ARTIST_QUALIFIERS, references)
+        )
+    return statements
+
+
+def public_domain_statement(row):
+    # add_public_domain_statement adds it whatever the copyright status.
+    return statement(
+        item_snak("P6216", PUBLIC_DOMAIN),
+        references=bibliography_references(row.get("Bibliography ID", "")),
+    )
+
+
+def public_domain_removals(claim_index):
+    """Removals for the copyright statements the public domain one replaces."""
+    removals = []
+    if claim_index.values("P6216") - {PUBLIC_DOMAIN}:
+        removals += [
+            removal(statement_id)
+            for statement_id, qid in claim_index.statements("P6216")
+            if qid and qid != PUBLIC_DOMAIN
+        ]
+    if "P275" in claim_index:
+        removals += [removal(statement_id) for statement_id, _ in claim_index.statements("P275")]
+    return removals
+
+
+def inception_statements(row, claim_index):
+    inception_str = row.get("Item Publication Date", "").strip()
+    current_p571_dates = {time[1:5] for time in claim_index.values("P571")}
+    if not inception_str or inception_str in current_p571_dates:
+        return []
+    if len(inception_str) != 4 or not inception_str.isdigit():
+        logging.warning(f"Invalid year format for inception date: {inception_str}")
+        return []
+    return [
+        statement(
+            year_snak("P571", inception_str),
+            "normal",
+            INCEPTION_QUALIFIERS,
+            inception_references(row.get("Item ID", "").strip()),
+        )
+    ]
+
+
+def bibliography_references_of(row):
+    bib_id = row.get("Bibliography ID", "").strip()
+    return bibliography_references(bib_id) if bib_id else None
+
+
+def sponsor_statements(row):
+    statements = []
+    if row["Sponsor"] == "":
+        statements.append(
+            statement(
+                {"snaktype": "somevalue", "property": "P859", "datatype": "wikibase-item"},
+                "normal",
+                DIGITIZATION_SPONSOR_QUALIFIERS,
+                bibliography_references_of(row),
+            )
+        )
+    sponsor = row.get("Sponsor", "").strip()
+    if sponsor:
+        statements.append(
+            statement(
+                item_snak("P859", get_institution_as_a_qid(sponsor)),
+                "normal",
+                DIGITIZATION_SPONSOR_QUALIFIERS,
+                bibliography_references_of(row),
+            )
+        )
+    return statements
+
+
+def collection_statements(row):
+    collection = row.get("Collection", "").strip()
+    if not collection:
+        return []
+    return [
+        statement(
+            item_snak("P195", get_institution_as_a_qid(collection)),
+            "normal",
+            HOLDING_INSTITUTION_QUALIFIERS,
+            bibliography_references_of(row),
+        )
+    ]
+
+
+def instance_statements(row, claim_index):
+    if "P31" in claim_index:
+        return []
+    page_type = row["Page Types"]
+    if page_type not in PAGE_TYPE_TO_QID:
+        return []
+    if page_type == "Illustration":
+        # Only before 1843: after that, it may be a photograph.
+        try:
+            if int(row["Item Publication Date"].strip()) >= 1843:
+                return []
+        except ValueError:
+            return []
+    return [statement(item_snak("P31", PAGE_TYPE_TO_QID[page_type]))]
+
+
+def published_in_statements(row, claim_index):
+    published_in = row.get("Published In QID", "").strip()
+    if not published_in or claim_index.has("P1433", published_in):
+        return []
+    qualifiers = dict(ANALOG_WORK_QUALIFIERS)
+    volume = row["Volume"]
+    if volume:
+        qualifiers["P478"] = [string_snak("P478", volume.strip())]
+    page_number_prefix = row.get("Page Number Prefix", "").strip()
+    page_number_number = row.get("Page Number Number", "").strip()
+    if page_number_prefix and page_number_number:
+        if page_number_prefix in LIST_OF_PLATE_PREFIXES:
+            qualifiers["P12275"] = [string_snak("P12275", page_number_number)]
+    bhl_page_id = row.get("BHL Page ID", "").strip()
+    return [
+        statement(
+            item_snak("P1433", published_in),
+            "normal",
+            qualifiers,
+            page_references(bhl_page_id) if bhl_page_id else None,
+        )
+    ]
+
+
+def external_id_statements(row):
+    statements = []
+    for prop, column in (("P687", "BHL Page ID"), ("P12120", "Flickr ID")):
+        value = row.get(column, "").strip()
+        if value:
+            statements.append(statement(string_snak(prop, value, "external-id")))
+    return statements
+
+
+def compile_statements(row, file_name, claim_index):
+    """
+    Compiles one TSV row against the ClaimIndex of its entity.
+
+    Returns (groups, had_minimum_data, removals): groups and had_minimum_data
+    as helper.build_statements returns them, with claim JSON in place of the
+    WikibaseIntegrator statements, and the removals it marks on the entity.
+    """
+    removals = public_domain_removals(claim_index)
+    file_is_likely_a_crop = is_likely_a_crop(row, file_name)
+    merge = wbi_enums.ActionIfExists.MERGE_REFS_OR_APPEND
+
+    if all(prop in claim_index for prop in MINIMAL_STATEMENTS):
+        statements = []
+        if not file_is_likely_a_crop:
+            statements = depicts_statements(row, claim_index)
+        return [
+            (merge, statements),
+            (wbi_enums.ActionIfExists.REPLACE_ALL, [public_domain_statement(row)]),
+        ], True, removals
+
+    statements = instance_statements(row, claim_index)
+    statements.append(public_domain_statement(row))
+    statements += published_in_statements(row, claim_index)
+    statements += collection_statements(row)
+    statements += sponsor_statements(row)
+    # add_bhl_id_claim comes before add_flickr_id_claim.
+    statements += external_id_statements(row)
+    if not file_is_likely_a_crop and row.get("Page Types", "") == "Illustration":
+        statements += creator_statements(row)
+        statements += depicts_statements(row, claim_index)
+    statements += inception_statements(row, claim_index)
+    return [(merge, statements)], False, removals
@@ -1,32 +1,32 @@
 import logging
 import argparse
+import time
+from collections import Counter
 
 from tqdm import tqdm
 from pathlib import Path
 
 import pandas as pd
 
-from wikibaseintegrator import wbi_login, WikibaseIntegrator, wbi_enums
+from wikibaseintegrator import wbi_login, WikibaseIntegrator
 from wikibaseintegrator.wbi_config import config as wbi_config
 
 from login import *
 from helper import (
     load_config,
-    get_media_info_id,
     generate_custom_edit_summary,
-    add_public_domain_statement,
-    add_creator_statements,
-    add_depicts_claim,
-    add_bhl_id_claim,
-    add_blank_sponsor,
-    add_collection_claim,
-    add_digital_sponsor_claim,
-    add_flickr_id_claim,
-    add_inception_claim,
-    add_instance_claim,
-    add_published_in_claim,
+    build_statements,
     set_up_wbi_config,
 )
+from mediainfo_loader import prefetch_mediainfo, resolve_media_info_ids
+from entity_edits import EntityEdit
+from edit_plan import EditConflict, apply_entry, plan_entry, read_plan, write_plan
+from claim_index import ClaimIndex
+from upload_pool import AdaptiveLimit, run_adaptive, throttle_delay
+from upload_ledger import UploadLedger, row_hash
+from disk_cache import DiskCache
+from http_metrics import export_run_metrics
+import helper
 
 HERE = Path(__file__).parent
 DATA = HERE / "data"
@@ -34,22 +34,116 @@ DICTS = HERE / "dicts"
 
 set_up_wbi_config(wbi_config)
 
+# Last known MediaInfo JSON of each file, for dry runs (see dry_run_upload).
+MEDIAINFO_SNAPSHOTS = DiskCache(DATA / "cache" / "mediainfo_snapshots.sqlite")
 
-def upload_metadata_to_commons(csv_path):
 
-    logging.basicConfig(level=logging.INFO)
-    login_instance = wbi_login.OAuth2(
-        consumer_token=WIKI_CLIENT_KEY, consumer_secret=WIKI_CLIENT_SECRET
+def save_snapshot(file_name, mediainfo_id, entity_json):
+    """
+    Stores the entity JSON as the API returned it (wbgetentities or the
+    wbeditentity response), or None for a file without structured data yet.
+    WikibaseIntegrator's get_json() can't be stored instead: it leaves out
+    the reference hashes that from_json requires.
+    """
+    MEDIAINFO_SNAPSHOTS.set(
+        "mediainfo", file_name, {"id": mediainfo_id, "entity": entity_json}
     )
-    wbi = WikibaseIntegrator(login=login_instance)
 
-    wiki_edit_summary = generate_custom_edit_summary()
 
+def build_edit(row, file_name, media):
+    """
+    Runs the helper builders for one TSV row against a loaded MediaInfo entity.
+
+    Returns the EntityEdit holding the changes, and whether the file already
+    had the minimal statements (in which case only depicts and the public
+    domain statement are updated).
+    """
+    edit = EntityEdit(media)
+    # Built from the claims EntityEdit already serialized, and shared by the builders.
+    claim_index = ClaimIndex(edit.base_claims)
+
+    groups, had_minimum_data = build_statements(row, file_name, media, claim_index)
+    if had_minimum_data:
+        logging.info(f"Skipping {file_name} because it already has minimum data.")
+    for action_if_exists, statements in groups:
+        edit.add(statements, action_if_exists=action_if_exists)
+    return edit, had_minimum_data
+
+
+def load_media(wbi, mediainfo_id, entity_json, loaded):
+    """
+    The MediaInfo entity of a prefetched file (see prefetch_mediainfo), and
+    its entity JSON as the API returned it (None without structured data).
+    """
+    try:
+        if not loaded:
+            # The batched request failed; fall back to a single fetch.
+            response = wbi.mediainfo.new()._get(entity_id=mediainfo_id)
+            entity_json = response["entities"][mediainfo_id]
+            if "missing" in entity_json:
+                entity_json = None
+        if entity_json is None:
+            return wbi.mediainfo.new(id=mediainfo_id), None
+        return wbi.mediainfo.new().from_json(entity_json), entity_json
+    except Exception as e:
+        if "The MW API returned that the entity was missing." in str(e):
+            return wbi.mediainfo.new(id=mediainfo_id), None
+        raise
+
+
+def upload_file(
+    wbi, wiki_edit_summary, row, file_name, mediainfo_id, entity_json, loaded
+):
+    """
+    Builds and writes the SDC statements for one TSV row. Returns the outcome
+    ("written", "unchanged", "unresolved" or "failed") and the revision the
+    entity was left at. Throttling errors are raised, so that the worker pool
+    can back off and retry the file.
+    """
+    if not mediainfo_id:
+        logging.error(f"Could not resolve MediaInfo ID for File:{file_name}")
+        return "unresolved", None
+
+    try:
+        media, entity_json = load_media(wbi, mediainfo_id, entity_json, loaded)
+    except Exception as e:
+        if throttle_delay(e) is not None:
+            raise
+        logging.error(f"Could not load MediaInfo for File:{file_name}: {e}")
+        return "failed", None
+    save_snapshot(file_name, mediainfo_id, entity_json)
+
+    edit, had_minimum_data = build_edit(row, file_name, media)
+
+    # All changes go out in a single edit, if they change anything at all.
+    if not edit.has_changes:
+        if not had_minimum_data:
+            logging.info(f"No SDC data to add for {file_name}, skipping...")
+        return "unchanged", edit.media.lastrevid
+    try:
+        edit.write(summary=wiki_edit_summary)
+    except Exception as e:
+        if throttle_delay(e) is not None:
+            raise
+        logging.error(f"Failed to write SDC for {file_name}: {e}")
+        return "failed", None
+    save_snapshot(file_name, mediainfo_id, edit.entity_json)
+
+    if had_minimum_data:
+        logging.info(
+            f"Added depicts and public domain statements to {file_name} because it already has minimum data."
+        )
+    else:
+        tqdm.write(f"No errors when trying to update {file_name} with SDC data.")
+    return "written", edit.media.lastrevid
+
+
+def read_upload_rows(csv_path):
     metadata_df = pd.read_csv(csv_path, sep="\t", dtype=str)
     metadata_df.fillna("", inplace=True)
 
-    for i, row in tqdm(metadata_df.iterrows()):
-
+    rows = []
+    for i, row in metadata_df.iterrows():
         file_name = row["File"].strip()
         file_name_lower = file_name.lower()
         if file_name_lower.endswith(".pdf") or file_name_lower.endswith(".djvu"):
@@ -58,98 +152,308 @@ def upload_metadata_to_commons(csv_path):
         if not file_name:
             logging.warning("Skipping row with empty 'File' column.")
             continue
+        rows.append(row)
+    return rows
+
+
+def pending_rows(rows, ledger):
+    """
+    Leaves out the files done in an earlier run whose row and entity haven't
+    changed since. Returns the remaining rows and the row hashes by file.
+    """
+    hashes = {row["File"].strip(): row_hash(row) for row in rows}
+    candidates = ledger.done_revisions(hashes)
+    if candidates:
+        current = resolve_media_info_ids(
+            candidates, endpoint=wbi_config["MEDIAWIKI_API_URL"]
+        )
+        up_to_date = {
+            name
+            for name, lastrevid in candidates.items()
+            if current.get(name) and current[name]["lastrevid"] == lastrevid
+        }
+        rows = [row for row in rows if row["File"].strip() not in up_to_date]
+        logging.info(
+            f"Skipping {len(up_to_date)} files already uploaded in a previous run."
+        )
+    return rows, hashes
 
-        bhl_page_id = row["BHL Page ID"].strip()
-        try:
-            flickr_id = row["Flickr ID"].strip()
-        except:
-            flickr_id = ""
 
-        file_is_likely_a_crop = True  # Assume it is a crop for safety
+def upload_metadata_to_commons(csv_path, max_workers=1):
+
+    logging.basicConfig(level=logging.INFO)
+    login_instance = wbi_login.OAuth2(
+        consumer_token=WIKI_CLIENT_KEY, consumer_secret=WIKI_CLIENT_SECRET
+    )
+    wbi = WikibaseIntegrator(login=login_instance)
+
+    wiki_edit_summary = generate_custom_edit_summary()
+
+    ledger = UploadLedger(Path(csv_path).with_suffix(".upload_ledger.sqlite"))
+    rows, hashes = pending_rows(read_upload_rows(csv_path), ledger)
 
-        if bhl_page_id in file_name:
-            file_is_likely_a_crop = False
-        if flickr_id != "" and flickr_id not in file_name:
-            file_is_likely_a_crop = False
-        if "(cropped)" in file_name:
-            file_is_likely_a_crop = True
+    # MediaInfo IDs and entities are loaded in batches of 50, ahead of the writes.
+    prefetched = prefetch_mediainfo(
+        [row["File"].strip() for row in rows], endpoint=wbi_config["MEDIAWIKI_API_URL"]
+    )
+    # Files are processed by a small pool of workers whose number adapts to
+    # how fast Commons accepts edits (see upload_pool.py).
+    outcomes = Counter()
+    progress = tqdm(total=len(rows))
+
+    def record_outcome(task, result):
+        file_name, mediainfo_id = task[3], task[4]
+        outcome, lastrevid = result or ("failed", None)
+        if result is None:
+            logging.error(f"Failed to process {file_name}")
+        ledger.record(file_name, mediainfo_id, lastrevid, outcome, hashes[file_name])
+        outcomes[outcome] += 1
+        progress.update()
+
+    run_adaptive(
+        (
+            (wbi, wiki_edit_summary, row, *loaded_entity)
+            for row, loaded_entity in zip(rows, prefetched)
+        ),
+        upload_file,
+        AdaptiveLimit(initial=min(2, max_workers), maximum=max_workers),
+        on_result=record_outcome,
+    )
+    progress.close()
 
+    logging.info(
+        f"Skipped {outcomes['unchanged']} of {len(rows)} files whose SDC was already up to date."
+    )
+    logging.info(f"Upload outcomes: {dict(outcomes)}")
+    logging.info(f"Ledger outcomes, all runs: {ledger.outcome_counts()}")
+    ledger.close()
+
+
+def add_to_totals(totals, delta):
+    """Adds an edit's delta to the per-property totals; returns it as "+P180 (2)" strings."""
+    changes = []
+    for prop, change in sorted(delta.items(), key=lambda item: int(item[0][1:])):
+        total = totals.setdefault(prop, {"added": 0, "removed": 0})
+        for kind, sign in (("added", "+"), ("removed", "-")):
+            if change[kind]:
+                changes.append(f"{sign}{prop} ({change[kind]})")
+                total[kind] += change[kind]
+    return changes
+
+
+def print_property_totals(totals):
+    print()
+    print(f"{'Property':<10}{'Added':>8}{'Removed':>9}")
+    for prop, total in sorted(totals.items(), key=lambda item: int(item[0][1:])):
+        print(f"{prop:<10}{total['added']:>8}{total['removed']:>9}")
+    print()
+
+
+def dry_run_upload(csv_path):
+    """
+    Runs the helper builders for every row against the stored MediaInfo
+    snapshots, without network access, and prints the statements each file
+    would gain or lose, plus totals by property. Nothing is written.
+    """
+    helper.OFFLINE = True
+    wbi = WikibaseIntegrator()
+    rows = read_upload_rows(csv_path)
+    totals = {}
+    counts = Counter()
+    start = time.perf_counter()
+    for row in rows:
+        file_name = row["File"].strip()
+        snapshot = MEDIAINFO_SNAPSHOTS.get("mediainfo", file_name)
+        if snapshot is None:
+            counts["no snapshot"] += 1
+            continue
         try:
-            data = get_media_info_id(file_name)
-            mediainfo_id = data
-            media = wbi.mediainfo.get(entity_id=mediainfo_id)
-        except Exception as e:
-            if "The MW API returned that the entity was missing." in str(e):
-                media = wbi.mediainfo.new(id=mediainfo_id)
+            if snapshot["entity"] is None:
+                media = wbi.mediainfo.new(id=snapshot["id"])
             else:
-                logging.error(f"Could not load MediaInfo for File:{file_name}: {e}")
-                continue
-
-        new_statements = []
-        claims = media.claims.get_json()
-
-        # skipping most info if mimimum statements are in (instance of, published in, bhl page id, collection, sponsor)
-        minimal_statements = ["P31", "P1433", "P687", "P195", "P859"]
-        if all(claim in claims for claim in minimal_statements):
-            logging.info(f"Skipping {file_name} because it already has minimum data.")
-
-            # Always adding depicts information (unless file is a crop)
-            if not file_is_likely_a_crop:
-                add_depicts_claim(row, new_statements, media)
-            if new_statements:
-                media.claims.add(
-                    new_statements,
-                    action_if_exists=wbi_enums.ActionIfExists.MERGE_REFS_OR_APPEND,
-                )
-                media.write(summary=wiki_edit_summary)
-                logging.info(
-                    f"Added depicts statement to {file_name} because it already has minimum data."
-                )
-
-            # Always adding public domain statement, replacing all other information
-            add_public_domain_statement(row, media, new_statements)
-            if new_statements:
-                media.claims.add(
-                    new_statements,
-                    action_if_exists=wbi_enums.ActionIfExists.REPLACE_ALL,
-                )
-                media.write(summary=wiki_edit_summary)
-                logging.info(
-                    f"Added public domain statement to {file_name} because it already has minimum data."
-                )
+                media = wbi.mediainfo.new().from_json(snapshot["entity"])
+            edit, _ = build_edit(row, file_name, media)
+        except Exception as e:
+            print(f"{file_name}: could not build statements offline: {e!r}")
+            counts["failed"] += 1
             continue
-
-        add_instance_claim(row, new_statements, media)
-        add_public_domain_statement(row, media, new_statements)
-        add_published_in_claim(row, new_statements, media)
-        add_collection_claim(row, new_statements)
-        if row["Sponsor"] == "":
-            add_blank_sponsor(row, new_statements)
-        add_digital_sponsor_claim(row, new_statements)
-        add_bhl_id_claim(row, new_statements)
-        add_flickr_id_claim(row, new_statements)
-
-        if not file_is_likely_a_crop:
-            if row.get("Page Types", "") == "Illustration":
-                add_creator_statements(row, new_statements)
-                add_depicts_claim(row, new_statements, media)
-
-        add_inception_claim(row, media, new_statements)
-
-        if new_statements:
-            media.claims.add(
-                new_statements,
-                action_if_exists=wbi_enums.ActionIfExists.MERGE_REFS_OR_APPEND,
+        delta = edit.delta()
+        if not delta:
+            counts["unchanged"] += 1
+            continue
+        counts["changed"] += 1
+        print(f"{file_name}: {', '.join(add_to_totals(totals, delta))}")
+    elapsed = time.perf_counter() - start
+
+    print_property_totals(totals)
+    print(
+        f"{len(rows)} files in {elapsed:.1f}s: {counts['changed']} would change, "
+        f"{counts['unchanged']} unchanged, {counts['failed']} failed, "
+        f"{counts['no snapshot']} without snapshot."
+    )
+    return totals
+
+
+def plan_upload(csv_path, plan_path):
+    """
+    Works out the edit of every file against its current entity and writes
+    them to a JSON-lines plan (see edit_plan.py). Nothing is written to
+    Commons; files that need no edit are recorded as done in the ledger.
+    """
+    wbi = WikibaseIntegrator()
+    ledger = UploadLedger(Path(csv_path).with_suffix(".upload_ledger.sqlite"))
+    rows, hashes = pending_rows(read_upload_rows(csv_path), ledger)
+    prefetched = prefetch_mediainfo(
+        [row["File"].strip() for row in rows],
+        endpoint=wbi_config["MEDIAWIKI_API_URL"],
+        with_revisions=True,
+    )
+    entries = []
+    totals = {}
+    counts = Counter()
+    start = time.perf_counter()
+    for row, loaded_entity in tqdm(zip(rows, prefetched), total=len(rows)):
+        file_name, mediainfo_id, entity_json, loaded, lastrevid = loaded_entity
+        if not mediainfo_id:
+            logging.error(f"Could not resolve MediaInfo ID for File:{file_name}")
+            counts["unresolved"] += 1
+            continue
+        try:
+            media, entity_json = load_media(wbi, mediainfo_id, entity_json, loaded)
+            save_snapshot(file_name, mediainfo_id, entity_json)
+            edit, _ = build_edit(row, file_name, media)
+        except Exception as e:
+            logging.error(f"Could not plan File:{file_name}: {e}")
+            counts["failed"] += 1
+            continue
+        # Files without structured data have no entity revision; the page's is used.
+        base_revid = media.lastrevid or lastrevid
+        if not edit.has_changes:
+            ledger.record(
+                file_name, mediainfo_id, base_revid, "unchanged", hashes[file_name]
             )
-            try:
-                media.write(summary=wiki_edit_summary)
-                tqdm.write(
-                    f"No errors when trying to update {file_name} with SDC data."
-                )
-            except Exception as e:
-                logging.error(f"Failed to write SDC for {file_name}: {e}")
-        else:
-            logging.info(f"No SDC data to add for {file_name}, skipping...")
+            counts["unchanged"] += 1
+            continue
+        entry = plan_entry(
+            file_name, mediainfo_id, base_revid, row, hashes[file_name], edit
+        )
+        add_to_totals(totals, entry["delta"])
+        entries.append(entry)
+    write_plan(entries, plan_path)
+    elapsed = time.perf_counter() - start
+    ledger.close()
+
+    print_property_totals(totals)
+    print(
+        f"{len(rows)} files planned in {elapsed:.1f}s: {len(entries)} edits, "
+        f"{counts['unchanged']} unchanged, {counts['failed']} failed, "
+        f"{counts['unresolved']} unresolved."
+    )
+    print(f"Plan written to: {plan_path}")
+    return entries
+
+
+def replay_entry(wbi, wiki_edit_summary, entry, conflict, on_conflict):
+    """
+    Writes one plan line. A file edited since planning (`conflict`, or an
+    editconflict answer) is skipped, or built and written again against its
+    current entity when `on_conflict` is "replan".
+    """
+    file_name = entry["file"]
+    if not conflict:
+        try:
+            return "written", apply_entry(wbi, wiki_edit_summary, entry)
+        except EditConflict:
+            logging.warning(f"File:{file_name} was edited since it was planned.")
+        except Exception as e:
+            if throttle_delay(e) is not None:
+                raise
+            logging.error(f"Failed to write SDC for {file_name}: {e}")
+            return "failed", None
+    if on_conflict == "replan":
+        mediainfo_id = entry["mediainfo_id"]
+        row = entry["row"]
+        return upload_file(
+            wbi, wiki_edit_summary, row, file_name, mediainfo_id, None, False
+        )
+    return "conflict", None
+
+
+def execute_plan(plan_path, csv_path, max_workers=1, on_conflict="skip"):
+    """
+    Replays a plan written by plan_upload, one wbeditentity call per file.
+    Files whose revision moved since planning are handled as `on_conflict`
+    says ("skip" or "replan").
+    """
+    logging.basicConfig(level=logging.INFO)
+    login_instance = wbi_login.OAuth2(
+        consumer_token=WIKI_CLIENT_KEY, consumer_secret=WIKI_CLIENT_SECRET
+    )
+    wbi = WikibaseIntegrator(login=login_instance)
+    wiki_edit_summary = generate_custom_edit_summary()
+    ledger = UploadLedger(Path(csv_path).with_suffix(".upload_ledger.sqlite"))
+    start = time.perf_counter()
+
+    entries = read_plan(plan_path)
+    # One revision check per 50 files, before any write.
+    current = resolve_media_info_ids(
+        [entry["file"] for entry in entries], endpoint=wbi_config["MEDIAWIKI_API_URL"]
+    )
+    outcomes = Counter()
+    tasks = []
+    for entry in entries:
+        info = current.get(entry["file"])
+        if not info:
+            logging.error(f"Could not resolve MediaInfo ID for File:{entry['file']}")
+            outcomes["unresolved"] += 1
+            continue
+        done = ledger.get(entry["file"])
+        if (
+            done
+            and done["outcome"] == "written"
+            and done["row_hash"] == entry["row_hash"]
+            and done["lastrevid"] == info["lastrevid"]
+        ):
+            # Written by an earlier run of this plan.
+            outcomes["already applied"] += 1
+            continue
+        conflict = info["lastrevid"] != entry["base_revid"]
+        if conflict:
+            outcomes["changed since planning"] += 1
+        tasks.append((wbi, wiki_edit_summary, entry, conflict, on_conflict))
+    if outcomes["changed since planning"]:
+        logging.warning(
+            f"{outcomes['changed since planning']} files were edited since the plan "
+            f"was made ({'re-planning' if on_conflict == 'replan' else 'skipping'} them)."
+        )
+
+    progress = tqdm(total=len(tasks))
+
+    def record_outcome(task, result):
+        entry = task[2]
+        outcome, lastrevid = result or ("failed", None)
+        if result is None:
+            logging.error(f"Failed to process {entry['file']}")
+        ledger.record(
+            entry["file"], entry["mediainfo_id"], lastrevid, outcome, entry["row_hash"]
+        )
+        outcomes[outcome] += 1
+        progress.update()
+
+    run_adaptive(
+        tasks,
+        replay_entry,
+        AdaptiveLimit(initial=min(2, max_workers), maximum=max_workers),
+        on_result=record_outcome,
+    )
+    progress.close()
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f"Replayed {len(entries)} planned edits in {elapsed:.1f}s: {dict(outcomes)}"
+    )
+    logging.info(f"Ledger outcomes, all runs: {ledger.outcome_counts()}")
+    ledger.close()
+    return outcomes
 
 
 if __name__ == "__main__":
@@ -161,16 +465,37 @@ if __name__ == "__main__":
     parser.add_argument(
         "--category_raw", type=str, help="Specify the raw category name."
     )
+    parser.add_argument(
+        "--dry_run",
+        "--dry-run",
+        action="store_true",
+        help="Preview the statement changes against local snapshots, without writing.",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Write the edits to a plan file (data/<category>.plan.jsonl), without writing to Commons.",
+    )
+    parser.add_argument(
+        "--execute_plan",
+        "--execute-plan",
+        action="store_true",
+        help="Write the edits of the plan file made with --plan.",
+    )
+    parser.add_argument(
+        "--on_conflict",
+        choices=["skip", "replan"],
+        default="skip",
+        help="What --execute_plan does with files edited since the plan was made.",
+    )
     args = parser.parse_args()
 
     if args.auto_mode:
         config_file = "config_auto.json"
-        test = input(
-            "Proceed with upload? Press anything to continue, or Ctrl+C to cancel."
-        )
-        print(
-            "Remember: on Linux, you may use Ctrl+S to pause the processing and Ctrl+Q to resume."
-        )
+        if not (args.dry_run or args.plan):
+            test = input(
+                "Proceed with upload? Press anything to continue, or Ctrl+C to cancel."
+            )
     else:
         config_file = "config.json"
 
@@ -194,5 +519,30 @@ if __name__ == "__main__":
     CATEGORY_NAME = CATEGORY_RAW.replace("_", " ").replace("Category:", "").strip()
 
     output_file = DATA / f"{CATEGORY_NAME.replace(' ', '_')}.tsv"
-
-    upload_metadata_to_commons(output_file)
+    plan_file = output_file.with_suffix(".plan.jsonl")
+
+    # Each mode writes its own metrics files (see export_run_metrics).
+    if args.dry_run:
+        stage = "dry_run"
+        dry_run_upload(output_file)
+    elif args.plan:
+        stage = "plan"
+        plan_upload(output_file, plan_file)
+    elif args.execute_plan:
+        stage = "upload"
+        execute_plan(
+            plan_file,
+            output_file,
+            max_workers=config.get("UPLOAD_WORKERS", 1),
+            on_conflict=args.on_conflict,
+        )
+    else:
+        stage = "upload"
+        upload_metadata_to_commons(
+            output_file, max_workers=config.get("UPLOAD_WORKERS", 1)
+        )
+    export_run_metrics(
+        stage,
+        DATA / "metrics" / f"{CATEGORY_NAME.replace(' ', '_')}_{stage}.json",
+        config.get("METRICS_TEXTFILE_DIR"),
+    )
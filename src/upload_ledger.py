@@ -0,0 +1,88 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+# Persistent record of what upload.py did with each file of a TSV.
+#
+# For every file the ledger keeps the MediaInfo ID, the revision the entity
+# was left at, the outcome and a hash of the TSV row. A restarted upload
+# skips files whose row is unchanged and whose entity is still at the
+# recorded revision, so only new rows, edited rows, files changed by someone
+# else since, and failures are processed again.
+
+DONE_OUTCOMES = ("written", "unchanged")
+
+
+def row_hash(row):
+    """Hash of a TSV row (a dict or pandas Series), independent of column order."""
+    row = dict(row)
+    serialized = json.dumps(row, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(serialized).hexdigest()
+
+
+class UploadLedger:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS uploads (
+                file TEXT PRIMARY KEY,
+                mediainfo_id TEXT,
+                lastrevid INTEGER,
+                outcome TEXT NOT NULL,
+                row_hash TEXT NOT NULL,
+                updated REAL NOT NULL
+            )
+            """
+        )
+
+    def record(self, file_name, mediainfo_id, lastrevid, outcome, row_hash):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO uploads "
+            "(file, mediainfo_id, lastrevid, outcome, row_hash, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (file_name, mediainfo_id, lastrevid, outcome, row_hash, time.time()),
+        )
+
+    def get(self, file_name):
+        found = self._conn.execute(
+            "SELECT mediainfo_id, lastrevid, outcome, row_hash FROM uploads "
+            "WHERE file = ?",
+            (file_name,),
+        ).fetchone()
+        if found is None:
+            return None
+        return dict(zip(("mediainfo_id", "lastrevid", "outcome", "row_hash"), found))
+
+    def done_revisions(self, hashes_by_file):
+        """
+        Returns {file_name: lastrevid} for the files of `hashes_by_file`
+        ({file_name: row_hash}) that were done with the same row hash.
+        These are the candidates for skipping; the caller still has to check
+        that the entity is at that revision.
+        """
+        done = {}
+        for file_name, current_hash in hashes_by_file.items():
+            entry = self.get(file_name)
+            if (
+                entry
+                and entry["outcome"] in DONE_OUTCOMES
+                and entry["row_hash"] == current_hash
+                and entry["lastrevid"] is not None
+            ):
+                done[file_name] = entry["lastrevid"]
+        return done
+
+    def outcome_counts(self):
+        """{outcome: number of files} over every run recorded in the ledger."""
+        return dict(
+            self._conn.execute("SELECT outcome, COUNT(*) FROM uploads GROUP BY outcome")
+        )
+
+    def close(self):
+        self._conn.close()
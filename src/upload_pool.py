@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from wikibaseintegrator.wbi_exceptions import MaxRetriesReachedException
+
+MAX_THROTTLE_RETRIES = 3
+DEFAULT_RETRY_AFTER = 60
+
+# Worker pool for upload.py with adaptive concurrency.
+#
+# AdaptiveLimit is an AIMD controller: the number of files processed at once
+# grows by one after each `limit` successes in a row, and is halved whenever
+# Commons pushes back (maxlag, rate limiting, HTTP 429/503). A Retry-After or
+# lag value also pauses every worker, not only the one that got the answer.
+#
+# WikibaseIntegrator already retries maxlag and throttled edits itself and
+# only logs about it, so ThrottleSignalHandler listens to those log records
+# and feeds them to the controller.
+
+
+class AdaptiveLimit:
+    def __init__(self, initial=2, minimum=1, maximum=8):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self._active = 0
+        self._successes = 0
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                elif self._active >= self.limit:
+                    self._cond.wait()
+                else:
+                    break
+            self._active += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+        return False
+
+    def success(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def throttle(self, retry_after=None):
+        with self._cond:
+            self.limit = max(self.minimum, self.limit // 2)
+            self._successes = 0
+            if retry_after:
+                self._paused_until = max(
+                    self._paused_until, time.monotonic() + float(retry_after)
+                )
+            self._cond.notify_all()
+        logging.warning(
+            f"Commons asked to slow down; now {self.limit} concurrent edits"
+            + (f", pausing {retry_after}s." if retry_after else ".")
+        )
+
+
+class ThrottleSignalHandler(logging.Handler):
+    """Turns WikibaseIntegrator's maxlag / rate-limit log records into throttle signals."""
+
+    def __init__(self, limit):
+        super().__init__(level=logging.ERROR)
+        self.limit = limit
+
+    def emit(self, record):
+        message = str(record.msg)
+        if any(
+            signal in message
+            for signal in ("maxlag", "rate limited", "Service unavailable")
+        ):
+            retry_after = record.args[-1] if record.args else None
+            self.limit.throttle(retry_after)
+
+
+def throttle_delay(error):
+    """
+    Returns the back-off delay in seconds if `error` is Commons pushing back,
+    None for any other error.
+    """
+    if isinstance(error, MaxRetriesReachedException):
+        return DEFAULT_RETRY_AFTER
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        if error.response.status_code in (429, 503):
+            retry_after = error.response.headers.get("Retry-After", "")
+            return int(retry_after) if retry_after.isdigit() else DEFAULT_RETRY_AFTER
+    return None
+
+
+def run_adaptive(tasks, process, limit, on_result=None):
+    """
+    Runs process(*task) for each task in a pool of up to `limit.maximum` threads,
+    with `limit` deciding how many run at once.
+
+    `process` must re-raise the errors for which throttle_delay() returns a
+    delay; those tasks are retried after the back-off, up to
+    MAX_THROTTLE_RETRIES times. `on_result(task, result)` is called from the
+    calling thread as tasks finish. Tasks are consumed lazily, so a generator
+    (e.g. prefetch_mediainfo) is only read a little ahead of the workers.
+    """
+    signal_handler = ThrottleSignalHandler(limit)
+    wbi_logger = logging.getLogger("wikibaseintegrator")
+    wbi_logger.addHandler(signal_handler)
+
+    def run_one(task):
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            with limit:
+                try:
+                    result = process(*task)
+                except Exception as e:
+                    delay = throttle_delay(e)
+                    if delay is None or attempt == MAX_THROTTLE_RETRIES:
+                        raise
+                    limit.throttle(delay)
+                    continue
+            limit.success()
+            return result
+
+    tasks = iter(tasks)
+    in_flight = {}
+    try:
+        with ThreadPoolExecutor(max_workers=limit.maximum) as executor:
+            while True:
+                while len(in_flight) < 2 * limit.maximum:
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    in_flight[executor.submit(run_one, task)] = task
+                if not in_flight:
+                    break
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logging.error(f"Task failed: {e!r}")
+                        result = None
+                    if on_result:
+                        on_result(task, result)
+    finally:
+        wbi_logger.removeHandler(signal_handler)
@@ -0,0 +1,59 @@
+import re
+
+# Extraction of the identifiers get_metadata.py looks for in a file page's
+# wikitext.
+#
+# Each file page is scanned once, when its wikitext is fetched, and the
+# resulting record is what the prefetch stage and fetch_file_record work
+# from. The scan is a few substring checks and precompiled searches, one per
+# token: on CPython these run faster than a single alternation of every token
+# (benchmarks/wikitext_benchmark.py compares the two).
+
+PAGEID = re.compile(r"\|\s*pageid\s*=\s*(\d+)")
+IA_STREAM_URL = re.compile(r"https://archive\.org/stream/([^#]+)#page/n(\d+)")
+FLICKR_PREFIX = "https://www.flickr.com/photos/biodivlibrary/"
+FLICKR_URL = re.compile(r"https://www\.flickr\.com/photos/biodivlibrary/(\d+)")
+BHL_PAGE_URL = re.compile(r"biodiversitylibrary\.org/page/(\d+)")
+BHL_PAGEIMAGE_URL = re.compile(r"biodiversitylibrary\.org/pageimage/(\d+)")
+
+
+def scan_wikitext(wikitext):
+    """
+    Returns the identifiers found in `wikitext`:
+
+      bhl_template      "{{BHL" appears
+      pageid            first "| pageid = N" value, or ""
+      consortium        "BHL Consortium" appears
+      ia_url, ia_item, ia_page
+                        first archive.org/stream/...#page/nN URL and its parts
+      flickr            a biodivlibrary Flickr URL appears
+      flickr_id         photo ID of the first such URL that has one, or ""
+      bhl_page_urls, bhl_pageimage_urls
+                        page IDs of biodiversitylibrary.org/page/N and
+                        /pageimage/N links, in order
+      extracted         "{{Extracted from" appears
+    """
+    wikitext = wikitext or ""
+    pageid = PAGEID.search(wikitext)
+    ia = IA_STREAM_URL.search(wikitext)
+    flickr = FLICKR_PREFIX in wikitext
+    flickr_id = FLICKR_URL.search(wikitext) if flickr else None
+    return {
+        "bhl_template": "{{BHL" in wikitext,
+        "pageid": pageid.group(1) if pageid else "",
+        "consortium": "BHL Consortium" in wikitext,
+        "ia_url": ia.group(0) if ia else "",
+        "ia_item": ia.group(1) if ia else "",
+        "ia_page": ia.group(2) if ia else "",
+        "flickr": flickr,
+        "flickr_id": flickr_id.group(1) if flickr_id else "",
+        "bhl_page_urls": BHL_PAGE_URL.findall(wikitext),
+        "bhl_pageimage_urls": BHL_PAGEIMAGE_URL.findall(wikitext),
+        "extracted": "{{Extracted from" in wikitext,
+    }
+
+
+def single_bhl_url_page_id(ids):
+    """The page ID of the BHL page links, if they all point to the same page, else ""."""
+    page_ids = ids["bhl_page_urls"] + ids["bhl_pageimage_urls"]
+    return page_ids[0] if len(set(page_ids)) == 1 else ""
@@ -0,0 +1,138 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from wikibaseintegrator import WikibaseIntegrator
+
+import upload
+from disk_cache import DiskCache
+
+# A MediaInfo entity as wbgetentities returns it: statements with qualifiers
+# and referenced snaks, each with the hashes Commons adds.
+ENTITY = {
+    "type": "mediainfo",
+    "id": "M152123456",
+    "title": "File:Plate 12 BHL1000000.jpg",
+    "pageid": 152123456,
+    "ns": 6,
+    "lastrevid": 987654321,
+    "modified": "2025-03-20T10:00:00Z",
+    "labels": {},
+    "descriptions": {},
+    "statements": {
+        "P6216": [
+            {
+                "mainsnak": {
+                    "snaktype": "value",
+                    "property": "P6216",
+                    "hash": "5570347fdc76d2a80732f51ea10ee4b144a084e0",
+                    "datavalue": {
+                        "value": {"entity-type": "item", "numeric-id": 19652, "id": "Q19652"},
+                        "type": "wikibase-entityid",
+                    },
+                },
+                "type": "statement",
+                "id": "M152123456$0A1B2C3D-0000-0000-0000-000000000001",
+                "rank": "normal",
+                "references": [
+                    {
+                        "hash": "6b8e8e2b1bbf1f2b4b42c8e3d0b4fd6d3e2a9c11",
+                        "snaks": {
+                            "P854": [
+                                {
+                                    "snaktype": "value",
+                                    "property": "P854",
+                                    "hash": "0f1e2d3c4b5a69788796a5b4c3d2e1f001122334",
+                                    "datavalue": {
+                                        "value": "https://www.biodiversitylibrary.org/bibliography/900",
+                                        "type": "string",
+                                    },
+                                }
+                            ]
+                        },
+                        "snaks-order": ["P854"],
+                    }
+                ],
+            }
+        ],
+        "P1433": [
+            {
+                "mainsnak": {
+                    "snaktype": "value",
+                    "property": "P1433",
+                    "hash": "1c2d3e4f5a6b7c8d9e0f1a2b3c4d5e6f7a8b9c0d",
+                    "datavalue": {
+                        "value": {"entity-type": "item", "numeric-id": 100, "id": "Q100"},
+                        "type": "wikibase-entityid",
+                    },
+                },
+                "type": "statement",
+                "qualifiers": {
+                    "P518": [
+                        {
+                            "snaktype": "value",
+                            "property": "P518",
+                            "hash": "2d3e4f5a6b7c8d9e0f1a2b3c4d5e6f7a8b9c0d1e",
+                            "datavalue": {
+                                "value": {"entity-type": "item", "numeric-id": 112134971, "id": "Q112134971"},
+                                "type": "wikibase-entityid",
+                            },
+                        }
+                    ]
+                },
+                "qualifiers-order": ["P518"],
+                "id": "M152123456$0A1B2C3D-0000-0000-0000-000000000002",
+                "rank": "normal",
+                "references": [
+                    {
+                        "hash": "3e4f5a6b7c8d9e0f1a2b3c4d5e6f7a8b9c0d1e2f",
+                        "snaks": {
+                            "P854": [
+                                {
+                                    "snaktype": "value",
+                                    "property": "P854",
+                                    "hash": "4f5a6b7c8d9e0f1a2b3c4d5e6f7a8b9c0d1e2f3a",
+                                    "datavalue": {
+                                        "value": "https://www.biodiversitylibrary.org/page/1000000",
+                                        "type": "string",
+                                    },
+                                }
+                            ]
+                        },
+                        "snaks-order": ["P854"],
+                    }
+                ],
+            }
+        ],
+    },
+}
+
+
+def test_snapshot_with_references_loads_back(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        upload, "MEDIAINFO_SNAPSHOTS", DiskCache(tmp_path / "mediainfo_snapshots.sqlite")
+    )
+    wbi = WikibaseIntegrator()
+    media, entity_json = upload.load_media(wbi, ENTITY["id"], ENTITY, loaded=True)
+    upload.save_snapshot("Plate 12 BHL1000000.jpg", ENTITY["id"], entity_json)
+
+    snapshot = upload.MEDIAINFO_SNAPSHOTS.get("mediainfo", "Plate 12 BHL1000000.jpg")
+    assert snapshot["entity"] == ENTITY
+    loaded = wbi.mediainfo.new().from_json(snapshot["entity"])
+    assert loaded.lastrevid == ENTITY["lastrevid"]
+    assert loaded.claims.get_json() == media.claims.get_json()
+    assert [reference.hash for reference in loaded.claims.get("P1433")[0].references] == [
+        "3e4f5a6b7c8d9e0f1a2b3c4d5e6f7a8b9c0d1e2f"
+    ]
+
+
+def test_file_without_structured_data_has_empty_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        upload, "MEDIAINFO_SNAPSHOTS", DiskCache(tmp_path / "mediainfo_snapshots.sqlite")
+    )
+    media, entity_json = upload.load_media(WikibaseIntegrator(), "M1", None, loaded=True)
+    upload.save_snapshot("Empty.jpg", "M1", entity_json)
+
+    assert entity_json is None
+    assert upload.MEDIAINFO_SNAPSHOTS.get("mediainfo", "Empty.jpg") == {"id": "M1", "entity": None}